@@ -0,0 +1,150 @@
+# JSON-RPC API load test: requests/sec for block, transaction and batch queries, with and without the response cache
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import time
+
+from libertydns.api.api import APIServer
+from libertydns.storage.database import BlockStore
+from chaingen import generate_chain
+
+
+class Client:
+    """
+    Minimal HTTP/1.1 JSON-RPC client over one persistent connection.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+
+    @staticmethod
+    async def connect(port):
+        return Client(*await asyncio.open_connection('127.0.0.1', port))
+
+    async def post(self, payload):
+        body = json.dumps(payload).encode()
+        self.writer.write(b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                          b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        status = await self.reader.readline()
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get(b'transfer-encoding') == b'chunked':
+            parts = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                parts.append(await self.reader.readexactly(size + 2))
+                if not size:
+                    break
+            data = b''.join(part[:-2] for part in parts)
+        else:
+            data = await self.reader.readexactly(int(headers.get(b'content-length', b'0')))
+        if not status.startswith(b'HTTP/1.1 200'):
+            raise ValueError("Request failed: %s" % status.decode().strip())
+        return json.loads(data)
+
+    async def call(self, method, *params):
+        self.next_id += 1
+        response = await self.post({'jsonrpc': '2.0', 'id': self.next_id, 'method': method, 'params': list(params)})
+        if 'error' in response:
+            raise ValueError("%s failed: %s" % (method, response['error']['message']))
+        return response['result']
+
+    def close(self):
+        self.writer.close()
+
+
+def make_request(workload, rng, heights, txids):
+    if workload == 'block':
+        return {'jsonrpc': '2.0', 'id': 1, 'method': 'getblockbyheight', 'params': [rng.choice(heights)]}
+    if workload == 'transaction':
+        return {'jsonrpc': '2.0', 'id': 1, 'method': 'gettransaction', 'params': [rng.choice(txids)]}
+    return [{'jsonrpc': '2.0', 'id': i, 'method': 'gettransaction', 'params': [rng.choice(txids)]} for i in range(10)]
+
+
+async def load(port, workload, clients, requests, heights, txids, seed=0):
+    """
+    `clients` concurrent connections each sending `requests` requests back to back.
+
+    :return: Requests per second (a batch counts as one request)
+    """
+    connections = [await Client.connect(port) for _ in range(clients)]
+
+    async def worker(client, rng):
+        for _ in range(requests):
+            await client.post(make_request(workload, rng, heights, txids))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(client, random.Random(seed + i)) for i, client in enumerate(connections)))
+    elapsed = time.perf_counter() - started
+    for client in connections:
+        client.close()
+    return clients * requests / elapsed
+
+
+async def measure(store, heights, txids, clients, requests, cache_bytes):
+    server = APIServer(store, cache_bytes=cache_bytes)
+    await server.start(port=0)
+    try:
+        results = {}
+        for workload in ('block', 'transaction', 'batch'):
+            # The first pass fills the cache; the second is measured
+            await load(server.port, workload, clients, requests, heights, txids)
+            results[workload + '_requests_per_second'] = await load(server.port, workload, clients, requests,
+                                                                    heights, txids, seed=1)
+        results['cache'] = server.cache.to_json()
+    finally:
+        await server.close()
+    return results
+
+
+def run(blocks=100, txs_per_block=50, clients=16, requests=200):
+    chain = generate_chain(blocks, txs_per_block)
+    directory = tempfile.mkdtemp()
+    try:
+        store = BlockStore(directory)
+        for height, block in enumerate(chain):
+            store.append(block, height)
+        heights = list(range(len(chain)))
+        txids = [tx.txid.hex() for block in chain for tx in block.transactions]
+        results = {
+            'blocks': len(chain),
+            'transactions': len(txids),
+            'clients': clients,
+            'uncached': asyncio.run(measure(store, heights, txids, clients, requests, cache_bytes=0)),
+            'cached': asyncio.run(measure(store, heights, txids, clients, requests, cache_bytes=256 * 1024 * 1024))
+        }
+        store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the JSON-RPC API over local HTTP connections. "
+                                                 "Clients run in the server's process, so the figures are a lower bound.")
+    parser.add_argument('--blocks', type=int, default=100)
+    parser.add_argument('--txs-per-block', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help="Requests per client")
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.blocks, args.txs_per_block, args.clients, args.requests)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['blocks']} blocks, {results['transactions']} transactions, {results['clients']} clients")
+        for name in ('uncached', 'cached'):
+            result = results[name]
+            print(f"{name:>9}: getblockbyheight {result['block_requests_per_second']:8.0f} req/s, "
+                  f"gettransaction {result['transaction_requests_per_second']:8.0f} req/s, "
+                  f"batches of 10 {result['batch_requests_per_second']:8.0f} req/s")
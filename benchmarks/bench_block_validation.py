@@ -0,0 +1,59 @@
+# Block validation pipeline benchmark: per-stage timings and blocks/sec, pipelined vs one block at a time
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from libertydns.crypto.crypto import SignatureVerifier
+from libertydns.storage.database import UTXODatabase, CoinsCache
+from libertydns.validation.block_validation import ValidationPipeline
+from chaingen import generate_chain
+
+
+def make_chain(count, txs_per_block, fan_in=2, keys=16, seed=0):
+    """
+    Serialized blocks of a chain whose transactions spend earlier outputs with
+    valid P2PKH signatures, genesis included.
+    """
+    return [block.serialize() for block in generate_chain(count - 1, txs_per_block, fan_in, keys=keys, seed=seed)]
+
+
+def validate(raw_blocks, window, workers):
+    directory = tempfile.mkdtemp()
+    try:
+        coins = CoinsCache(UTXODatabase(os.path.join(directory, 'coins')))
+        with SignatureVerifier(max_workers=workers) as verifier:
+            pipeline = ValidationPipeline(coins, verifier=verifier, window=window)
+            return pipeline.run(raw_blocks).to_json()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(blocks=200, txs_per_block=20, fan_in=2, window=8, workers=None):
+    raw_blocks = make_chain(blocks, txs_per_block, fan_in)
+    return {
+        'serial': validate(raw_blocks, 0, 1),
+        'pipelined': validate(raw_blocks, window, workers)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate a synthetic signed chain with the block validation pipeline.")
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--fan-in', type=int, default=2)
+    parser.add_argument('--window', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.blocks, args.txs_per_block, args.fan_in, args.window, args.workers)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, result in results.items():
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result['stage_seconds'].items())
+            print(f"{name:>9}: {result['blocks_per_second']:.1f} blocks/sec "
+                  f"({result['blocks']} blocks, {result['signatures']} signatures in {result['elapsed_seconds']:.2f}s)")
+            print(f"           {stages}")
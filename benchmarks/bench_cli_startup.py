@@ -0,0 +1,82 @@
+# Command-line startup benchmark: wall time of light commands, run as fresh processes, against a bare interpreter
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from libertydns.storage.database import BlockStore, DomainIndex
+from chaingen import generate_chain
+
+COMMANDS = {
+    'help': ['--help'],
+    'chain_info': ['chain', 'info'],
+    'chain_block': ['chain', 'block', '0'],
+    'domain_lookup': ['domain', 'lookup', 'chain0.dns'],
+    'wallet_address': ['wallet', 'address', 'benchmark']
+}
+
+
+def make_data_dir(directory, blocks):
+    chain = generate_chain(blocks, 5, domain_mix=0.1)
+    store = BlockStore(os.path.join(directory, 'blocks'))
+    domains = DomainIndex(os.path.join(directory, 'domains'))
+    for height, block in enumerate(chain):
+        store.append(block, height)
+        domains.connect_block(block, height)
+    store.close()
+
+
+def time_command(argv, runs):
+    """
+    :return: List of wall times in seconds, one per run.
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def run(runs=20, blocks=20):
+    directory = tempfile.mkdtemp()
+    try:
+        make_data_dir(directory, blocks)
+        baseline = statistics.median(time_command([sys.executable, '-c', 'pass'], runs))
+        results = {'runs': runs, 'interpreter_seconds': baseline, 'commands': {}}
+        cli = [sys.executable, '-m', 'libertydns.api.cli', '--data-dir', directory]
+        for name, args in COMMANDS.items():
+            times = time_command(cli + args, runs)
+            median = statistics.median(times)
+            results['commands'][name] = {
+                'median_seconds': median,
+                'min_seconds': min(times),
+                'overhead_seconds': median - baseline
+            }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time light CLI commands as fresh processes. "
+                                                 "The overhead is the median over a bare `python -c pass`.")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--blocks', type=int, default=20, help="Blocks in the temporary data directory")
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.runs, args.blocks)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"interpreter startup {results['interpreter_seconds'] * 1000:6.1f} ms (median of {results['runs']})")
+        for name, result in results['commands'].items():
+            print(f"{name:>15}: {result['median_seconds'] * 1000:6.1f} ms median, "
+                  f"{result['min_seconds'] * 1000:6.1f} ms min, "
+                  f"{result['overhead_seconds'] * 1000:+6.1f} ms over the interpreter")
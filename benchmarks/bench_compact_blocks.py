@@ -0,0 +1,144 @@
+# Compact block relay benchmark: bytes on the wire, propagation and reconstruction time vs full-block relay
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from libertydns.core.block import Block
+from libertydns.core.transaction import TransactionBuilder
+from libertydns.network.compact_block import CompactBlock, PartialBlock
+from libertydns.network.node import Node
+from libertydns.network.network import start_local_network, stop_local_network
+from bench_p2p import EASY_BITS, mine, make_transaction, wait_until
+
+
+def make_rounds(count, txs_per_block, unrelayed, seed=0, version=1):
+    """
+    A genesis block and `count` rounds of (loose transactions, block). Each block
+    holds the loose transactions of its round plus `unrelayed` transactions the
+    network has never seen, which the receivers have to fetch. Blocks and
+    transactions are of `version` (2: the v2 wire format).
+    """
+    def make(rng):
+        builder = make_transaction(rng).to_builder()
+        builder.version = version
+        return builder.build()
+
+    rng = random.Random(seed)
+    rounds = []
+    previous_hash = b'\x00' * 32
+    for height in range(count + 1):
+        loose = [make(rng) for _ in range(txs_per_block)]
+        coinbase = (TransactionBuilder(tx_type=0, version=version, lock_time=height)
+                    .add_coin_output(50 * 10**8, rng.randbytes(25)).build())
+        transactions = [coinbase] + loose + [make(rng) for _ in range(unrelayed)]
+        block = Block(version, previous_hash, Block.calculateMerkleRoot(transactions), 1700000000 + height,
+                      EASY_BITS, 0, transactions)
+        previous_hash = mine(block).header_hash()
+        rounds.append((loose, block))
+    return rounds[0][1], rounds[1:]
+
+
+def check_reconstruction(rounds):
+    """
+    Round-trip every block through a serialized compact block and rebuild it
+    from its loose transactions plus the missing ones, as a receiving node does.
+
+    :raises ValueError: If a rebuilt block differs from the original.
+    """
+    for nonce, (loose, block) in enumerate(rounds):
+        compact = CompactBlock.parse(CompactBlock.from_block(block, nonce).serialize())
+        partial = PartialBlock(compact, {tx.txid: tx for tx in loose})
+        partial.fill([block.transactions[index] for index in partial.missing])
+        rebuilt = partial.to_block()
+        if rebuilt.header_hash() != block.header_hash() or rebuilt.serialize() != block.serialize():
+            raise ValueError("Compact block %s did not rebuild to the original" % block.header_hash().hex())
+
+
+async def propagate(genesis, rounds, nodes_count, outbound, compact, timeout=60.0):
+    nodes, managers = await start_local_network(lambda: Node(genesis, compact_blocks=compact), nodes_count, outbound)
+    try:
+        def wire_bytes():
+            return sum(peer.bytes_received for node in nodes for peer in node.peers)
+
+        rng = random.Random(1)
+        block_bytes = 0
+        block_seconds = []
+        for height, (loose, block) in enumerate(rounds, 1):
+            for tx in loose:
+                rng.choice(nodes).submit_transaction(tx)
+            await wait_until(lambda: all(tx.txid in node.transactions for node in nodes for tx in loose), timeout)
+            bytes_before = wire_bytes()
+            started = time.perf_counter()
+            nodes[0].submit_block(block)
+            await wait_until(lambda: all(node.best_height == height and len(node.blocks) == height + 1
+                                         for node in nodes), timeout)
+            block_seconds.append(time.perf_counter() - started)
+            block_bytes += wire_bytes() - bytes_before
+        stats = {}
+        for node in nodes:
+            for key, value in node.compact_stats.items():
+                stats[key] = stats.get(key, 0) + value
+    finally:
+        await stop_local_network(nodes, managers)
+
+    block_seconds.sort()
+    deliveries = len(rounds) * (nodes_count - 1)
+    result = {
+        'relay': 'compact' if compact else 'full',
+        'blocks': len(rounds),
+        'block_bytes_on_wire': block_bytes,
+        'bytes_per_delivery': block_bytes / deliveries,
+        'median_propagation_ms': block_seconds[len(block_seconds) // 2] * 1000,
+        'max_propagation_ms': block_seconds[-1] * 1000
+    }
+    if compact:
+        reconstructed = stats.get('complete', 0)
+        result.update({
+            'reconstructed': reconstructed,
+            'round_trips': stats.get('round_trips', 0),
+            'missing_transactions': stats.get('missing', 0),
+            'failed': stats.get('failed', 0),
+            'reconstruction_us': stats.get('seconds', 0.0) / max(reconstructed, 1) * 1e6
+        })
+    return result
+
+
+def run(nodes=8, outbound=3, blocks=30, txs_per_block=200, unrelayed=2, version=1):
+    genesis, rounds = make_rounds(blocks, txs_per_block, unrelayed, version=version)
+    check_reconstruction(rounds)
+    return {
+        'nodes': nodes,
+        'version': version,
+        'txs_per_block': txs_per_block + unrelayed + 1,
+        'full': asyncio.run(propagate(genesis, rounds, nodes, outbound, compact=False)),
+        'compact': asyncio.run(propagate(genesis, rounds, nodes, outbound, compact=True))
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay blocks whose transactions the nodes already have, "
+                                                 "as full blocks and as compact blocks.")
+    parser.add_argument('--nodes', type=int, default=8)
+    parser.add_argument('--outbound', type=int, default=3)
+    parser.add_argument('--blocks', type=int, default=30)
+    parser.add_argument('--txs-per-block', type=int, default=200)
+    parser.add_argument('--unrelayed', type=int, default=2, help="Transactions per block the nodes have not seen")
+    parser.add_argument('--version', type=int, default=1, help="Block and transaction version (2: v2 wire format)")
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.nodes, args.outbound, args.blocks, args.txs_per_block, args.unrelayed, args.version)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['nodes']} nodes, {results['txs_per_block']} transactions per block")
+        for name in ('full', 'compact'):
+            result = results[name]
+            print(f"{name:>8}: {result['bytes_per_delivery'] / 1e3:.1f} kB per block delivery, "
+                  f"propagation median {result['median_propagation_ms']:.1f} ms, max {result['max_propagation_ms']:.1f} ms")
+        compact = results['compact']
+        print(f"          {compact['reconstructed']} reconstructions in {compact['reconstruction_us']:.0f} us each, "
+              f"{compact['round_trips']} getblocktxn round trips, {compact['failed']} fell back to full blocks")
+        print(f"Bytes saved: {1 - results['compact']['block_bytes_on_wire'] / results['full']['block_bytes_on_wire']:.1%}")
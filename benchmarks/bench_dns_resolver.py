@@ -0,0 +1,111 @@
+# DNS resolver load generator: queries/sec and p50/p99 latency against a local server
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+
+from libertydns.dns.dns_resolver import DNSResolver, DNSServer, build_query, TYPE_A, TYPE_AAAA
+
+
+def make_zone(count, seed=0):
+    """
+    Map "nameN.com" to a synthetic IPv4 (or every tenth name, IPv6) address.
+    """
+    rng = random.Random(seed)
+    zone = {}
+    for i in range(count):
+        if i % 10 == 0:
+            zone[(f"name{i}", 'com')] = '2001:db8::%x' % rng.randint(1, 0xffff)
+        else:
+            zone[(f"name{i}", 'com')] = '10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+    return zone
+
+
+def serve(port, domains, ready):
+    zone = make_zone(domains)
+
+    def lookup(domain_name, tld):
+        ip_address = zone.get((domain_name, tld))
+        return ip_address, ip_address is not None
+
+    async def main():
+        server = DNSServer(DNSResolver(lookup), port=port)
+        await server.start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+class _Client(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = {}
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(int.from_bytes(data[:2], 'big'), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def load(port, domains, queries, concurrency, seed=1):
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(_Client, remote_addr=('127.0.0.1', port))
+    rng = random.Random(seed)
+    names = [(f"name{rng.randrange(domains)}.com", TYPE_AAAA if rng.random() < 0.1 else TYPE_A)
+             for _ in range(queries)]
+    latencies = []
+    next_query = iter(range(queries))
+
+    async def worker():
+        for i in next_query:
+            query_id = i & 0xffff
+            future = loop.create_future()
+            client.pending[query_id] = future
+            started = time.perf_counter()
+            transport.sendto(build_query(query_id, *names[i]))
+            try:
+                await asyncio.wait_for(future, timeout=1.0)
+                latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                client.pending.pop(query_id, None)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    transport.close()
+    latencies.sort()
+    return {
+        'queries': queries,
+        'answered': len(latencies),
+        'qps': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None
+    }
+
+
+def run(queries=20000, concurrency=32, domains=10000, port=15353):
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, domains, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(timeout=10):
+            raise RuntimeError("DNS server did not start")
+        return asyncio.run(load(port, domains, queries, concurrency))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the DNS resolver over UDP on localhost.")
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--domains', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=15353)
+    args = parser.parse_args()
+
+    result = run(args.queries, args.concurrency, args.domains, args.port)
+    print(f"Answered {result['answered']}/{result['queries']} queries")
+    print(f"Throughput: {result['qps']:.0f} queries/sec")
+    print(f"Latency: p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
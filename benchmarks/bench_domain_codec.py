@@ -0,0 +1,66 @@
+# FullDomain codec benchmark: bit-packed binary layout vs the old "name.tld:ip" string format
+import argparse
+import random
+import string
+import time
+
+from libertydns.core.domain import FullDomain
+
+
+def random_domains(count, seed=0):
+    rng = random.Random(seed)
+    domains = []
+    for _ in range(count):
+        name = ''.join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(rng.randint(3, 20)))
+        tld = rng.choice(['com', 'net', 'org', 'io', 'dns'])
+        if rng.random() < 0.8:
+            ip = '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+        else:
+            ip = ':'.join('%x' % rng.randint(0, 0xffff) for _ in range(8))
+        domains.append(FullDomain(name, tld, ip))
+    return domains
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run(count=20000, repeat=3):
+    domains = random_domains(count)
+    results = {}
+
+    string_time, encoded_strings = timed(lambda: [d.get_full_domain().encode('utf-8') for d in domains], repeat)
+    string_parse_time, _ = timed(lambda: [FullDomain.from_string(s.decode('utf-8')) for s in encoded_strings], repeat)
+    # A length byte is needed to frame each variable-length string
+    string_size = sum(len(s) + 1 for s in encoded_strings)
+    results['string'] = {'encode_s': string_time, 'decode_s': string_parse_time, 'bytes': string_size}
+
+    binary_time, encoded = timed(lambda: [d.serialize() for d in domains], repeat)
+    binary_parse_time, parsed = timed(lambda: [FullDomain.parse(b) for b in encoded], repeat)
+    assert [d.get_full_domain() for d in parsed] == [d.get_full_domain() for d in domains]
+    results['binary'] = {'encode_s': binary_time, 'decode_s': binary_parse_time, 'bytes': sum(map(len, encoded))}
+
+    bulk_time, bulk = timed(lambda: FullDomain.encode_many(domains), repeat)
+    bulk_parse_time, bulk_parsed = timed(lambda: FullDomain.decode_many(bulk), repeat)
+    assert bulk == b''.join(encoded)
+    assert [d.get_full_domain() for d in bulk_parsed] == [d.get_full_domain() for d in domains]
+    results['bulk'] = {'encode_s': bulk_time, 'decode_s': bulk_parse_time, 'bytes': len(bulk)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.count, args.repeat)
+    print(f"{'codec':<8}{'encode/s':>14}{'decode/s':>14}{'bytes/domain':>14}")
+    for codec, r in results.items():
+        print(f"{codec:<8}{args.count / r['encode_s']:>14.0f}{args.count / r['decode_s']:>14.0f}"
+              f"{r['bytes'] / args.count:>14.1f}")
@@ -0,0 +1,140 @@
+# P2P relay benchmark: messages/sec and blocks/sec propagated across in-process localhost nodes
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from libertydns.core.block import Block
+from libertydns.core.transaction import TransactionBuilder
+from libertydns.consensus.pow import bits_to_target, scan_nonces
+from libertydns.network.node import Node
+from libertydns.network.network import start_local_network, stop_local_network
+from libertydns.utils import metrics
+
+EASY_BITS = 0x207fffff  # About one hash in two meets the target
+
+
+def mine(block):
+    header = block.serialize_header()
+    target = bits_to_target(block.difficulty)
+    block.nonce = scan_nonces(header, 0, 1 << 32, target, target)[0]
+    return block
+
+
+def make_transaction(rng):
+    builder = TransactionBuilder()
+    builder.add_coin_input(rng.randbytes(32), 0, rng.randbytes(106))
+    for _ in range(2):
+        builder.add_coin_output(rng.randrange(1, 10**8), b'\x76\xa9\x14' + rng.randbytes(20) + b'\x88\xac')
+    return builder.build()
+
+
+def make_chain(count, txs_per_block, seed=0):
+    """
+    A genesis block and `count` blocks on top of it, each with a coinbase and
+    `txs_per_block` synthetic coin transactions.
+    """
+    rng = random.Random(seed)
+    blocks = []
+    previous_hash = b'\x00' * 32
+    for height in range(count + 1):
+        coinbase = TransactionBuilder(tx_type=0, lock_time=height).add_coin_output(50 * 10**8, rng.randbytes(25)).build()
+        transactions = [coinbase] + [make_transaction(rng) for _ in range(txs_per_block if height else 0)]
+        block = Block(1, previous_hash, Block.calculateMerkleRoot(transactions), 1700000000 + height,
+                      EASY_BITS, 0, transactions)
+        previous_hash = mine(block).header_hash()
+        blocks.append(block)
+    return blocks
+
+
+async def wait_until(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Network did not converge in %.0fs" % timeout)
+        await asyncio.sleep(0.005)
+
+
+async def propagate(nodes_count, outbound, blocks, loose_txs, timeout=120.0, metrics_port=None):
+    genesis, chain = blocks[0], blocks[1:]
+    server = None
+    if metrics_port is not None:
+        server = await metrics.start_metrics_server(port=metrics_port)
+    nodes, managers = await start_local_network(lambda: Node(genesis), nodes_count, outbound)
+    try:
+        def messages():
+            return sum(sum(node.messages_received.values()) for node in nodes)
+
+        def wire_bytes():
+            return sum(peer.bytes_received for node in nodes for peer in node.peers)
+
+        # Blocks mined one after another at the first node
+        messages_before, bytes_before = messages(), wire_bytes()
+        started = time.perf_counter()
+        for block in chain:
+            nodes[0].submit_block(block)
+            await asyncio.sleep(0)
+        await wait_until(lambda: all(node.best_height == len(chain) and len(node.blocks) == len(blocks)
+                                     for node in nodes), timeout)
+        block_elapsed = time.perf_counter() - started
+        block_messages = messages() - messages_before
+        block_bytes = wire_bytes() - bytes_before
+
+        # A burst of loose transactions entering at random nodes
+        rng = random.Random(1)
+        txs = [make_transaction(rng) for _ in range(loose_txs)]
+        messages_before = messages()
+        started = time.perf_counter()
+        for tx in txs:
+            rng.choice(nodes).submit_transaction(tx)
+        await wait_until(lambda: all(len(node.transactions) == loose_txs for node in nodes), timeout)
+        tx_elapsed = time.perf_counter() - started
+        tx_messages = messages() - messages_before
+    finally:
+        await stop_local_network(nodes, managers)
+        if server is not None:
+            server.close()
+
+    return {
+        'nodes': nodes_count,
+        'outbound': outbound,
+        'blocks': len(chain),
+        'block_propagation_seconds': block_elapsed,
+        'blocks_per_second': len(chain) / block_elapsed,
+        'block_deliveries_per_second': len(chain) * (nodes_count - 1) / block_elapsed,
+        'block_messages_per_second': block_messages / block_elapsed,
+        'block_bytes_on_wire': block_bytes,
+        'transactions': loose_txs,
+        'tx_propagation_seconds': tx_elapsed,
+        'tx_deliveries_per_second': loose_txs * (nodes_count - 1) / tx_elapsed,
+        'tx_messages_per_second': tx_messages / tx_elapsed
+    }
+
+
+def run(nodes=16, outbound=4, blocks=200, txs_per_block=20, loose_txs=5000, metrics_port=None):
+    chain = make_chain(blocks, txs_per_block)
+    if metrics_port is not None:
+        metrics.enable(log_level=logging.WARNING)
+    return asyncio.run(propagate(nodes, outbound, chain, loose_txs, metrics_port=metrics_port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propagate blocks and transactions through in-process localhost nodes.")
+    parser.add_argument('--nodes', type=int, default=16)
+    parser.add_argument('--outbound', type=int, default=4)
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--loose-txs', type=int, default=5000)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Enable instrumentation and serve Prometheus metrics on this port during the run")
+    args = parser.parse_args()
+
+    result = run(args.nodes, args.outbound, args.blocks, args.txs_per_block, args.loose_txs, args.metrics_port)
+    print(f"{result['nodes']} nodes, {result['outbound']} outbound peers each")
+    print(f"Blocks: {result['blocks']} propagated to every node in {result['block_propagation_seconds']:.2f}s "
+          f"({result['blocks_per_second']:.1f} blocks/sec, {result['block_deliveries_per_second']:.0f} deliveries/sec)")
+    print(f"Block relay: {result['block_messages_per_second']:.0f} messages/sec, "
+          f"{result['block_bytes_on_wire'] / 1e6:.2f} MB on the wire")
+    print(f"Transactions: {result['transactions']} propagated in {result['tx_propagation_seconds']:.2f}s "
+          f"({result['tx_deliveries_per_second']:.0f} deliveries/sec, {result['tx_messages_per_second']:.0f} messages/sec)")
@@ -0,0 +1,108 @@
+# Reorg benchmark: disconnecting tip blocks with undo records vs rebuilding the chain state from genesis
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from libertydns.crypto.crypto import SignatureVerifier
+from libertydns.storage.database import UTXODatabase, CoinsCache, DomainIndex, BlockStore
+from libertydns.validation.block_validation import ValidationPipeline
+from libertydns.validation.reorg import ChainRollback
+from chaingen import generate_chain
+
+
+def connect(directory, chain, verifier, start_height=0, state=None):
+    """
+    Store and connect the blocks of `chain` from `start_height`, writing their
+    undo records, onto `state` (a fresh chain state in `directory` if None).
+
+    :return: Tuple of (BlockStore, CoinsCache, DomainIndex)
+    """
+    if state is None:
+        state = (BlockStore(os.path.join(directory, 'blocks')),
+                 CoinsCache(UTXODatabase(os.path.join(directory, 'coins'))),
+                 DomainIndex(os.path.join(directory, 'domains')))
+    store, coins, domains = state
+    for height, block in enumerate(chain, start_height):
+        store.append(block, height)
+    pipeline = ValidationPipeline(coins, domains, verifier=verifier, undo_store=store)
+    for height, block in enumerate(chain, start_height):
+        pipeline.submit(block.serialize(), height)
+    pipeline.flush()
+    coins.flush()
+    return state
+
+
+def replay(directory, chain, verifier):
+    """
+    Rebuild the coin set and domain index from genesis, as a node without undo
+    records has to: validate and connect every block again.
+
+    :return: Seconds taken
+    """
+    started = time.perf_counter()
+    coins = CoinsCache(UTXODatabase(os.path.join(directory, 'coins')))
+    pipeline = ValidationPipeline(coins, DomainIndex(os.path.join(directory, 'domains')), verifier=verifier)
+    for height, block in enumerate(chain):
+        pipeline.submit(block.serialize(), height)
+    pipeline.flush()
+    coins.flush()
+    return time.perf_counter() - started
+
+
+def run(blocks=200, txs_per_block=20, domain_mix=0.1, depths=(1, 6, 24, 96)):
+    """
+    Connect a synthetic chain, then for each depth roll the tip back with
+    ChainRollback and compare with what a node without undo records pays:
+    rebuilding the chain state from genesis up to the fork point. Depths that
+    leave less than two blocks are skipped.
+    """
+    chain = generate_chain(blocks, txs_per_block, domain_mix=domain_mix)
+    directory = tempfile.mkdtemp()
+    try:
+        with SignatureVerifier() as verifier:
+            state = connect(os.path.join(directory, 'node'), chain, verifier)
+            store = state[0]
+            undo_bytes = sum(len(store.get_undo(block.header_hash()).serialize()) for block in chain)
+            results = []
+            for depth in (depth for depth in depths if depth < len(chain) - 1):
+                fork = len(chain) - depth
+                rollback = ChainRollback(*state).rollback(depth)
+                replay_seconds = replay(os.path.join(directory, 'replay%d' % depth), chain[:fork], verifier)
+                results.append({'depth': depth, 'rollback': rollback.to_json(), 'replay_seconds': replay_seconds,
+                                'speedup': replay_seconds / rollback.elapsed})
+                # Reconnect the disconnected blocks for the next depth
+                connect(None, chain[fork:], verifier, fork, state)
+            store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'blocks': len(chain),
+        'transactions': sum(len(block.transactions) for block in chain),
+        'block_bytes': sum(len(block.serialize()) for block in chain),
+        'undo_bytes': undo_bytes,
+        'reorgs': results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll back the tip of a stored synthetic chain at several depths.")
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--domain-mix', type=float, default=0.1, help="Fraction of transactions that transfer a domain")
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.blocks, args.txs_per_block, args.domain_mix)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['blocks']} blocks, {results['transactions']} transactions, "
+              f"undo records {results['undo_bytes'] / 1e3:.1f} kB for {results['block_bytes'] / 1e3:.1f} kB of blocks")
+        for result in results['reorgs']:
+            rollback = result['rollback']
+            print(f"depth {result['depth']:>3}: rollback {rollback['elapsed_seconds'] * 1000:8.1f} ms "
+                  f"({rollback['coins_restored']} coins, {rollback['domains_restored']} domains restored), "
+                  f"replay from genesis {result['replay_seconds'] * 1000:8.1f} ms, {result['speedup']:.0f}x")
@@ -0,0 +1,80 @@
+# Wallet rescan benchmark: compact-filter rescan vs reading every block, for wallets of different sizes
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from libertydns.core.script import Script
+from libertydns.core.wallet_index import WalletIndex
+from libertydns.core.rescan import rescan
+from libertydns.storage.database import BlockStore
+from chaingen import generate_chain, make_wallets
+
+
+def full_rescan(wallet_index, store):
+    started = time.perf_counter()
+    relevant = 0
+    for height, block in store.iter_blocks():
+        relevant += bool(wallet_index.connect_block(block, height))
+    return {'blocks_read': height + 1, 'relevant': relevant, 'elapsed_seconds': time.perf_counter() - started}
+
+
+def run(blocks=200, txs_per_block=20, keys=256, wallet_sizes=(0, 1, 4, 16)):
+    """
+    Store a synthetic chain whose payments are spread over `keys` keys, then
+    rescan it for wallets holding the first n of those keys (0: a key the chain
+    never pays). The filter rescan should cost about the filter tests plus the
+    blocks relevant to the wallet, where the full rescan reads every block.
+    """
+    chain = generate_chain(blocks, txs_per_block, domain_mix=0.05, keys=keys)
+    wallets = make_wallets(max(wallet_sizes))
+    scripts = [Script.createP2PKH_ScriptPubKey(wallet.address_to_pubkey_hash(wallet.address)) for wallet in wallets]
+    unused = make_wallets(keys + 1)[-1]
+    directory = tempfile.mkdtemp()
+    try:
+        store = BlockStore(directory)
+        for height, block in enumerate(chain):
+            store.append(block, height)
+        filter_bytes = sum(len(store.get_filter(block.header_hash()).data) + 4 for block in chain)
+        results = []
+        for size in wallet_sizes:
+            wallet_scripts = scripts[:size] or [
+                Script.createP2PKH_ScriptPubKey(unused.address_to_pubkey_hash(unused.address))]
+            full = full_rescan(WalletIndex(wallet_scripts), store)
+            wallet_index = WalletIndex(wallet_scripts)
+            filtered = rescan(wallet_index, store).to_json()
+            results.append({'keys': size, 'full': full, 'filtered': filtered,
+                            'speedup': full['elapsed_seconds'] / filtered['elapsed_seconds']})
+        store.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'blocks': len(chain),
+        'transactions': sum(len(block.transactions) for block in chain),
+        'block_bytes': sum(len(block.serialize()) for block in chain),
+        'filter_bytes': filter_bytes,
+        'wallets': results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescan a stored synthetic chain for wallets of different sizes.")
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--keys', type=int, default=256, help="Keys the chain's payments are spread over")
+    parser.add_argument('--json', action='store_true', help="Print the raw results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.blocks, args.txs_per_block, args.keys)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['blocks']} blocks, {results['transactions']} transactions, "
+              f"filters {results['filter_bytes'] / 1e3:.1f} kB for {results['block_bytes'] / 1e3:.1f} kB of blocks")
+        for result in results['wallets']:
+            full, filtered = result['full'], result['filtered']
+            print(f"{result['keys']:>3} keys: full {full['elapsed_seconds'] * 1000:7.1f} ms ({full['blocks_read']} blocks read), "
+                  f"filtered {filtered['elapsed_seconds'] * 1000:7.1f} ms ({filtered['matched']} blocks read, "
+                  f"{filtered['relevant']} relevant, {filtered['false_positives']} false positives), "
+                  f"{result['speedup']:.1f}x")
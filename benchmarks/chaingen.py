@@ -0,0 +1,132 @@
+# Deterministic synthetic chain generator for benchmarks
+import argparse
+import random
+
+from libertydns.core.block import Block
+from libertydns.core.domain import FullDomain
+from libertydns.core.transaction import TransactionBuilder
+from libertydns.core.script import Script
+from libertydns.core.wallet import Wallet
+from libertydns.consensus.pow import bits_to_target, scan_nonces
+from libertydns.validation.block_validation import block_subsidy
+
+EASY_BITS = 0x207fffff  # About one hash in two meets the target
+FEE = 1000
+
+
+def make_wallets(keys):
+    wallets = []
+    for i in range(keys):
+        wallet = Wallet()
+        wallet.generate_keypair_from_string("bench-%d" % i)
+        wallets.append(wallet)
+    return wallets
+
+
+def generate_chain(blocks, txs_per_block=20, fan_in=2, domain_mix=0.0, keys=16, seed=0, bits=EASY_BITS, version=1):
+    """
+    A valid chain of `blocks` blocks after a genesis block, the same bytes for
+    the same arguments: keys come from fixed seed strings, signatures are
+    deterministic (RFC 6979) and every random choice comes from `seed`.
+
+    Each block holds a coinbase and up to `txs_per_block` transactions. A
+    fraction `domain_mix` of them are domain transfers; the others spend
+    `fan_in` earlier outputs of one key with P2PKH signatures and pay two
+    outputs. With a domain mix, every block also issues one domain in a domain
+    coinbase, so there are domains to transfer. Outputs and domains become
+    spendable in the block after the one that created them. Blocks and
+    transactions are of `version`, so 2 gives a chain in the v2 wire format.
+
+    :return: List of Blocks, genesis first
+    """
+    rng = random.Random(seed)
+    wallets = make_wallets(keys)
+    owners = [wallet.address_to_pubkey_hash(wallet.address) for wallet in wallets]
+    scripts = [Script.createP2PKH_ScriptPubKey(owner) for owner in owners]
+    target = bits_to_target(bits)
+    spendable = []  # (txid, output index, CoinOutput, wallet index)
+    domains = []  # (txid, output index, wallet index)
+    chain = []
+    previous_hash = b'\x00' * 32
+    for height in range(blocks + 1):
+        transactions = []
+        created = []
+        transferred = []
+        fees = 0
+        for _ in range(txs_per_block if height else 0):
+            if domains and rng.random() < domain_mix:
+                txid, index, owner = domains.pop(rng.randrange(len(domains)))
+                recipient = rng.randrange(keys)
+                tx = (TransactionBuilder(tx_type=2, version=version)
+                      .add_domain_input(txid, index, b'')
+                      .add_domain_output(owners[recipient])
+                      .build())
+                tx = wallets[owner].sign_transaction(tx, [])
+                transferred.append((tx.txid, 0, recipient))
+            elif spendable:
+                # All inputs of a transaction belong to one key, so one wallet signs them together
+                spender = spendable[rng.randrange(len(spendable))][3]
+                candidates = [i for i, item in enumerate(spendable) if item[3] == spender]
+                builder = TransactionBuilder(version=version)
+                spent = []
+                for position in sorted(rng.sample(candidates, min(fan_in, len(candidates))), reverse=True):
+                    txid, index, output, _ = spendable.pop(position)
+                    builder.add_coin_input(txid, index, b'')
+                    spent.append(output)
+                value = sum(output.value for output in spent) - FEE
+                recipients = [rng.randrange(keys) for _ in range(2)]
+                for recipient, amount in zip(recipients, (value // 2, value - value // 2)):
+                    builder.add_coin_output(amount, scripts[recipient])
+                tx = wallets[spender].sign_transaction(builder.build(), spent)
+                # Outputs too small to pay the fee are left unspent
+                created.extend((tx.txid, index, output, recipient)
+                               for index, (output, recipient) in enumerate(zip(tx.coin_outputs, recipients))
+                               if output.value > 2 * FEE)
+                fees += FEE
+            else:
+                break
+            transactions.append(tx)
+
+        owner = rng.randrange(keys)
+        coinbase = (TransactionBuilder(tx_type=0, version=version, lock_time=height)
+                    .add_coin_output(block_subsidy(height) + fees, scripts[owner]).build())
+        created.append((coinbase.txid, 0, coinbase.coin_outputs[0], owner))
+        header_transactions = [coinbase]
+        if domain_mix > 0:
+            ip = '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+            domain_owner = rng.randrange(keys)
+            domain_coinbase = (TransactionBuilder(tx_type=4, version=version, lock_time=height)
+                               .add_domain_issue_output(FullDomain("chain%d" % height, "dns", ip), owners[domain_owner])
+                               .build())
+            header_transactions.append(domain_coinbase)
+            transferred.append((domain_coinbase.txid, 0, domain_owner))
+        transactions[:0] = header_transactions
+
+        block = Block(version, previous_hash, Block.calculateMerkleRoot(transactions), 1700000000 + height * 60,
+                      bits, 0, transactions)
+        block.nonce = scan_nonces(block.serialize_header(), 0, 1 << 32, target, target)[0]
+        previous_hash = block.header_hash()
+        chain.append(block)
+        spendable.extend(created)
+        domains.extend(transferred)
+    return chain
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic chain as framed blocks.")
+    parser.add_argument('output', help="Path of the block file to write")
+    parser.add_argument('--blocks', type=int, default=100)
+    parser.add_argument('--txs-per-block', type=int, default=20)
+    parser.add_argument('--fan-in', type=int, default=2)
+    parser.add_argument('--domain-mix', type=float, default=0.1, help="Fraction of transactions that transfer a domain")
+    parser.add_argument('--keys', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--version', type=int, default=1, help="Block and transaction version (2: v2 wire format)")
+    args = parser.parse_args()
+
+    chain = generate_chain(args.blocks, args.txs_per_block, args.fan_in, args.domain_mix, args.keys, args.seed,
+                           version=args.version)
+    with open(args.output, 'wb') as f:
+        for block in chain:
+            f.write(block.frame())
+    print(f"Wrote {len(chain)} blocks, {sum(len(block.transactions) for block in chain)} transactions to {args.output}")
@@ -0,0 +1,415 @@
+# Benchmark suite: micro-benchmarks of the core codecs and crypto, compared against a stored baseline
+import argparse
+import copy
+import fnmatch
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from libertydns.core.block import Block
+from libertydns.core.transaction import Transaction
+from libertydns.core.domain import FullDomain
+from libertydns.core.script import (Script, SigHashCache, SignatureChecker, verify_script, eval_script,
+                                    cast_to_bool)
+from libertydns.core.wallet import Wallet
+from libertydns.validation.block_validation import parse_script_sig
+from chaingen import generate_chain
+from bench_domain_codec import random_domains
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+BENCHMARKS = {}  # Name -> function(data) returning (setup, run, operation count)
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+class Data:
+    """
+    Inputs shared by the benchmarks, built once from a deterministic synthetic
+    chain so every run measures the same bytes.
+    """
+    def __init__(self, blocks=20, txs_per_block=50, domains=5000):
+        self.chain = generate_chain(blocks, txs_per_block, fan_in=2, domain_mix=0.1)
+        self.raw_blocks = [block.serialize() for block in self.chain]
+        self.raw_blocks_v2 = [self._to_v2(block).serialize(offset_table=True) for block in self.chain]
+        self.raw_transactions = [tx.serialize() for block in self.chain for tx in block.transactions]
+        self.domains = random_domains(domains)
+        self.encoded_domains = [domain.serialize() for domain in self.domains]
+        self.inputs = self._inputs()
+        self.signatures = self._signatures()
+
+    @staticmethod
+    def _to_v2(block):
+        """
+        The block re-encoded as version 2 with version 2 transactions. The signatures no
+        longer match, which does not matter to the codec benchmarks that use it.
+        """
+        transactions = []
+        for tx in block.transactions:
+            builder = tx.to_builder()
+            builder.version = 2
+            transactions.append(builder.build())
+        return Block(2, block.previous_hash, Block.calculateMerkleRoot(transactions), block.timestamp,
+                     block.difficulty, block.nonce, transactions)
+
+    def _inputs(self):
+        """
+        (ScriptSig, spent ScriptPubKey, spent value, input index, SigHashCache) of every coin input in the chain.
+        """
+        outputs = {}
+        inputs = []
+        for block in self.chain:
+            for tx in block.transactions:
+                sighash_cache = SigHashCache(tx)
+                for index, coin_input in enumerate(tx.coin_inputs):
+                    spent = outputs[(coin_input.txid, coin_input.output_index)]
+                    inputs.append((coin_input.script_sig, spent.script_pub_key, spent.value, index, sighash_cache))
+                for index, output in enumerate(tx.coin_outputs):
+                    outputs[(tx.txid, index)] = output
+        return inputs
+
+    def _signatures(self):
+        """
+        (message hash, signature, public key) of every coin input in the chain.
+        """
+        signatures = []
+        for script_sig, script_pub_key, value, index, sighash_cache in self.inputs:
+            signature, public_key = parse_script_sig(script_sig)
+            signatures.append((sighash_cache.coin_input_hash(index, script_pub_key, value), signature, public_key))
+        return signatures
+
+
+@benchmark('transaction.serialize')
+def _transaction_serialize(data):
+    state = {}
+
+    def setup():
+        # Copies are rebuilt through the constructors, so nothing is cached yet
+        state['txs'] = copy.deepcopy([tx for block in data.chain for tx in block.transactions])
+
+    def run():
+        for tx in state['txs']:
+            tx.serialize()
+    return setup, run, len(data.raw_transactions)
+
+
+@benchmark('transaction.parse')
+def _transaction_parse(data):
+    def run():
+        for raw in data.raw_transactions:
+            Transaction.parse(raw)
+    return None, run, len(data.raw_transactions)
+
+
+@benchmark('transaction.txid')
+def _transaction_txid(data):
+    state = {}
+
+    def setup():
+        state['txs'] = copy.deepcopy([tx for block in data.chain for tx in block.transactions])
+        for tx in state['txs']:
+            tx.serialize()
+
+    def run():
+        for tx in state['txs']:
+            tx.txid
+    return setup, run, len(data.raw_transactions)
+
+
+@benchmark('block.serialize')
+def _block_serialize(data):
+    state = {}
+
+    def setup():
+        state['blocks'] = copy.deepcopy(data.chain)
+
+    def run():
+        for block in state['blocks']:
+            block.serialize()
+    return setup, run, len(data.raw_blocks)
+
+
+@benchmark('block.parse')
+def _block_parse(data):
+    def run():
+        for raw in data.raw_blocks:
+            Block.parse(raw)
+    return None, run, len(data.raw_blocks)
+
+
+@benchmark('block.parse_v2')
+def _block_parse_v2(data):
+    def run():
+        for raw in data.raw_blocks_v2:
+            Block.parse(raw)
+    return None, run, len(data.raw_blocks_v2)
+
+
+@benchmark('block.read_transaction')
+def _block_read_transaction(data):
+    # The last transaction of each block: a version 1 block is parsed up to it
+    def run():
+        for raw, block in zip(data.raw_blocks, data.chain):
+            Block.read_transaction(memoryview(raw), len(block.transactions) - 1)
+    return None, run, len(data.raw_blocks)
+
+
+@benchmark('block.read_transaction_v2')
+def _block_read_transaction_v2(data):
+    # The same through the offset table of version 2 blocks
+    def run():
+        for raw, block in zip(data.raw_blocks_v2, data.chain):
+            Block.read_transaction(memoryview(raw), len(block.transactions) - 1)
+    return None, run, len(data.raw_blocks_v2)
+
+
+@benchmark('block.merkle_proof_v2')
+def _block_merkle_proof_v2(data):
+    def run():
+        for raw in data.raw_blocks_v2:
+            Block.merkle_proof_from(memoryview(raw), 0)
+    return None, run, len(data.raw_blocks_v2)
+
+
+@benchmark('block.calculateMerkleRoot')
+def _merkle_root(data):
+    def run():
+        for block in data.chain:
+            Block.calculateMerkleRoot(block.transactions)
+    return None, run, len(data.chain)
+
+
+@benchmark('script.verify_signature')
+def _verify_signature(data):
+    script = Script(b'', b'')
+
+    def run():
+        for message_hash, signature, public_key in data.signatures:
+            if not script.verify_signature(message_hash, signature, public_key):
+                raise ValueError("Benchmark signature does not verify")
+    return None, run, len(data.signatures)
+
+
+@benchmark('script.verify_p2pkh')
+def _verify_p2pkh(data):
+    # Signature checks are deferred, so this times the template match, hashing and sighash only
+    def run():
+        jobs = []
+        for script_sig, script_pub_key, value, index, sighash_cache in data.inputs:
+            verify_script(script_sig, script_pub_key, SignatureChecker(sighash_cache, index, value, jobs=jobs))
+    return None, run, len(data.inputs)
+
+
+@benchmark('script.interpret_p2pkh')
+def _interpret_p2pkh(data):
+    # The same inputs through the generic interpreter loop, for comparison with the fast path
+    def run():
+        jobs = []
+        for script_sig, script_pub_key, value, index, sighash_cache in data.inputs:
+            checker = SignatureChecker(sighash_cache, index, value, jobs=jobs)
+            stack = []
+            eval_script(script_sig, stack, checker)
+            eval_script(script_pub_key, stack, checker)
+            if not cast_to_bool(stack[-1]):
+                raise ValueError("Benchmark script does not verify")
+    return None, run, len(data.inputs)
+
+
+@benchmark('wallet.generate_keypair')
+def _wallet_keygen(data):
+    seeds = ["bench-keygen-%d" % i for i in range(50)]
+
+    def run():
+        for seed in seeds:
+            Wallet().generate_keypair_from_string(seed)
+    return None, run, len(seeds)
+
+
+@benchmark('wallet.public_key_to_address')
+def _wallet_address(data):
+    wallet = Wallet()
+    public_keys = []
+    for i in range(200):
+        public_keys.append(wallet.generate_keypair_from_string("bench-address-%d" % i)[1])
+
+    def run():
+        for public_key in public_keys:
+            wallet.public_key_to_address(public_key)
+    return None, run, len(public_keys)
+
+
+@benchmark('domain.serialize')
+def _domain_serialize(data):
+    def run():
+        for domain in data.domains:
+            domain.serialize()
+    return None, run, len(data.domains)
+
+
+@benchmark('domain.parse')
+def _domain_parse(data):
+    def run():
+        for encoded in data.encoded_domains:
+            FullDomain.parse(encoded)
+    return None, run, len(data.encoded_domains)
+
+
+@benchmark('domain.encode_many')
+def _domain_encode_many(data):
+    return None, lambda: FullDomain.encode_many(data.domains), len(data.domains)
+
+
+@benchmark('domain.decode_many')
+def _domain_decode_many(data):
+    encoded = b''.join(data.encoded_domains)
+    return None, lambda: FullDomain.decode_many(encoded), len(data.domains)
+
+
+def measure(setup, run, repeat, loops=1):
+    """
+    Like timeit, the garbage collector is paused while timing, so a collection
+    triggered by an earlier benchmark's garbage is not charged to this one.
+
+    :return: List of the wall times of `repeat` samples of `loops` runs each, `setup` excluded
+    """
+    times = []
+    for _ in range(repeat):
+        elapsed = 0.0
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(loops):
+                if setup is not None:
+                    setup()
+                started = time.perf_counter()
+                run()
+                elapsed += time.perf_counter() - started
+        finally:
+            gc.enable()
+        times.append(elapsed / loops)
+    return times
+
+
+def run_suite(patterns=None, repeat=7, min_time=0.1, data=None):
+    """
+    Run every benchmark whose name matches one of the glob `patterns` (all if None).
+    Each sample loops over the benchmark for at least `min_time` seconds, so
+    short benchmarks are not dominated by timer and scheduling noise; those
+    that need a fresh setup before every run take one run per sample instead.
+    Samples are taken round-robin across the benchmarks, so a burst of load on
+    the machine slows one sample of each rather than every sample of one.
+
+    :return: JSON-compatible dictionary of the environment and per-benchmark results
+    """
+    if data is None:
+        data = Data()
+    cases = {}
+    for name, factory in BENCHMARKS.items():
+        if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        setup, run, operations = factory(data)
+        warmup = measure(setup, run, 1)[0]  # Also warms up caches and lazy imports
+        loops = 1 if setup is not None else max(1, int(min_time / max(warmup, 1e-9)))
+        cases[name] = (setup, run, operations, loops, [])
+    for _ in range(repeat):
+        for setup, run, _, loops, times in cases.values():
+            times.extend(measure(setup, run, 1, loops))
+    results = {}
+    for name, (_, _, operations, loops, times) in cases.items():
+        results[name] = {
+            'operations': operations,
+            'repeat': repeat,
+            'loops': loops,
+            'best_us_per_op': min(times) / operations * 1e6,
+            'median_us_per_op': statistics.median(times) / operations * 1e6
+        }
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    Compare best times per operation against a baseline run.
+
+    :return: List of (name, baseline us/op, current us/op, ratio, regressed) for every current
+             benchmark; baseline us/op and ratio are None for those missing from the baseline
+    """
+    rows = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            rows.append((name, None, result['best_us_per_op'], None, False))
+            continue
+        ratio = result['best_us_per_op'] / previous['best_us_per_op']
+        rows.append((name, previous['best_us_per_op'], result['best_us_per_op'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite and compare it against a stored baseline.")
+    parser.add_argument('patterns', nargs='*', help="Only run benchmarks matching these glob patterns, e.g. 'block.*'")
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.1, help="Minimum seconds per sample")
+    parser.add_argument('--output', help="Write the results as JSON to this file ('-' for stdout)")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Slowdown over the baseline reported as a regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    current = run_suite(args.patterns, args.repeat, args.min_time)
+    if args.output == '-':
+        print(json.dumps(current, indent=2))
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    regressions = []
+    missing = []  # Benchmarks without a baseline entry
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['python'] != current['python']:
+            print(f"Note: baseline was recorded with Python {baseline['python']}", file=sys.stderr)
+        for name, before, after, ratio, regressed in compare(current, baseline, args.threshold):
+            if before is None:
+                print(f"{name:<32} {'':>10}    {after:10.2f} us/op  no baseline", file=sys.stderr)
+                missing.append(name)
+                continue
+            marker = "  REGRESSION" if regressed else ""
+            print(f"{name:<32} {before:10.2f} -> {after:10.2f} us/op  {ratio - 1:+7.1%}{marker}", file=sys.stderr)
+            if regressed:
+                regressions.append(name)
+    else:
+        for name, result in current['results'].items():
+            print(f"{name:<32} {result['best_us_per_op']:10.2f} us/op", file=sys.stderr)
+
+    if args.save_baseline:
+        if args.patterns and os.path.exists(args.baseline):
+            # A partial run only replaces the entries it measured
+            with open(args.baseline) as f:
+                stored = json.load(f)
+            stored['results'].update(current['results'])
+            current = dict(current, results=stored['results'])
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2)
+            f.write('\n')
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+    if missing:
+        print(f"{len(missing)} benchmark(s) have no baseline: {', '.join(missing)}", file=sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
@@ -1 +1,32 @@
- 
+# Packaging: the modules under src/ are installed as the `libertydns` package
+from setuptools import setup
+
+setup(
+    name='libertydns',
+    version='0.1.0',
+    description='LibertyDNS: Decentralized Domain Freedom',
+    python_requires='>=3.9',
+    package_dir={'libertydns': 'src'},
+    packages=[
+        'libertydns',
+        'libertydns.api',
+        'libertydns.consensus',
+        'libertydns.core',
+        'libertydns.crypto',
+        'libertydns.dns',
+        'libertydns.network',
+        'libertydns.storage',
+        'libertydns.utils',
+        'libertydns.validation'
+    ],
+    install_requires=[
+        'ecdsa>=0.18',
+        'base58>=2.1',
+        'structlog>=23.1',
+        'pyrocksdb>=0.9',
+        'numpy>=1.22'
+    ],
+    entry_points={
+        'console_scripts': ['libertydns=libertydns.api.cli:main']
+    }
+)
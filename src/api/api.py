@@ -1 +1,432 @@
-# API endpoints 
+# API endpoints: JSON-RPC 2.0 over HTTP for blocks, transactions and domains
+import asyncio
+import inspect
+import json
+import struct
+from collections import OrderedDict
+
+from ..core.transaction import Transaction
+from ..utils import metrics
+from .encoding import dumps, transaction_json, iter_block_json
+
+# JSON-RPC 2.0 error codes, plus application codes as used by Bitcoin Core
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+NOT_FOUND = -5
+DESERIALIZATION_ERROR = -22
+REJECTED = -26
+
+MAX_BODY_SIZE = 4 * 1024 * 1024
+MAX_BATCH_SIZE = 1000
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+STREAM_THRESHOLD = 256 * 1024  # Blocks larger than this (serialized) are streamed, not cached
+STREAM_CHUNK_SIZE = 64 * 1024
+
+log = metrics.get_logger('api')
+
+
+class RPCError(ValueError):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def _parse_hash(value, name='hash'):
+    if not isinstance(value, str) or len(value) != 64:
+        raise RPCError(INVALID_PARAMS, "%s must be 64 hex digits" % name)
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        raise RPCError(INVALID_PARAMS, "%s must be 64 hex digits" % name)
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded JSON results for immutable objects (blocks by hash,
+    confirmed transactions by txid), bounded by the total size of the encodings.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Key -> encoded bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        encoded = self.entries.get(key)
+        if encoded is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return encoded
+
+    def put(self, key, encoded):
+        if len(encoded) > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[key] = encoded
+        self.size += len(encoded)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, key):
+        encoded = self.entries.pop(key, None)
+        if encoded is not None:
+            self.size -= len(encoded)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def to_json(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+class APIServer:
+    """
+    JSON-RPC 2.0 over HTTP/1.1 (POST, persistent connections) serving the
+    stored chain:
+
+    - getblockcount, getblockhash(height)
+    - getblock(hash), getblockbyheight(height)
+    - gettransaction(txid): stored transactions, then the mempool
+    - resolvedomain(name): the domain's record, e.g. resolvedomain("example.dns")
+    - sendrawtransaction(hex): submitted to the node (and its mempool) or to the mempool
+
+    Batch requests are answered with one array. Block and transaction results
+    never change once stored, so their encodings are cached by hash and a
+    repeated query is a dictionary lookup. Blocks over `stream_threshold`
+    bytes are not cached; they are encoded and sent a transaction at a time
+    with chunked transfer encoding, so a client never waits for, and the
+    server never holds, the whole encoded block. Only a reorg invalidates
+    them: register block_disconnected with ChainRollback.add_listener.
+
+    :param store: Block source with best_height, get_hash_at_height(), get_location(),
+                  get_block(), get_transaction() and get_merkle_proof(), e.g. BlockStore.
+    :param domains: Optional DomainIndex for resolvedomain.
+    :param mempool: Optional Mempool, for gettransaction of unconfirmed transactions and
+                    sendrawtransaction when there is no node.
+    :param node: Optional Node that relays submitted transactions.
+    """
+    def __init__(self, store, domains=None, mempool=None, node=None, cache_bytes=DEFAULT_CACHE_BYTES,
+                 stream_threshold=STREAM_THRESHOLD):
+        self.store = store
+        self.domains = domains
+        self.mempool = mempool if mempool is not None or node is None else node.mempool
+        self.node = node
+        self.cache = ResponseCache(cache_bytes)
+        self.stream_threshold = stream_threshold
+        self.server = None
+        self._connections = {}  # Handler task -> StreamWriter of each open connection
+        self.methods = {
+            'getblockcount': self.getblockcount,
+            'getblockhash': self.getblockhash,
+            'getblock': self.getblock,
+            'getblockbyheight': self.getblockbyheight,
+            'gettransaction': self.gettransaction,
+            'gettxproof': self.gettxproof,
+            'resolvedomain': self.resolvedomain,
+            'sendrawtransaction': self.sendrawtransaction
+        }
+        self._signatures = {name: inspect.signature(method) for name, method in self.methods.items()}
+
+    def block_disconnected(self, block_hash, block):
+        """
+        Drop the cached results a disconnected block invalidates: the block
+        itself and its transactions and their Merkle proofs, which are no longer
+        confirmed.
+        """
+        self.cache.discard(('block', block_hash))
+        for tx in block.transactions:
+            self.cache.discard(('tx', tx.txid))
+            self.cache.discard(('proof', tx.txid))
+
+    # Methods: each returns the encoded result, or an iterator of its chunks to stream
+
+    def getblockcount(self):
+        return dumps(self.store.best_height + 1)
+
+    def getblockhash(self, height):
+        return dumps(self._hash_at_height(height).hex())
+
+    def _hash_at_height(self, height):
+        if not isinstance(height, int) or isinstance(height, bool) or height < 0:
+            raise RPCError(INVALID_PARAMS, "height must be a non-negative integer")
+        block_hash = self.store.get_hash_at_height(height)
+        if block_hash is None:
+            raise RPCError(NOT_FOUND, "No block at height %d" % height)
+        return block_hash
+
+    def getblock(self, hash):
+        block_hash = _parse_hash(hash)
+        key = ('block', block_hash)
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            metrics.inc('rpc_cache_hits_total')
+            return encoded
+        location = self.store.get_location(block_hash)
+        if location is None:
+            raise RPCError(NOT_FOUND, "Block %s not found" % hash)
+        block = self.store.get_block(block_hash)
+        chunks = iter_block_json(block, block_hash, location.height, location.length)
+        if location.length > self.stream_threshold:
+            return chunks
+        encoded = b''.join(chunks)
+        self.cache.put(key, encoded)
+        return encoded
+
+    def getblockbyheight(self, height):
+        return self.getblock(self._hash_at_height(height).hex())
+
+    def gettransaction(self, txid):
+        tx_hash = _parse_hash(txid, 'txid')
+        key = ('tx', tx_hash)
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            metrics.inc('rpc_cache_hits_total')
+            return encoded
+        stored = self.store.get_transaction(tx_hash)
+        if stored is not None:
+            tx, block_hash, location = stored
+            result = transaction_json(tx)
+            result.update(block_hash=block_hash.hex(), height=location.height)
+            encoded = dumps(result)
+            self.cache.put(key, encoded)
+            return encoded
+        entry = self.mempool.get_entry(tx_hash) if self.mempool is not None else None
+        if entry is None:
+            raise RPCError(NOT_FOUND, "Transaction %s not found" % txid)
+        result = transaction_json(entry.tx)
+        result.update(block_hash=None, height=None, fee=entry.fee)
+        return dumps(result)  # Not cached: it changes once confirmed
+
+    def gettxproof(self, txid):
+        """
+        Merkle proof that a confirmed transaction is in its block. The proof is built
+        from the stored block's transaction hashes without decoding the block.
+        """
+        tx_hash = _parse_hash(txid, 'txid')
+        key = ('proof', tx_hash)
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            metrics.inc('rpc_cache_hits_total')
+            return encoded
+        stored = self.store.get_merkle_proof(tx_hash)
+        if stored is None:
+            raise RPCError(NOT_FOUND, "Transaction %s not found in a block" % txid)
+        proof, block_hash, location = stored
+        result = proof.to_json()
+        result.update(block_hash=block_hash.hex(), height=location.height, merkle_root=proof.compute_root().hex())
+        encoded = dumps(result)
+        self.cache.put(key, encoded)
+        return encoded
+
+    def resolvedomain(self, name):
+        if self.domains is None:
+            raise RPCError(METHOD_NOT_FOUND, "Domain index is not available")
+        domain_name, _, tld = name.rstrip('.').rpartition('.') if isinstance(name, str) else ('', '', '')
+        if not domain_name or not tld:
+            raise RPCError(INVALID_PARAMS, "name must be a full domain such as example.dns")
+        record = self.domains.get(domain_name, tld)
+        if record is None:
+            raise RPCError(NOT_FOUND, "Domain %s not found" % name)
+        return dumps(record.to_json())
+
+    def sendrawtransaction(self, hex):
+        try:
+            tx = Transaction.parse(bytes.fromhex(hex))
+        except (ValueError, TypeError, IndexError, struct.error) as e:
+            raise RPCError(DESERIALIZATION_ERROR, "Transaction decode failed: %s" % e)
+        try:
+            if self.node is not None:
+                self.node.accept_transaction(tx)
+            elif self.mempool is not None:
+                self.mempool.add(tx)
+            else:
+                raise RPCError(METHOD_NOT_FOUND, "No node or mempool to submit to")
+        except RPCError:
+            raise
+        except ValueError as e:
+            raise RPCError(REJECTED, str(e))
+        return dumps(tx.txid.hex())
+
+    # JSON-RPC
+
+    def _call(self, request):
+        """
+        Run one request object.
+
+        :return: Tuple of (id, encoded result or chunk iterator, None) or (id, None, error dict);
+                 id is Ellipsis for notifications, which get no response.
+        """
+        if not isinstance(request, dict) or request.get('jsonrpc') != '2.0' or not isinstance(request.get('method'), str):
+            return None, None, {'code': INVALID_REQUEST, 'message': "Invalid request"}
+        request_id = request.get('id', Ellipsis)
+        name = request['method']
+        params = request.get('params', [])
+        method = self.methods.get(name)
+        if method is None:
+            return request_id, None, {'code': METHOD_NOT_FOUND, 'message': "Method %s not found" % name}
+        try:
+            if isinstance(params, list):
+                self._signatures[name].bind(*params)
+                args, kwargs = params, {}
+            elif isinstance(params, dict):
+                self._signatures[name].bind(**params)
+                args, kwargs = (), params
+            else:
+                raise TypeError("params must be an array or an object")
+        except TypeError as e:
+            return request_id, None, {'code': INVALID_PARAMS, 'message': str(e)}
+        metrics.inc('rpc_requests_total', method=name)
+        try:
+            with metrics.span('rpc_call', method=name):
+                return request_id, method(*args, **kwargs), None
+        except RPCError as e:
+            error = {'code': e.code, 'message': str(e)}
+        except Exception as e:
+            log.error('rpc_failed', method=name, error=repr(e))
+            error = {'code': INTERNAL_ERROR, 'message': "Internal error"}
+        metrics.inc('rpc_errors_total', method=name)
+        return request_id, None, error
+
+    @staticmethod
+    def _response(request_id, result, error):
+        """
+        :return: List of the response's chunks (bytes, or an iterator of bytes for a streamed result)
+        """
+        prefix = b'{"jsonrpc":"2.0","id":' + dumps(None if request_id is Ellipsis else request_id)
+        if error is not None:
+            return [prefix + b',"error":' + dumps(error) + b'}']
+        if isinstance(result, bytes):
+            return [prefix + b',"result":' + result + b'}']
+        return [prefix + b',"result":', result, b'}']
+
+    def handle(self, body):
+        """
+        Answer an HTTP request body holding one JSON-RPC request or a batch.
+
+        :return: List of chunks (bytes, or iterators of bytes to stream); empty if
+                 there is nothing to answer (only notifications).
+        """
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return self._response(None, None, {'code': PARSE_ERROR, 'message': "Parse error"})
+        if not isinstance(request, list):
+            request_id, result, error = self._call(request)
+            return self._response(request_id, result, error) if request_id is not Ellipsis else []
+        if not request or len(request) > MAX_BATCH_SIZE:
+            return self._response(None, None, {'code': INVALID_REQUEST, 'message': "Invalid batch size"})
+        chunks = []
+        for item in request:
+            request_id, result, error = self._call(item)
+            if request_id is Ellipsis:
+                continue
+            chunks.append(b',' if chunks else b'[')
+            chunks.extend(self._response(request_id, result, error))
+        if chunks:
+            chunks.append(b']')
+        return chunks
+
+    # HTTP
+
+    async def _write(self, writer, status, chunks, keep_alive):
+        connection = b'keep-alive' if keep_alive else b'close'
+        if all(isinstance(chunk, bytes) for chunk in chunks):
+            body = b''.join(chunks)
+            writer.write(b'HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                         b'Connection: %s\r\n\r\n%s' % (status, len(body), connection, body))
+            await writer.drain()
+            return
+        writer.write(b'HTTP/1.1 %s\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n'
+                     b'Connection: %s\r\n\r\n' % (status, connection))
+        pending = []
+        pending_size = 0
+        for chunk in chunks:
+            for part in ((chunk,) if isinstance(chunk, bytes) else chunk):
+                pending.append(part)
+                pending_size += len(part)
+                if pending_size >= STREAM_CHUNK_SIZE:
+                    writer.write(b'%x\r\n%s\r\n' % (pending_size, b''.join(pending)))
+                    pending, pending_size = [], 0
+                    await writer.drain()  # Waits while the client is slower than the encoder
+        if pending_size:
+            writer.write(b'%x\r\n%s\r\n' % (pending_size, b''.join(pending)))
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.partition(b':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.split()
+                if len(parts) != 3:
+                    break
+                method, _, version = parts
+                keep_alive = (headers.get(b'connection', b'').lower() != b'close' if version == b'HTTP/1.1'
+                              else headers.get(b'connection', b'').lower() == b'keep-alive')
+                try:
+                    length = int(headers.get(b'content-length', b'0'))
+                except ValueError:
+                    length = -1
+                if method != b'POST':
+                    await self._write(writer, b'405 Method Not Allowed', [b'{"error":"POST JSON-RPC requests"}'], False)
+                    break
+                if length < 0 or length > MAX_BODY_SIZE:
+                    await self._write(writer, b'413 Payload Too Large', [b'{"error":"Request too large"}'], False)
+                    break
+                body = await reader.readexactly(length)
+                chunks = self.handle(body)
+                if chunks:
+                    await self._write(writer, b'200 OK', chunks, keep_alive)
+                else:
+                    writer.write(b'HTTP/1.1 204 No Content\r\nConnection: %s\r\n\r\n'
+                                 % (b'keep-alive' if keep_alive else b'close'))
+                    await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8332):
+        """
+        Start listening; port 0 picks a free port (see `port`).
+        """
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            # Idle keep-alive connections end their handlers by reading EOF, rather than being cancelled
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
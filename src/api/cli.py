@@ -1 +1,175 @@
-# Command-line interface 
+# Command-line interface: wallet keys, chain inspection and domain lookups against a node's data directory
+import argparse
+import json
+import os
+import sys
+
+# Only argparse, json and os are imported up front. Each command imports the
+# modules it needs when it runs, so `libertydns --help` or a lookup never pays
+# for the node, the signature engine or the RPC server.
+
+DATA_DIR_ENV = 'LIBERTYDNS_DATA_DIR'
+BLOCKS_DIR = 'blocks'
+DOMAINS_DIR = 'domains'
+
+
+def default_data_dir():
+    return os.environ.get(DATA_DIR_ENV) or os.path.join(os.path.expanduser('~'), '.libertydns')
+
+
+def _print_json(value):
+    print(json.dumps(value, indent=2))
+
+
+def _open_store(args):
+    from ..storage.database import BlockStore
+    directory = os.path.join(args.data_dir, BLOCKS_DIR)
+    if not os.path.isdir(directory):
+        raise ValueError("No block store in %s" % directory)
+    return BlockStore(directory, read_only=True)
+
+
+def _parse_hash(value, name):
+    try:
+        data = bytes.fromhex(value)
+    except ValueError:
+        data = b''
+    if len(data) != 32:
+        raise ValueError("%s must be 64 hex digits" % name)
+    return data
+
+
+# Wallet
+
+def wallet_new(args):
+    from ..core.wallet import Wallet
+    wallet = Wallet()
+    wallet.generate_random_keypair()
+    _print_json(wallet.to_json())
+
+
+def wallet_address(args):
+    from ..core.wallet import Wallet
+    wallet = Wallet()
+    wallet.generate_keypair_from_string(args.seed)
+    result = wallet.to_json()
+    if not args.show_private:
+        del result['private_key']
+    result['pub_key_hash'] = wallet.address_to_pubkey_hash(wallet.address).hex()
+    _print_json(result)
+
+
+# Chain
+
+def chain_info(args):
+    store = _open_store(args)
+    try:
+        best_hash = store.get_hash_at_height(store.best_height) if store.best_height >= 0 else None
+        _print_json({
+            'blocks': store.best_height + 1,
+            'best_height': store.best_height,
+            'best_block_hash': best_hash.hex() if best_hash is not None else None
+        })
+    finally:
+        store.close()
+
+
+def chain_block(args):
+    from .encoding import iter_block_json
+    store = _open_store(args)
+    try:
+        if args.block.isdigit():
+            block_hash = store.get_hash_at_height(int(args.block))
+            if block_hash is None:
+                raise ValueError("No block at height %s" % args.block)
+        else:
+            block_hash = _parse_hash(args.block, 'Block hash')
+        location = store.get_location(block_hash)
+        if location is None:
+            raise ValueError("Block %s not found" % block_hash.hex())
+        block = store.get_block(block_hash)
+        encoded = b''.join(iter_block_json(block, block_hash, location.height, location.length))
+        _print_json(json.loads(encoded))
+    finally:
+        store.close()
+
+
+def chain_tx(args):
+    from .encoding import transaction_json
+    store = _open_store(args)
+    try:
+        stored = store.get_transaction(_parse_hash(args.txid, 'txid'))
+        if stored is None:
+            raise ValueError("Transaction %s not found" % args.txid)
+        tx, block_hash, location = stored
+        result = transaction_json(tx)
+        result.update(block_hash=block_hash.hex(), height=location.height)
+        _print_json(result)
+    finally:
+        store.close()
+
+
+# Domains
+
+def domain_lookup(args):
+    from ..storage.database import DomainIndex
+    domain_name, _, tld = args.domain.partition('.')
+    if not domain_name or not tld:
+        raise ValueError("Domain must be of the form name.tld")
+    directory = os.path.join(args.data_dir, DOMAINS_DIR)
+    if not os.path.isdir(directory):
+        raise ValueError("No domain index in %s" % directory)
+    domains = DomainIndex(directory, cache_size=0, read_only=True)
+    record = domains.get(domain_name, tld)
+    if record is None:
+        raise ValueError("Domain %s is not registered" % args.domain)
+    result = record.to_json()
+    result['ip_address'] = record.full_domain.get_ip_address()
+    _print_json(result)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='libertydns', description="LibertyDNS wallet, chain and domain tools.")
+    parser.add_argument('--data-dir', default=default_data_dir(),
+                        help="Node data directory (default: $%s or ~/.libertydns)" % DATA_DIR_ENV)
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    wallet = commands.add_parser('wallet', help="Create keys and addresses").add_subparsers(dest='action', metavar='action')
+    wallet.required = True
+    wallet.add_parser('new', help="Generate a random keypair").set_defaults(handler=wallet_new)
+    address = wallet.add_parser('address', help="Derive the keypair and address of a seed string")
+    address.add_argument('seed')
+    address.add_argument('--show-private', action='store_true', help="Include the private key in the output")
+    address.set_defaults(handler=wallet_address)
+
+    chain = commands.add_parser('chain', help="Inspect the stored chain").add_subparsers(dest='action', metavar='action')
+    chain.required = True
+    chain.add_parser('info', help="Height and hash of the best stored block").set_defaults(handler=chain_info)
+    block = chain.add_parser('block', help="Show a block by hash or height")
+    block.add_argument('block', help="Block hash (hex) or height")
+    block.set_defaults(handler=chain_block)
+    tx = chain.add_parser('tx', help="Show a confirmed transaction")
+    tx.add_argument('txid')
+    tx.set_defaults(handler=chain_tx)
+
+    domain = commands.add_parser('domain', help="Query registered domains").add_subparsers(dest='action', metavar='action')
+    domain.required = True
+    lookup = domain.add_parser('lookup', help="Show the owner and address of a domain")
+    lookup.add_argument('domain', help="Domain name with its TLD, e.g. example.com")
+    lookup.set_defaults(handler=domain_lookup)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.handler(args)
+    except ValueError as e:
+        print("error: %s" % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,35 @@
+# JSON encodings of blocks and transactions, shared by the JSON-RPC server and the command-line tools
+import json
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def transaction_json(tx):
+    result = {'txid': tx.txid.hex()}
+    result.update(tx.to_json())
+    return result
+
+
+def iter_block_json(block, block_hash, height, size):
+    """
+    Encode a block as JSON a transaction at a time, so a large block can be
+    written to the client as it is encoded rather than built as one string.
+    """
+    header = {
+        'hash': block_hash.hex(),
+        'height': height,
+        'size': size,
+        'version': block.version,
+        'previous_hash': block.previous_hash.hex(),
+        'merkle_root': block.merkle_root.hex(),
+        'timestamp': block.timestamp,
+        'difficulty': block.difficulty,
+        'nonce': block.nonce
+    }
+    yield dumps(header)[:-1] + b',"transactions":['
+    for index, tx in enumerate(block.transactions):
+        encoded = dumps(transaction_json(tx))
+        yield b',' + encoded if index else encoded
+    yield b']}'
@@ -1 +1,203 @@
-# Proof of Work implementation 
+# Proof of Work implementation
+import argparse
+import hashlib
+import multiprocessing
+import os
+import queue
+import struct
+import time
+
+from ..core.block import Block, BLOCK_HEADER_SIZE
+
+NONCE_OFFSET = BLOCK_HEADER_SIZE - 4  # Nonce is the last field of the header
+TIMESTAMP_OFFSET = BLOCK_HEADER_SIZE - 12  # Timestamp (4 bytes), Difficulty (4 bytes), Nonce (4 bytes)
+NONCE_SPACE = 1 << 32
+
+
+def bits_to_target(bits):
+    """
+    Expand a compact difficulty (e.g. 0x1d00ffff) into the 256-bit target.
+    """
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def target_to_bits(target):
+    """
+    Encode a 256-bit target in compact form.
+    """
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    if mantissa & 0x00800000:  # Keep the sign bit clear
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+def scan_nonces(header, start, end, target, share_target):
+    """
+    Hash the header for every nonce in [start, end). The SHA-256 state of the
+    first 76 header bytes is computed once and copied for each nonce, so only
+    the 4 nonce bytes are hashed per attempt.
+
+    :return: Tuple of (winning nonce or None, hash of the winner or None, shares found)
+    """
+    target_bin = target.to_bytes(32, 'big')
+    share_target_bin = share_target.to_bytes(32, 'big')
+    midstate = hashlib.sha256(header[:NONCE_OFFSET])
+    pack = struct.Struct('>I').pack
+    shares = 0
+    for nonce in range(start, end):
+        h = midstate.copy()
+        h.update(pack(nonce))
+        digest = h.digest()
+        if digest <= share_target_bin:
+            shares += 1
+            if digest <= target_bin:
+                return nonce, digest, shares
+    return None, None, shares
+
+
+def _mine_worker(header, worker_index, worker_count, target, share_target, batch_size, stop, results):
+    """
+    Worker process: scans its slice of the nonce space, rolling the timestamp
+    forward once the slice is exhausted. Progress is reported after every batch.
+    """
+    shard = NONCE_SPACE // worker_count
+    first = worker_index * shard
+    last = NONCE_SPACE if worker_index == worker_count - 1 else first + shard
+    header = bytearray(header)
+    timestamp = struct.unpack_from('>I', header, TIMESTAMP_OFFSET)[0]
+    while not stop.is_set():
+        for start in range(first, last, batch_size):
+            end = min(start + batch_size, last)
+            nonce, digest, shares = scan_nonces(bytes(header), start, end, target, share_target)
+            if nonce is not None:
+                results.put(('found', nonce - start + 1, shares, nonce, timestamp, digest))
+                return
+            results.put(('progress', end - start, shares))
+            if stop.is_set():
+                return
+        # Nonce space exhausted for this timestamp
+        timestamp += 1
+        struct.pack_into('>I', header, TIMESTAMP_OFFSET, timestamp)
+
+
+class MiningStats:
+    def __init__(self):
+        self.hashes = 0
+        self.shares = 0
+        self.elapsed = 0.0
+        self.found = False
+
+    @property
+    def hashrate(self):
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+    def to_json(self):
+        return {
+            'hashes': self.hashes,
+            'shares': self.shares,
+            'elapsed_seconds': self.elapsed,
+            'hashrate': self.hashrate,
+            'time_to_block': self.elapsed if self.found else None
+        }
+
+
+class Miner:
+    """
+    Multi-process proof-of-work miner. The nonce space is split evenly between
+    worker processes; each rolls the timestamp forward when its slice runs out.
+    A share is any hash below the block target relaxed by `share_bits` bits.
+    """
+    def __init__(self, workers=None, batch_size=1 << 16, share_bits=8):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.share_bits = share_bits
+
+    def mine(self, block, max_seconds=None, target=None):
+        """
+        Search for a nonce (and timestamp) giving a header hash at or below the
+        block's target. On success the block's nonce and timestamp are updated.
+
+        :param block: Block whose header is mined.
+        :param max_seconds: Give up after this many seconds (None for no limit).
+        :param target: Override the target decoded from block.difficulty.
+        :return: MiningStats for the run.
+        """
+        if target is None:
+            target = bits_to_target(block.difficulty)
+        share_target = min((target << self.share_bits) | ((1 << self.share_bits) - 1), (1 << 256) - 1)
+        header = block.serialize_header()
+
+        ctx = multiprocessing.get_context()
+        stop = ctx.Event()
+        results = ctx.Queue()
+        processes = [ctx.Process(target=_mine_worker,
+                                 args=(header, i, self.workers, target, share_target,
+                                       self.batch_size, stop, results),
+                                 daemon=True)
+                     for i in range(self.workers)]
+
+        stats = MiningStats()
+        started = time.perf_counter()
+        for process in processes:
+            process.start()
+        try:
+            while True:
+                timeout = None
+                if max_seconds is not None:
+                    timeout = max_seconds - (time.perf_counter() - started)
+                    if timeout <= 0:
+                        break
+                try:
+                    message = results.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                stats.hashes += message[1]
+                stats.shares += message[2]
+                if message[0] == 'found':
+                    _, _, _, nonce, timestamp, _ = message
+                    block.nonce = nonce
+                    block.timestamp = timestamp
+                    stats.found = True
+                    break
+        finally:
+            stats.elapsed = time.perf_counter() - started
+            stop.set()
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+        return stats
+
+
+def meets_target(block):
+    """
+    Check a block's proof of work against its own difficulty.
+    """
+    return int.from_bytes(block.header_hash(), 'big') <= bits_to_target(block.difficulty)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mine a dummy header to measure header hashing throughput.")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--bits', type=lambda v: int(v, 0), default=0x1d00ffff,
+                        help="Compact difficulty to mine at")
+    args = parser.parse_args()
+
+    block = Block(1, b'\x00' * 32, b'\x00' * 32, int(time.time()), args.bits, 0, [])
+    miner = Miner(workers=args.workers)
+    stats = miner.mine(block, max_seconds=args.seconds)
+    print(f"Workers: {miner.workers}")
+    print(f"Hashrate: {stats.hashrate / 1e6:.3f} MH/s ({stats.hashes} hashes in {stats.elapsed:.2f}s)")
+    print(f"Shares found: {stats.shares}")
+    if stats.found:
+        print(f"Block found in {stats.elapsed:.2f}s: nonce={block.nonce} hash={block.header_hash().hex()}")
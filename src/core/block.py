@@ -1,7 +1,18 @@
 import json
+import mmap
+import os
 import struct
 import hashlib
-from transaction import *
+
+from .transaction import Transaction, CoinOutput, DOMAIN_OUTPUT_TYPES, WIRE_V2_VERSION, encode_varint, read_varint
+from ..crypto.merkle_tree import MerkleTree, hash_leaves
+from ..utils import metrics
+
+NETWORK_MAGIC = 0x4C444E53  # "LDNS"
+FRAME_HEADER_SIZE = 8  # Magic Number (4 bytes) + Block Size (4 bytes)
+BLOCK_HEADER_SIZE = 80  # version, previous_hash, merkle_root, timestamp, difficulty, nonce
+BLOCK_FLAG_OFFSET_TABLE = 0x01  # Version 2 blocks: an offset table follows the Transaction Count
+OFFSET_ENTRY = struct.Struct('>II')  # Offset table entry: Transaction Offset, Domain Offset
 
 class Block:
     def __init__(self, version, previous_hash, merkle_root, timestamp, difficulty, nonce, transactions):
@@ -13,40 +24,274 @@ class Block:
         self.nonce = nonce
         self.transactions = transactions
 
-    def serialize(self):
+    def serialize(self, offset_table=False):
+        """
+        Version 1 blocks are the header followed by the transactions back to back.
+        Version 2 blocks add Flags (1 byte), a Transaction Count (VarInt) and a
+        length prefix (VarInt) per transaction; with `offset_table` they also
+        carry the position of every transaction and of its domain section, so a
+        reader can seek to one without decoding the others.
+        """
+        if self.version < WIRE_V2_VERSION:
+            transactions_bin = b''.join(tx.serialize() for tx in self.transactions)
+            return self.serialize_header() + transactions_bin
+
+        encoded = [tx.serialize() for tx in self.transactions]
+        prefixes = [encode_varint(len(raw)) for raw in encoded]
+        count_bin = encode_varint(len(encoded))
+        table_bin = b''
+        if offset_table:
+            # Transaction Offset (4 bytes, from the start of the block to the length prefix),
+            # Domain Offset (4 bytes, from the start of the transaction, 0 without a domain section)
+            position = BLOCK_HEADER_SIZE + 1 + len(count_bin) + OFFSET_ENTRY.size * len(encoded)
+            entries = []
+            for tx, prefix, raw in zip(self.transactions, prefixes, encoded):
+                entries.append(OFFSET_ENTRY.pack(position, tx.domain_offset or 0))
+                position += len(prefix) + len(raw)
+            table_bin = b''.join(entries)
+        flags_bin = struct.pack('B', BLOCK_FLAG_OFFSET_TABLE if offset_table else 0)
+        transactions_bin = b''.join(prefix + raw for prefix, raw in zip(prefixes, encoded))
+        return self.serialize_header() + flags_bin + count_bin + table_bin + transactions_bin
+
+    def serialize_header(self):
+        """
+        Serialize the 80-byte block header (everything but the transactions).
+        """
         version_bin = struct.pack('>I', self.version)
         previous_hash_bin = self.previous_hash
         merkle_root_bin = self.merkle_root
         timestamp_bin = struct.pack('>I', self.timestamp)
         difficulty_bin = struct.pack('>I', self.difficulty)  # Changed from bits to difficulty
         nonce_bin = struct.pack('>I', self.nonce)
-        transactions_bin = b''.join(tx.serialize() for tx in self.transactions)
-        
-        return version_bin + previous_hash_bin + merkle_root_bin + timestamp_bin + difficulty_bin + nonce_bin + transactions_bin
+
+        return version_bin + previous_hash_bin + merkle_root_bin + timestamp_bin + difficulty_bin + nonce_bin
+
+    def header_hash(self):
+        """
+        Block hash: SHA-256 of the block header, as referenced by the next block's previous_hash.
+        """
+        return hashlib.sha256(self.serialize_header()).digest()
 
     @staticmethod
     def parse(data):
-        offset = 0
-        version = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-        previous_hash = data[offset:offset+32]
-        offset += 32
-        merkle_root = data[offset:offset+32]
-        offset += 32
-        timestamp = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-        difficulty = struct.unpack('>I', data[offset:offset+4])[0]  # Changed from bits to difficulty
-        offset += 4
-        nonce = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-
-        transactions = []
-        while offset < len(data):
-            tx = Transaction.parse(data[offset:])
-            transactions.append(tx)
-            offset += len(tx.serialize())
-        
-        return Block(version, previous_hash, merkle_root, timestamp, difficulty, nonce, transactions)
+        view = memoryview(data)
+        return Block.parse_from(view, 0, len(view))[0]
+
+    @staticmethod
+    @metrics.timed('block_parse')
+    def parse_from(view, offset=0, length=None):
+        """
+        Parse a block at `offset` of a memoryview with a single cursor. `length`
+        must be the size of the block (the rest of the buffer if None): version 1
+        transactions are read back to back until it has been consumed, and a
+        version 2 block has to end exactly after its last transaction. A version 2
+        offset table is checked against the transactions it points at.
+
+        :return: Tuple of (Block, number of bytes consumed)
+        """
+        start = offset
+        end = len(view) if length is None else offset + length
+        if end > len(view):
+            raise ValueError("Truncated block: need %d bytes, have %d" % (end, len(view)))
+
+        block = Block.parse_header(view, offset)
+        version = block.version
+        offset += BLOCK_HEADER_SIZE
+
+        transactions = block.transactions
+        if version < WIRE_V2_VERSION:
+            while offset < end:
+                tx, consumed = Transaction.parse_from(view, offset)
+                transactions.append(tx)
+                offset += consumed
+        else:
+            count, table, offset = Block._read_v2_layout(view, start, end)
+            for index in range(count):
+                tx_length, size = read_varint(view, offset)
+                tx, consumed = Transaction.parse_from(view, offset + size)
+                if consumed != tx_length:
+                    raise ValueError("Length prefix of transaction %d does not match its encoding" % index)
+                if table is not None and OFFSET_ENTRY.unpack_from(view, table + index * OFFSET_ENTRY.size) != (
+                        offset - start, tx.domain_offset or 0):
+                    raise ValueError("Offset table entry %d does not match its transaction" % index)
+                transactions.append(tx)
+                offset += size + consumed
+        if offset != end:
+            raise ValueError("Last transaction overruns the block boundary")
+
+        return block, offset - start
+
+    @staticmethod
+    def parse_header(view, offset=0):
+        """
+        Parse only the 80-byte header at `offset`, e.g. the header of a compact
+        block. The returned Block has no transactions.
+        """
+        if offset + BLOCK_HEADER_SIZE > len(view):
+            raise ValueError("Truncated block header: need %d bytes, have %d" % (offset + BLOCK_HEADER_SIZE, len(view)))
+        version = struct.unpack_from('>I', view, offset)[0]
+        previous_hash = bytes(view[offset+4:offset+36])
+        merkle_root = bytes(view[offset+36:offset+68])
+        timestamp, difficulty, nonce = struct.unpack_from('>III', view, offset+68)  # Changed from bits to difficulty
+        return Block(version, previous_hash, merkle_root, timestamp, difficulty, nonce, [])
+
+    @staticmethod
+    def _read_v2_layout(view, offset, end):
+        """
+        Read the Flags and Transaction Count of the version 2 block at `offset`.
+
+        :return: Tuple of (transaction count, position of the offset table or None, position of the first transaction)
+        """
+        position = offset + BLOCK_HEADER_SIZE
+        flags = struct.unpack_from('B', view, position)[0]
+        if flags & ~BLOCK_FLAG_OFFSET_TABLE:
+            raise ValueError("Unknown block flags 0x%02x" % flags)
+        count, size = read_varint(view, position + 1)
+        position += 1 + size
+        table = None
+        if flags & BLOCK_FLAG_OFFSET_TABLE:
+            table = position
+            position += count * OFFSET_ENTRY.size
+        if position > end:
+            raise ValueError("Truncated block: the offset table runs past the block")
+        return count, table, position
+
+    @staticmethod
+    def transaction_spans(view, offset=0, length=None, transactions=None):
+        """
+        Locate every transaction of a serialized block without building the
+        Block. A version 2 block is walked by its length prefixes, or read
+        straight from its offset table; a version 1 block has no lengths to
+        walk, so its transactions are parsed, unless the already parsed
+        `transactions` of the block are passed in.
+
+        :return: List of (offset, length) of each transaction's encoding, relative to `view`
+        """
+        end = len(view) if length is None else offset + length
+        position = offset + BLOCK_HEADER_SIZE
+        spans = []
+        if struct.unpack_from('>I', view, offset)[0] < WIRE_V2_VERSION:
+            if transactions is not None:
+                for tx in transactions:
+                    size = len(tx.serialize())
+                    spans.append((position, size))
+                    position += size
+            else:
+                while position < end:
+                    size = Transaction.parse_from(view, position)[1]
+                    spans.append((position, size))
+                    position += size
+        else:
+            count, table, position = Block._read_v2_layout(view, offset, end)
+            for index in range(count):
+                if table is not None:
+                    position = offset + OFFSET_ENTRY.unpack_from(view, table + index * OFFSET_ENTRY.size)[0]
+                tx_length, size = read_varint(view, position)
+                spans.append((position + size, tx_length))
+                position += size + tx_length
+        if spans and spans[-1][0] + spans[-1][1] > end:
+            raise ValueError("Last transaction overruns the block boundary")
+        return spans
+
+    @staticmethod
+    def read_transaction(view, index, offset=0, length=None):
+        """
+        Parse only transaction `index` of a serialized block. With an offset
+        table this is a single lookup; otherwise the transactions in front are
+        skipped by their length prefixes (or parsed, in a version 1 block).
+        """
+        end = len(view) if length is None else offset + length
+        if struct.unpack_from('>I', view, offset)[0] >= WIRE_V2_VERSION:
+            count, table, position = Block._read_v2_layout(view, offset, end)
+            if not 0 <= index < count:
+                raise ValueError("Transaction index %d out of range for %d transactions" % (index, count))
+            if table is not None:
+                position = offset + OFFSET_ENTRY.unpack_from(view, table + index * OFFSET_ENTRY.size)[0]
+                return Transaction.parse_from(view, position + read_varint(view, position)[1])[0]
+        spans = Block.transaction_spans(view, offset, length)
+        if not 0 <= index < len(spans):
+            raise ValueError("Transaction index %d out of range for %d transactions" % (index, len(spans)))
+        return Transaction.parse_from(view, spans[index][0])[0]
+
+    @staticmethod
+    def iter_domain_sections(view, offset=0, length=None):
+        """
+        Yield (index, txid, tx_type, domain_inputs, domain_outputs) for every
+        domain transaction of a serialized block. The transaction type is read
+        from each transaction's fixed header, so coin transactions are skipped
+        undecoded; with an offset table the coin inputs and outputs of domain
+        transactions are skipped as well.
+        """
+        end = len(view) if length is None else offset + length
+        table = None
+        if struct.unpack_from('>I', view, offset)[0] >= WIRE_V2_VERSION:
+            table = Block._read_v2_layout(view, offset, end)[1]
+        for index, (position, size) in enumerate(Block.transaction_spans(view, offset, length)):
+            version, tx_type = struct.unpack_from('>IB', view, position)
+            if tx_type not in DOMAIN_OUTPUT_TYPES:
+                continue
+            txid = hashlib.sha256(view[position:position+size]).digest()
+            if table is not None:
+                domain_offset = OFFSET_ENTRY.unpack_from(view, table + index * OFFSET_ENTRY.size)[1]
+                domain_inputs, domain_outputs, _ = Transaction.parse_domain_section(
+                    view, position + domain_offset, tx_type, version)
+            else:
+                tx = Transaction.parse_from(view, position)[0]
+                domain_inputs, domain_outputs = tx.domain_inputs, tx.domain_outputs
+            yield index, txid, tx_type, domain_inputs, domain_outputs
+
+    @staticmethod
+    def merkle_proof_from(view, index, offset=0, length=None):
+        """
+        Merkle proof for transaction `index` of a serialized block, built from the
+        hashes of the transaction encodings without parsing any of them (in a
+        version 2 block).
+        """
+        spans = Block.transaction_spans(view, offset, length)
+        if not 0 <= index < len(spans):
+            raise ValueError("Transaction index %d out of range for %d transactions" % (index, len(spans)))
+        leaves = hash_leaves(view[position:position+size] for position, size in spans)
+        return MerkleTree.from_leaves([leaves]).get_proof(index)
+
+    def frame(self, magic=NETWORK_MAGIC, offset_table=False):
+        """
+        Serialize the block with the Magic Number (4 bytes) and Block Size (4 bytes)
+        prefix described in PROTOCOL/BLOCKS/Blocks.txt.
+        """
+        block_bin = self.serialize(offset_table)
+        return struct.pack('>II', magic, len(block_bin)) + block_bin
+
+    @staticmethod
+    def iter_frames(data, magic=NETWORK_MAGIC):
+        """
+        Yield (Block, offset) for every framed block in a buffer of concatenated
+        blocks. The buffer is walked through one memoryview; nothing is copied
+        apart from the parsed field values themselves.
+        """
+        with memoryview(data) as view:
+            offset = 0
+            while offset < len(view):
+                if offset + FRAME_HEADER_SIZE > len(view):
+                    raise ValueError("Truncated frame header at offset %d" % offset)
+                frame_magic, size = struct.unpack_from('>II', view, offset)
+                if frame_magic != magic:
+                    raise ValueError("Bad magic number 0x%08x at offset %d" % (frame_magic, offset))
+                block, _ = Block.parse_from(view, offset + FRAME_HEADER_SIZE, size)
+                yield block, offset
+                offset += FRAME_HEADER_SIZE + size
+
+    @staticmethod
+    def iter_file(path, magic=NETWORK_MAGIC):
+        """
+        Yield every block of a file of concatenated framed blocks. The file is
+        memory mapped rather than read into Python bytes.
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for block, _ in Block.iter_frames(mapped, magic):
+                    yield block
 
     def to_json(self):
         return {
@@ -60,35 +305,19 @@ class Block:
         }
 
     @staticmethod
+    @metrics.timed('merkle_root')
     def calculateMerkleRoot(transactions):
         """
         Calculate the Merkle root of the transactions.
         """
-        if not transactions:
-            return b'\x00' * 32
-        
-        def hash_pair(left, right):
-            return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
-        
-        # Get the hashes of all transactions
-        tx_hashes = [hashlib.sha256(tx.serialize()).digest() for tx in transactions]
-        
-        # If there is only one hash, it is the Merkle root
-        if len(tx_hashes) == 1:
-            return tx_hashes[0]
-        
-        # If there is an odd number of hashes, duplicate the last one
-        if len(tx_hashes) % 2 != 0:
-            tx_hashes.append(tx_hashes[-1])
-        
-        # Calculate the Merkle root
-        while len(tx_hashes) > 1:
-            new_level = []
-            for i in range(0, len(tx_hashes), 2):
-                new_level.append(hash_pair(tx_hashes[i], tx_hashes[i+1]))
-            tx_hashes = new_level
-        
-        return tx_hashes[0]
+        return MerkleTree.from_transactions(transactions).root()
+
+    def get_merkle_proof(self, tx_index):
+        """
+        Build a proof that the transaction at `tx_index` is committed to by this
+        block's Merkle root, so it can be checked without the rest of the block.
+        """
+        return MerkleTree.from_transactions(self.transactions).get_proof(tx_index)
 
     @staticmethod
     def generateGenesisBlock(scriptPubKey):
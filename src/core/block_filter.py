@@ -0,0 +1,166 @@
+# Compact block filters: Golomb-coded sets of the scripts and outpoints a block touches (after BIP 158)
+import hashlib
+import struct
+
+FILTER_P = 19  # Golomb-Rice parameter: bits in each remainder
+FILTER_M = 784931  # Inverse of the false positive rate per queried element, as in BIP 158
+
+COINBASE = 0
+DOMAIN_TRANSFER = 2
+DOMAIN_COINBASE = 4
+
+P2PKH_PREFIX = b'\x76\xa9\x14'  # OP_DUP OP_HASH160 <20 bytes>
+P2PKH_SUFFIX = b'\x88\xac'  # OP_EQUALVERIFY OP_CHECKSIG
+
+
+def outpoint_element(txid, output_index):
+    return bytes(txid) + struct.pack('>I', output_index)
+
+
+def owner_element(owner_pub_key_hash):
+    """
+    Domain owners are added as the P2PKH script of their key, so one script
+    query finds both the coins and the domains of a key.
+    """
+    return P2PKH_PREFIX + bytes(owner_pub_key_hash) + P2PKH_SUFFIX
+
+
+def block_elements(block):
+    """
+    The set of items a block's filter covers: the ScriptPubKey of every coin
+    output, the owner of every issued or transferred domain, and the outpoint
+    of every coin and domain output its inputs spend.
+    """
+    elements = set()
+    for tx in block.transactions:
+        if tx.tx_type != COINBASE:
+            for coin_input in tx.coin_inputs:
+                elements.add(outpoint_element(coin_input.txid, coin_input.output_index))
+        for domain_input in tx.domain_inputs:
+            elements.add(outpoint_element(domain_input.domain_txid, domain_input.output_index))
+        for output in tx.coin_outputs:
+            if output.script_pub_key:
+                elements.add(bytes(output.script_pub_key))
+        if tx.tx_type == DOMAIN_COINBASE:
+            elements.update(owner_element(output.owner_pub_key_hash) for output in tx.domain_outputs)
+        elif tx.tx_type == DOMAIN_TRANSFER:
+            elements.update(owner_element(output.new_owner_pub_key_hash) for output in tx.domain_outputs)
+    return elements
+
+
+def hash_to_range(element, key, modulus):
+    """
+    Map an element uniformly onto [0, modulus) with a keyed 64-bit hash.
+    """
+    value = int.from_bytes(hashlib.blake2b(element, key=key, digest_size=8).digest(), 'big')
+    return (value * modulus) >> 64
+
+
+def golomb_encode(values, p=FILTER_P):
+    """
+    Golomb-Rice code the differences of sorted values: each difference is its
+    quotient by 2^p in unary, then the remainder in p bits.
+    """
+    mask = (1 << p) - 1
+    remainder_format = '0%db' % p
+    parts = []
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        parts.append('1' * (delta >> p) + '0' + format(delta & mask, remainder_format))
+    bits = ''.join(parts)
+    if not bits:
+        return b''
+    bits += '0' * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def golomb_decode(data, count, p=FILTER_P):
+    """
+    Decode `count` sorted values. The code is expanded into a string of bits
+    once, so each unary quotient is a single str.find and each remainder a
+    single int() of a slice.
+
+    :return: List of the values
+    """
+    if not count:
+        return []
+    bits = format(int.from_bytes(data, 'big'), '0%db' % (len(data) * 8))
+    values = []
+    value = 0
+    position = 0
+    for _ in range(count):
+        end = bits.find('0', position)
+        if end < 0 or end + 1 + p > len(bits):
+            raise ValueError("Truncated block filter")
+        value += ((end - position) << p) | int(bits[end + 1:end + 1 + p], 2)
+        values.append(value)
+        position = end + 1 + p
+    return values
+
+
+class BlockFilter:
+    """
+    Golomb-coded set of a block's elements (see block_elements). Elements are
+    hashed onto [0, N * M) with a key taken from the block hash, so a query
+    element that is not in the block matches with probability 1/M.
+    """
+    __slots__ = ('block_hash', 'count', 'data', '_values')
+
+    def __init__(self, block_hash, count, data):
+        self.block_hash = block_hash
+        self.count = count  # Number of elements
+        self.data = data  # Golomb-Rice coded hashes
+        self._values = None
+
+    @property
+    def key(self):
+        return bytes(self.block_hash[:16])
+
+    @staticmethod
+    def build(block, block_hash=None):
+        block_hash = block_hash or block.header_hash()
+        elements = block_elements(block)
+        key = bytes(block_hash[:16])
+        modulus = len(elements) * FILTER_M
+        # Colliding hashes are both coded (as a zero difference), so the count stays that of the elements
+        values = sorted(hash_to_range(element, key, modulus) for element in elements)
+        return BlockFilter(block_hash, len(values), golomb_encode(values))
+
+    def serialize(self):
+        return struct.pack('>I', self.count) + self.data
+
+    @staticmethod
+    def parse(block_hash, data):
+        if len(data) < 4:
+            raise ValueError("Block filter too short")
+        count = struct.unpack_from('>I', data)[0]
+        return BlockFilter(block_hash, count, bytes(data[4:]))
+
+    def values(self):
+        if self._values is None:
+            self._values = set(golomb_decode(self.data, self.count))
+        return self._values
+
+    def match_any(self, elements):
+        """
+        Check whether any of the elements may be in the block. False positives
+        occur at a rate of about len(elements) / M; there are no false negatives.
+        """
+        if not self.count:
+            return False
+        key = self.key
+        modulus = self.count * FILTER_M
+        values = self.values()
+        return any(hash_to_range(element, key, modulus) in values for element in elements)
+
+    def match(self, element):
+        return self.match_any((element,))
+
+    def to_json(self):
+        return {
+            'block_hash': self.block_hash.hex(),
+            'count': self.count,
+            'size': len(self.data)
+        }
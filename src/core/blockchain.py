@@ -1,20 +1,305 @@
-# Blockchain implementation 
-from wallet import * 
-from block import *
-from script import *
-from transaction import *
+# Blockchain implementation
+import hashlib
+import struct
 
-import pickledb
+import numpy as np
 
-# Load or create the database
-db = pickledb.load('example.db', False)
+from .block import BLOCK_HEADER_SIZE
+from ..consensus.pow import bits_to_target
 
-# Set a key-value pair
-db.set('username', 'bob')
+HEADER_FORMAT = struct.Struct('>I32s32sIII')  # version, previous_hash, merkle_root, timestamp, difficulty, nonce
+NULL_HASH = b'\x00' * 32
 
-# Retrieve a value
-username = db.get('username')
-print(username)  # Output: 'bob'
+# Header status flags
+HEADER_VALID = 1  # Connects to the index and satisfies its proof of work
+HAVE_DATA = 2  # The full block is stored
+FAILED = 4  # The block (or an ancestor) failed validation
 
-# Save changes
-db.dump()
+HEADER_DTYPE = np.dtype([
+    ('parent', '<i4'),  # Index of the parent header, -1 for genesis
+    ('height', '<i4'),
+    ('skip', '<i4'),  # Index of an ancestor further back, see get_skip_height
+    ('status', 'u1'),
+    ('timestamp', '<u4'),
+    ('difficulty', '<u4'),
+    ('work_hi', '<u8'),  # Cumulative chain work, high and low 64 bits
+    ('work_lo', '<u8'),
+])
+
+_MASK64 = (1 << 64) - 1
+
+
+def header_work(difficulty):
+    """
+    Expected number of hashes needed to meet a compact difficulty target.
+    """
+    return (1 << 256) // (bits_to_target(difficulty) + 1)
+
+
+def _invert_lowest_one(n):
+    return n & (n - 1)
+
+
+def get_skip_height(height):
+    """
+    Height of the skip pointer of a header at `height`. Chosen so that any
+    ancestor can be reached in O(log n) hops.
+    """
+    if height < 2:
+        return 0
+    if height & 1:
+        return _invert_lowest_one(_invert_lowest_one(height - 1)) + 1
+    return _invert_lowest_one(height)
+
+
+class HeaderIndex:
+    """
+    Index of every known block header, kept in NumPy arrays instead of per-header
+    objects: a structured array of parent/skip pointers, height, cumulative work
+    and status flags (37 bytes per header), the 32-byte hashes in one contiguous
+    buffer, and an open-addressing table from the first 8 bytes of a hash to its
+    position (24 bytes per header at the 50% load limit).
+    """
+    def __init__(self, capacity=1024):
+        self.count = 0
+        self.headers = np.zeros(capacity, dtype=HEADER_DTYPE)
+        self.hashes = np.zeros((capacity, 32), dtype=np.uint8)
+        self._table_keys = np.zeros(2 * capacity, dtype=np.uint64)
+        self._table_values = np.zeros(2 * capacity, dtype=np.int32)  # Position + 1, 0 for an empty slot
+        self.best = -1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, block_hash):
+        return self.get_position(block_hash) >= 0
+
+    # Hash table
+
+    def _lookup_slot(self, block_hash):
+        key = int.from_bytes(block_hash[:8], 'little')
+        mask = len(self._table_keys) - 1
+        slot = key & mask
+        while True:
+            value = int(self._table_values[slot])
+            if value == 0:
+                return slot, -1
+            if int(self._table_keys[slot]) == key and self.hashes[value - 1].tobytes() == block_hash:
+                return slot, value - 1
+            slot = (slot + 1) & mask
+
+    def get_position(self, block_hash):
+        """
+        Return the position of a header in the index, or -1 if unknown.
+        """
+        return self._lookup_slot(bytes(block_hash))[1]
+
+    def _grow(self):
+        capacity = 2 * len(self.headers)
+        headers = np.zeros(capacity, dtype=HEADER_DTYPE)
+        headers[:self.count] = self.headers[:self.count]
+        hashes = np.zeros((capacity, 32), dtype=np.uint8)
+        hashes[:self.count] = self.hashes[:self.count]
+        self.headers, self.hashes = headers, hashes
+        self._table_keys = np.zeros(2 * capacity, dtype=np.uint64)
+        self._table_values = np.zeros(2 * capacity, dtype=np.int32)
+        for position in range(self.count):
+            slot, _ = self._lookup_slot(self.hashes[position].tobytes())
+            self._table_keys[slot] = int.from_bytes(self.hashes[position, :8].tobytes(), 'little')
+            self._table_values[slot] = position + 1
+
+    # Header access
+
+    def get_hash(self, position):
+        return self.hashes[position].tobytes()
+
+    def get_height(self, block_hash):
+        position = self.get_position(block_hash)
+        return int(self.headers[position]['height']) if position >= 0 else None
+
+    def get_work(self, position):
+        header = self.headers[position]
+        return (int(header['work_hi']) << 64) | int(header['work_lo'])
+
+    def get_status(self, block_hash):
+        position = self.get_position(block_hash)
+        return int(self.headers[position]['status']) if position >= 0 else 0
+
+    # Adding headers
+
+    def add_header(self, header, check_pow=True):
+        """
+        Add a serialized 80-byte header (Block.serialize_header()). Its parent
+        must already be indexed, except for the first (genesis) header.
+
+        :return: Position of the header (existing position if already known).
+        """
+        if len(header) != BLOCK_HEADER_SIZE:
+            raise ValueError("Block header must be %d bytes long" % BLOCK_HEADER_SIZE)
+        header = bytes(header)
+        block_hash = hashlib.sha256(header).digest()
+        slot, position = self._lookup_slot(block_hash)
+        if position >= 0:
+            return position
+
+        _, previous_hash, _, timestamp, difficulty, _ = HEADER_FORMAT.unpack(header)
+        if check_pow and int.from_bytes(block_hash, 'big') > bits_to_target(difficulty):
+            raise ValueError("Header %s does not meet its proof-of-work target" % block_hash.hex())
+        if self.count == 0:
+            if previous_hash != NULL_HASH:
+                raise ValueError("The first header must be a genesis header")
+            parent, height, work, status = -1, 0, 0, HEADER_VALID
+        else:
+            parent = self.get_position(previous_hash)
+            if parent < 0:
+                raise ValueError("Header %s does not connect to a known header" % block_hash.hex())
+            height = int(self.headers[parent]['height']) + 1
+            work = self.get_work(parent)
+            status = HEADER_VALID | (int(self.headers[parent]['status']) & FAILED)
+        work += header_work(difficulty)
+
+        if self.count == len(self.headers):
+            self._grow()
+            slot, _ = self._lookup_slot(block_hash)
+        position = self.count
+        skip = self.get_ancestor(parent, get_skip_height(height)) if parent >= 0 else -1
+        self.headers[position] = (parent, height, skip, status, timestamp, difficulty, work >> 64, work & _MASK64)
+        self.hashes[position] = np.frombuffer(block_hash, dtype=np.uint8)
+        self._table_keys[slot] = int.from_bytes(block_hash[:8], 'little')
+        self._table_values[slot] = position + 1
+        self.count += 1
+
+        if not status & FAILED and (self.best < 0 or work > self.get_work(self.best)):
+            self.best = position
+        return position
+
+    def add_headers(self, headers, check_pow=True):
+        """
+        Add a batch of headers (e.g. one `headers` message during sync), in order.
+
+        :return: Position of the last header.
+        """
+        position = -1
+        for header in headers:
+            position = self.add_header(header, check_pow)
+        return position
+
+    # Status updates
+
+    def set_have_data(self, block_hash):
+        position = self.get_position(block_hash)
+        if position < 0:
+            raise ValueError("Unknown header %s" % bytes(block_hash).hex())
+        self.headers['status'][position] |= HAVE_DATA
+
+    def set_failed(self, block_hash):
+        """
+        Mark a header and all of its descendants as failed and move the best tip off them.
+        """
+        position = self.get_position(block_hash)
+        if position < 0:
+            raise ValueError("Unknown header %s" % bytes(block_hash).hex())
+        failed = np.zeros(self.count, dtype=bool)
+        failed[position] = True
+        # Children are always added after their parent, so one forward pass reaches every descendant
+        parents = self.headers['parent'][:self.count]
+        for child in range(position + 1, self.count):
+            if failed[parents[child]]:
+                failed[child] = True
+        self.headers['status'][:self.count][failed] |= FAILED
+        self._recompute_best()
+
+    def _recompute_best(self):
+        headers = self.headers[:self.count]
+        candidates = np.nonzero((headers['status'] & FAILED) == 0)[0]
+        if not len(candidates):
+            self.best = -1
+            return
+        order = np.lexsort((headers['work_lo'][candidates], headers['work_hi'][candidates]))
+        self.best = int(candidates[order[-1]])
+
+    # Queries
+
+    def best_tip(self):
+        """
+        Return (hash, height, cumulative work) of the valid header with the most work.
+        """
+        if self.best < 0:
+            return None
+        return self.get_hash(self.best), int(self.headers[self.best]['height']), self.get_work(self.best)
+
+    def get_ancestor(self, position, height):
+        """
+        Position of the ancestor of `position` at `height`, following skip pointers.
+        """
+        walk_height = int(self.headers[position]['height'])
+        if height > walk_height or height < 0:
+            return -1
+        headers = self.headers
+        while walk_height > height:
+            skip_height = get_skip_height(walk_height)
+            skip_height_previous = get_skip_height(walk_height - 1)
+            skip = int(headers[position]['skip'])
+            if skip >= 0 and (skip_height == height or
+                              (skip_height > height and not (skip_height_previous < skip_height - 2 and
+                                                             skip_height_previous >= height))):
+                position = skip
+                walk_height = skip_height
+            else:
+                position = int(headers[position]['parent'])
+                walk_height -= 1
+        return position
+
+    def get_ancestor_hash(self, block_hash, height):
+        position = self.get_position(block_hash)
+        if position < 0:
+            return None
+        ancestor = self.get_ancestor(position, height)
+        return self.get_hash(ancestor) if ancestor >= 0 else None
+
+    def find_fork(self, hash_a, hash_b):
+        """
+        Hash of the last common ancestor of two headers. Both are brought to the
+        same height, then walked back together, through their skip pointers
+        while those still differ and one parent at a time once they agree.
+        """
+        a = self.get_position(hash_a)
+        b = self.get_position(hash_b)
+        if a < 0 or b < 0:
+            return None
+        headers = self.headers
+        height = min(int(headers[a]['height']), int(headers[b]['height']))
+        a = self.get_ancestor(a, height)
+        b = self.get_ancestor(b, height)
+        while a != b:
+            # Equal heights have equal skip heights
+            skip_a = int(headers[a]['skip'])
+            skip_b = int(headers[b]['skip'])
+            if skip_a != skip_b:
+                a, b = skip_a, skip_b
+            else:
+                a = int(headers[a]['parent'])
+                b = int(headers[b]['parent'])
+            if a < 0 or b < 0:
+                return None  # No shared genesis
+        return self.get_hash(a)
+
+    def get_locator(self, block_hash=None):
+        """
+        Block locator for a getheaders request: the tip, then hashes at exponentially
+        growing distances back to genesis.
+        """
+        position = self.best if block_hash is None else self.get_position(block_hash)
+        if position < 0:
+            return []
+        locator = []
+        height = int(self.headers[position]['height'])
+        step = 1
+        while True:
+            locator.append(self.get_hash(position))
+            if height == 0:
+                return locator
+            if len(locator) >= 10:
+                step *= 2
+            height = max(height - step, 0)
+            position = self.get_ancestor(position, height)
@@ -0,0 +1,148 @@
+# Coin selection: branch-and-bound search for a change-free input set, with a largest-first fallback
+INPUT_SIZE = 167  # Serialized P2PKH coin input: outpoint, script length and 130-byte ScriptSig
+OUTPUT_SIZE = 34  # Serialized P2PKH coin output: value, script length and 25-byte ScriptPubKey
+TX_OVERHEAD = 11  # Version, type, the two coin counts and lock time
+MAX_INPUTS = 255  # Coin input count is a single byte
+MAX_BNB_TRIES = 100000
+
+
+class SelectionResult:
+    """
+    Coins chosen to fund a payment. `fee` is what is left after the payments
+    and the change, so change too small to be worth spending is part of it.
+    """
+    def __init__(self, coins, target, fee, change, algorithm):
+        self.coins = coins
+        self.target = target
+        self.fee = fee
+        self.change = change
+        self.algorithm = algorithm
+
+    @property
+    def total(self):
+        return sum(coin.value for coin in self.coins)
+
+    def to_json(self):
+        return {
+            'inputs': len(self.coins),
+            'total': self.total,
+            'target': self.target,
+            'fee': self.fee,
+            'change': self.change,
+            'algorithm': self.algorithm
+        }
+
+
+def transaction_size(inputs, outputs):
+    return TX_OVERHEAD + inputs * INPUT_SIZE + outputs * OUTPUT_SIZE
+
+
+def branch_and_bound(values, target, cost_of_change, max_tries=MAX_BNB_TRIES):
+    """
+    Depth-first search over the inclusion and omission of each value for the
+    subset whose sum lies in [target, target + cost_of_change] with the least
+    excess. `values` must be positive and sorted in descending order, so a
+    branch is cut as soon as it overshoots or the values left cannot reach the
+    target. Values equal to an omitted predecessor are skipped, as their
+    subsets were already explored.
+
+    :return: Indexes of the selected values, or None if no subset was found within max_tries
+    """
+    selection = []
+    best = None
+    best_waste = cost_of_change + 1
+    value = 0
+    available = sum(values)
+    if available < target:
+        return None
+    index = 0
+    for _ in range(max_tries):
+        backtrack = False
+        if value + available < target or value > target + cost_of_change or len(selection) > MAX_INPUTS:
+            backtrack = True
+        elif value >= target:
+            waste = value - target
+            if waste < best_waste:
+                best, best_waste = list(selection), waste
+                if waste == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            if not selection:
+                break  # Every branch was explored
+            # Values omitted after the last included one become available again
+            index -= 1
+            while index > selection[-1]:
+                available += values[index]
+                index -= 1
+            # Then explore the branch omitting the last included value
+            value -= values[index]
+            selection.pop()
+        else:
+            available -= values[index]
+            if not selection or index - 1 == selection[-1] or values[index] != values[index - 1]:
+                selection.append(index)
+                value += values[index]
+        index += 1
+    return best
+
+
+def select_coins(coins, payment_total, fee_rate=1, payment_outputs=1, min_change=None):
+    """
+    Choose coins paying `payment_total` plus the fee of the transaction that
+    spends them at `fee_rate` per byte.
+
+    Coins are compared by their effective value, what they are worth after
+    paying for their own input. Branch-and-bound first looks for a set that
+    needs no change output: any excess up to the cost of creating and later
+    spending a change output goes to the fee. If there is none, the smallest
+    coin that covers the payment with change is used, or else the largest
+    coins until the payment and change are covered.
+
+    :param coins: Candidate coins, each with a `value` attribute (e.g. OwnedCoin).
+    :param payment_outputs: Number of outputs the payments need.
+    :param min_change: Smallest change output worth creating (default: the cost of spending it).
+    :return: SelectionResult
+    :raises ValueError: If the coins cannot fund the payment.
+    """
+    if payment_total <= 0:
+        raise ValueError("Payment must be positive")
+    input_fee = INPUT_SIZE * fee_rate
+    change_fee = OUTPUT_SIZE * fee_rate
+    if min_change is None:
+        min_change = input_fee
+    target = payment_total + transaction_size(0, payment_outputs) * fee_rate
+    candidates = sorted((coin for coin in coins if coin.value > input_fee),
+                        key=lambda coin: coin.value, reverse=True)
+    effective = [coin.value - input_fee for coin in candidates]
+
+    selected = branch_and_bound(effective, target, change_fee + input_fee)
+    if selected is not None:
+        chosen = [candidates[i] for i in selected]
+        return SelectionResult(chosen, payment_total, sum(coin.value for coin in chosen) - payment_total,
+                               0, 'branch_and_bound')
+
+    # With change, the transaction also pays for the change output
+    target += change_fee + min_change
+    larger = [i for i, value in enumerate(effective) if value >= target]
+    if larger:
+        selected = [larger[-1]]
+    else:
+        selected = []
+        value = 0
+        for i, coin_value in enumerate(effective[:MAX_INPUTS]):
+            selected.append(i)
+            value += coin_value
+            if value >= target:
+                break
+        else:
+            if sum(effective) >= target:
+                raise ValueError("Payment needs more than %d inputs" % MAX_INPUTS)
+            raise ValueError("Insufficient funds: %d spendable in %d coins for a payment of %d"
+                             % (sum(effective), len(effective), payment_total))
+    chosen = [candidates[i] for i in selected]
+    total = sum(coin.value for coin in chosen)
+    fee = transaction_size(len(chosen), payment_outputs + 1) * fee_rate
+    change = total - payment_total - fee
+    return SelectionResult(chosen, payment_total, fee, change, 'largest_first')
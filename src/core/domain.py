@@ -1,4 +1,46 @@
+import hashlib
 import ipaddress
+import string
+from functools import lru_cache
+
+# Bit layout from the whitepaper: 64 name characters of 6 bits, 4 TLD characters of 5 bits,
+# a 1-bit IP version flag and a 32-bit (IPv4) or 128-bit (IPv6) address, padded to whole bytes.
+NAME_CHARS = 64
+NAME_BITS = 6
+TLD_CHARS = 4
+TLD_BITS = 5
+IP_FLAG_BIT = NAME_CHARS * NAME_BITS + TLD_CHARS * TLD_BITS  # 404
+IPV4_BITS = IP_FLAG_BIT + 1 + 32  # 437
+IPV6_BITS = IP_FLAG_BIT + 1 + 128  # 533
+IPV4_SIZE = (IPV4_BITS + 7) // 8  # 55 bytes
+IPV6_SIZE = (IPV6_BITS + 7) // 8  # 67 bytes
+
+# Character codes. 0 pads names and TLDs shorter than their maximum length.
+NAME_ALPHABET = '\0' + string.ascii_lowercase + string.digits + '-'
+TLD_ALPHABET = '\0' + string.ascii_lowercase
+NAME_CODES = {c: i for i, c in enumerate(NAME_ALPHABET)}
+TLD_CODES = {c: i for i, c in enumerate(TLD_ALPHABET)}
+del NAME_CODES['\0'], TLD_CODES['\0']
+# bytes.translate tables: ASCII -> code (0xff outside the alphabet) and code -> ASCII
+NAME_ENCODE_TABLE = bytes(NAME_CODES.get(chr(i).lower(), 0xff) for i in range(256))
+TLD_ENCODE_TABLE = bytes(TLD_CODES.get(chr(i).lower(), 0xff) for i in range(256))
+NAME_DECODE_TABLE = NAME_ALPHABET.encode('ascii').ljust(256, b'\xff')
+TLD_DECODE_TABLE = TLD_ALPHABET.encode('ascii').ljust(256, b'\xff')
+
+
+def normalize_domain(domain_name, tld):
+    """
+    Canonical form of a full domain name: names and TLDs are case-insensitive.
+    """
+    return f"{domain_name.strip().lower()}.{tld.strip().lower()}"
+
+
+def domain_name_hash(domain_name, tld):
+    """
+    Fixed-size key of a domain: SHA-256 of its normalised name.
+    """
+    return hashlib.sha256(normalize_domain(domain_name, tld).encode('utf-8')).digest()
+
 
 class FullDomain:
     def __init__(self, domain_name, tld, ip_address=None):
@@ -13,13 +55,24 @@ class FullDomain:
         self.tld = tld
         self.ip_address = ip_address
 
+    @staticmethod
+    def _trusted(domain_name, tld, ip_address):
+        """Build a FullDomain from fields already validated by the binary codec."""
+        domain = FullDomain.__new__(FullDomain)
+        domain.domain_name = domain_name
+        domain.tld = tld
+        domain.ip_address = ip_address
+        return domain
+
     def is_valid_domain_name(self, domain_name):
-        """Validate the domain name."""
-        return isinstance(domain_name, str) and 1 <= len(domain_name) <= 64
+        """Validate the domain name: 1 to 64 letters, digits or hyphens (case-insensitive)."""
+        return (isinstance(domain_name, str) and 1 <= len(domain_name) <= NAME_CHARS and
+                all(c in NAME_CODES for c in domain_name.lower()))
 
     def is_valid_tld(self, tld):
-        """Validate the top-level domain (TLD)."""
-        return isinstance(tld, str) and 1 <= len(tld) <= 4
+        """Validate the top-level domain (TLD): 1 to 4 letters (case-insensitive)."""
+        return (isinstance(tld, str) and 1 <= len(tld) <= TLD_CHARS and
+                all(c in TLD_CODES for c in tld.lower()))
 
     def is_valid_ip_address(self, ip_address):
         """Validate the IP address."""
@@ -48,25 +101,194 @@ class FullDomain:
         return f"{self.domain_name}.{self.tld}"
 
     def serialize(self):
-        """Serialize the domain into bytes."""
-        serialized = f"{self.domain_name}.{self.tld}"
-        if self.ip_address:
-            serialized += f":{self.ip_address}"
-        return serialized.encode('utf-8')
+        """
+        Serialize the domain into the bit-packed layout: 55 bytes with an IPv4
+        address, 67 bytes with an IPv6 address. A domain without an IP is
+        encoded with IPv4 address 0.0.0.0.
+        """
+        name_codes = self.domain_name.encode('ascii').translate(NAME_ENCODE_TABLE)
+        tld_codes = self.tld.encode('ascii').translate(TLD_ENCODE_TABLE)
+        value = 0
+        for code in name_codes:
+            value = (value << NAME_BITS) | code
+        value <<= NAME_BITS * (NAME_CHARS - len(name_codes))
+        for code in tld_codes:
+            value = (value << TLD_BITS) | code
+        value <<= TLD_BITS * (TLD_CHARS - len(tld_codes))
+
+        ip = ipaddress.ip_address(self.ip_address) if self.ip_address else ipaddress.IPv4Address(0)
+        if ip.version == 6:
+            value = (((value << 1) | 1) << 128) | int(ip)
+            return (value << (IPV6_SIZE * 8 - IPV6_BITS)).to_bytes(IPV6_SIZE, 'big')
+        value = (value << 33) | int(ip)
+        return (value << (IPV4_SIZE * 8 - IPV4_BITS)).to_bytes(IPV4_SIZE, 'big')
+
+    @staticmethod
+    def encoded_size(data, offset=0):
+        """Return the size of the encoded domain starting at `offset`, read from its IP version flag."""
+        flag_byte = data[offset + IP_FLAG_BIT // 8]
+        return IPV6_SIZE if flag_byte & (0x80 >> (IP_FLAG_BIT % 8)) else IPV4_SIZE
 
     @staticmethod
     def parse(serialized):
         """Parse bytes into a FullDomain object."""
+        return FullDomain.parse_from(memoryview(serialized))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        Parse a bit-packed domain at `offset` of a buffer.
+
+        :return: Tuple of (FullDomain, number of bytes consumed)
+        """
+        if offset + IPV4_SIZE > len(view):
+            raise ValueError("Invalid serialized format")
+        size = FullDomain.encoded_size(view, offset)
+        if offset + size > len(view):
+            raise ValueError("Invalid serialized format")
+        value = int.from_bytes(view[offset:offset+size], 'big')
+        pad = size * 8 - (IPV6_BITS if size == IPV6_SIZE else IPV4_BITS)
+        if value & ((1 << pad) - 1):
+            # Nonzero padding would decode to the same domain under different bytes (and txid)
+            raise ValueError("Invalid serialized format: nonzero padding bits")
+        value >>= pad
+        if size == IPV6_SIZE:
+            ip_address = str(ipaddress.IPv6Address(value & ((1 << 128) - 1)))
+            value >>= 129
+        else:
+            ip = value & 0xffffffff
+            ip_address = '%d.%d.%d.%d' % (ip >> 24, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff) if ip else None
+            value >>= 33
+
+        tld = bytes([(value >> shift) & 0x1f for shift in range(TLD_BITS * (TLD_CHARS - 1), -1, -TLD_BITS)])
+        value >>= TLD_BITS * TLD_CHARS
+        name = bytes([(value >> shift) & 0x3f for shift in range(NAME_BITS * (NAME_CHARS - 1), -1, -NAME_BITS)])
+        domain_name = name.translate(NAME_DECODE_TABLE).rstrip(b'\0')
+        tld = tld.translate(TLD_DECODE_TABLE).rstrip(b'\0')
+        if (not domain_name or not tld or b'\0' in domain_name or b'\0' in tld or
+                b'\xff' in domain_name or b'\xff' in tld):
+            raise ValueError("Invalid serialized format")
+        return FullDomain._trusted(domain_name.decode('ascii'), tld.decode('ascii'), ip_address), size
+
+    @staticmethod
+    def from_string(full_domain):
+        """Parse the human-readable form, e.g. "example.com:192.168.1.1"."""
         try:
-            serialized_str = serialized.decode('utf-8')
-            if ':' in serialized_str:
-                domain_part, ip_address = serialized_str.split(':', 1)
+            if ':' in full_domain:
+                domain_part, ip_address = full_domain.split(':', 1)
                 domain_name, tld = domain_part.split('.', 1)
                 return FullDomain(domain_name, tld, ip_address)
-            domain_name, tld = serialized_str.split('.', 1)
+            domain_name, tld = full_domain.split('.', 1)
             return FullDomain(domain_name, tld)
         except (ValueError, IndexError) as e:
-            raise ValueError("Invalid serialized format") from e
+            raise ValueError("Invalid domain format") from e
+
+    @staticmethod
+    def encode_many(domains):
+        """
+        Encode a list of domains at once with NumPy bit operations.
+
+        :return: The encodings concatenated in order, as bytes.
+        """
+        import numpy as np  # Only the bulk codec needs NumPy
+        import socket
+
+        count = len(domains)
+        if not count:
+            return b''
+        names = b''.join(d.domain_name.lower().encode('ascii').ljust(NAME_CHARS, b'\0') for d in domains)
+        tlds = b''.join(d.tld.lower().encode('ascii').ljust(TLD_CHARS, b'\0') for d in domains)
+        ips = [socket.inet_pton(socket.AF_INET6 if ':' in d.ip_address else socket.AF_INET, d.ip_address)
+               if d.ip_address else b'\0' * 4 for d in domains]
+        is_v6 = np.fromiter((len(ip) == 16 for ip in ips), dtype=bool, count=count)
+        ip_bytes = np.frombuffer(b''.join(ip.ljust(16, b'\0') for ip in ips), dtype=np.uint8).reshape(count, 16)
+
+        name_lut, tld_lut, _, _ = _lookup_tables()
+        name_codes = name_lut[np.frombuffer(names, dtype=np.uint8)].reshape(count, NAME_CHARS)
+        tld_codes = tld_lut[np.frombuffer(tlds, dtype=np.uint8)].reshape(count, TLD_CHARS)
+        if (name_codes == 0xff).any() or (tld_codes == 0xff).any():
+            raise ValueError("Invalid character in domain name or TLD")
+
+        # Keep the low 6 (name) or 5 (TLD) bits of every code, most significant first
+        name_bits = np.unpackbits(name_codes[:, :, None], axis=2)[:, :, 8-NAME_BITS:].reshape(count, -1)
+        tld_bits = np.unpackbits(tld_codes[:, :, None], axis=2)[:, :, 8-TLD_BITS:].reshape(count, -1)
+        ip_bits = np.unpackbits(ip_bytes, axis=1)
+        prefix = np.concatenate([name_bits, tld_bits, is_v6[:, None].astype(np.uint8)], axis=1)
+
+        sizes = np.where(is_v6, IPV6_SIZE, IPV4_SIZE)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        out = np.empty(int(sizes.sum()), dtype=np.uint8)
+        for v6, ip_width, size in ((False, 32, IPV4_SIZE), (True, 128, IPV6_SIZE)):
+            rows = np.nonzero(is_v6 == v6)[0]
+            if not len(rows):
+                continue
+            bits = np.zeros((len(rows), size * 8), dtype=np.uint8)
+            bits[:, :IP_FLAG_BIT + 1] = prefix[rows]
+            bits[:, IP_FLAG_BIT + 1:IP_FLAG_BIT + 1 + ip_width] = ip_bits[rows, :ip_width]
+            out[starts[rows, None] + np.arange(size)] = np.packbits(bits, axis=1)
+        return out.tobytes()
+
+    @staticmethod
+    def decode_many(data):
+        """
+        Decode a buffer of concatenated encodings (as produced by encode_many) with NumPy bit operations.
+
+        :return: List of FullDomain objects.
+        """
+        import numpy as np  # Only the bulk codec needs NumPy
+
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        starts = []
+        offset = 0
+        flag_index = IP_FLAG_BIT // 8
+        flag_mask = 0x80 >> (IP_FLAG_BIT % 8)
+        while offset < len(buffer):
+            starts.append(offset)
+            if offset + IPV4_SIZE > len(buffer):
+                raise ValueError("Invalid serialized format")
+            offset += IPV6_SIZE if data[offset + flag_index] & flag_mask else IPV4_SIZE
+        if offset != len(buffer):
+            raise ValueError("Invalid serialized format")
+        starts = np.array(starts, dtype=np.int64)
+        count = len(starts)
+
+        # The name, TLD and flag occupy the same leading bits of both encodings
+        head = buffer[starts[:, None] + np.arange(IPV4_SIZE)]
+        bits = np.unpackbits(head, axis=1)
+        name_codes = np.packbits(np.pad(bits[:, :IP_FLAG_BIT - TLD_CHARS * TLD_BITS].reshape(count, NAME_CHARS, NAME_BITS),
+                                        ((0, 0), (0, 0), (8 - NAME_BITS, 0))), axis=2).reshape(count, NAME_CHARS)
+        tld_codes = np.packbits(np.pad(bits[:, IP_FLAG_BIT - TLD_CHARS * TLD_BITS:IP_FLAG_BIT].reshape(count, TLD_CHARS, TLD_BITS),
+                                       ((0, 0), (0, 0), (8 - TLD_BITS, 0))), axis=2).reshape(count, TLD_CHARS)
+        is_v6 = bits[:, IP_FLAG_BIT].astype(bool)
+        if (name_codes >= len(NAME_ALPHABET)).any() or (tld_codes >= len(TLD_ALPHABET)).any():
+            raise ValueError("Invalid serialized format")
+
+        _, _, name_chars, tld_chars = _lookup_tables()
+        names = name_chars[name_codes]
+        tlds = tld_chars[tld_codes]
+        ip_values = np.zeros((count, 16), dtype=np.uint8)
+        for v6, ip_width, size in ((False, 32, IPV4_SIZE), (True, 128, IPV6_SIZE)):
+            rows = np.nonzero(is_v6 == v6)[0]
+            if not len(rows):
+                continue
+            row_bits = np.unpackbits(buffer[starts[rows, None] + np.arange(size)], axis=1)
+            if row_bits[:, IP_FLAG_BIT + 1 + ip_width:].any():
+                raise ValueError("Invalid serialized format: nonzero padding bits")
+            ip_values[rows, :ip_width // 8] = np.packbits(row_bits[:, IP_FLAG_BIT + 1:IP_FLAG_BIT + 1 + ip_width], axis=1)
+
+        domains = []
+        for i in range(count):
+            if is_v6[i]:
+                ip_address = str(ipaddress.IPv6Address(ip_values[i].tobytes()))
+            else:
+                ip = ip_values[i, :4].tolist()
+                ip_address = '%d.%d.%d.%d' % tuple(ip) if any(ip) else None
+            domain_name = names[i].tobytes().rstrip(b'\0')
+            tld = tlds[i].tobytes().rstrip(b'\0')
+            if not domain_name or not tld or b'\0' in domain_name or b'\0' in tld:
+                raise ValueError("Invalid serialized format")
+            domains.append(FullDomain._trusted(domain_name.decode('ascii'), tld.decode('ascii'), ip_address))
+        return domains
 
     def is_equal_up_to_ip(self, other_domain):
         """Check if two domains are the same up to the IP address."""
@@ -78,3 +300,24 @@ class FullDomain:
         if not self.is_valid_ip_address(new_ip_address):
             raise ValueError("Invalid IP address")
         self.ip_address = new_ip_address
+
+
+@lru_cache(maxsize=None)
+def _lookup_tables():
+    """
+    NumPy lookup tables for the bulk codec: ASCII -> name code, ASCII -> TLD code
+    (0xff for characters outside the alphabet) and the reverse code -> ASCII tables.
+    """
+    import numpy as np
+    name_codes = np.full(256, 0xff, dtype=np.uint8)
+    tld_codes = np.full(256, 0xff, dtype=np.uint8)
+    for c, code in NAME_CODES.items():
+        name_codes[ord(c)] = code
+    for c, code in TLD_CODES.items():
+        tld_codes[ord(c)] = code
+    name_codes[0] = tld_codes[0] = 0
+    name_chars = np.zeros(1 << NAME_BITS, dtype=np.uint8)
+    name_chars[:len(NAME_ALPHABET)] = np.frombuffer(NAME_ALPHABET.encode('ascii'), dtype=np.uint8)
+    tld_chars = np.zeros(1 << TLD_BITS, dtype=np.uint8)
+    tld_chars[:len(TLD_ALPHABET)] = np.frombuffer(TLD_ALPHABET.encode('ascii'), dtype=np.uint8)
+    return name_codes, tld_codes, name_chars, tld_chars
@@ -0,0 +1,519 @@
+# Transaction memory pool
+import bisect
+import heapq
+import itertools
+import time
+
+from .script import (SigHashCache, SignatureChecker, ScriptError, Script, verify_script,
+                     STANDARD_SCRIPT_VERIFY_FLAGS)
+
+COINBASE_TX_TYPES = (0, 4)  # Coinbase and domain coinbase transactions only appear in blocks
+
+DEFAULT_MAX_BYTES = 300 * 1024 * 1024
+DEFAULT_MAX_ANCESTORS = 25
+DEFAULT_MAX_DESCENDANTS = 25
+DEFAULT_BLOCK_SIZE = 1000000
+BLOCK_HEADER_RESERVE = 1000  # Room left in a template for the header and coinbase transactions
+MAX_CONSECUTIVE_FAILURES = 1000  # Packages that did not fit before template building gives up
+
+
+class MempoolEntry:
+    """
+    A transaction in the mempool with its fee, in-mempool parents and children,
+    and running totals over its ancestors and descendants (each including the
+    entry itself).
+    """
+    __slots__ = ('tx', 'txid', 'size', 'fee', 'time', 'sequence', 'parents', 'children',
+                 'ancestor_count', 'ancestor_size', 'ancestor_fee',
+                 'descendant_count', 'descendant_size', 'descendant_fee',
+                 'score_key', 'eviction_version')
+
+    def __init__(self, tx, size, fee, entry_time, sequence):
+        self.tx = tx
+        self.txid = tx.txid
+        self.size = size  # Serialized size in bytes
+        self.fee = fee
+        self.time = entry_time
+        self.sequence = sequence  # Arrival order, breaks fee rate ties
+        self.parents = set()  # In-mempool entries this one spends from
+        self.children = set()  # In-mempool entries spending from this one
+        self.ancestor_count = 1
+        self.ancestor_size = size
+        self.ancestor_fee = fee
+        self.descendant_count = 1
+        self.descendant_size = size
+        self.descendant_fee = fee
+        self.score_key = None  # Key in the mempool's ancestor score index
+        self.eviction_version = 0  # Invalidates stale eviction heap items
+
+    @property
+    def fee_rate(self):
+        return self.fee / self.size
+
+    @property
+    def ancestor_score(self):
+        """
+        Fee rate of the entry together with all its unconfirmed ancestors, which a
+        block must include first. Ranks entries for block templates.
+        """
+        return min(self.fee_rate, self.ancestor_fee / self.ancestor_size)
+
+    @property
+    def descendant_score(self):
+        """
+        Fee rate the entry is worth keeping for, counting the descendants that would
+        be evicted with it. The lowest scores are evicted first.
+        """
+        return max(self.fee_rate, self.descendant_fee / self.descendant_size)
+
+    def to_json(self):
+        return {
+            'txid': self.txid.hex(),
+            'size': self.size,
+            'fee': self.fee,
+            'fee_rate': self.fee_rate,
+            'time': self.time,
+            'ancestor_count': self.ancestor_count,
+            'ancestor_size': self.ancestor_size,
+            'ancestor_fee': self.ancestor_fee,
+            'descendant_count': self.descendant_count,
+            'descendant_size': self.descendant_size,
+            'descendant_fee': self.descendant_fee
+        }
+
+
+class BlockTemplate:
+    def __init__(self, transactions, size, fees):
+        self.transactions = transactions  # Parents always come before their children
+        self.size = size
+        self.fees = fees
+
+    def to_json(self):
+        return {
+            'txids': [tx.txid.hex() for tx in self.transactions],
+            'size': self.size,
+            'fees': self.fees
+        }
+
+
+class Mempool:
+    """
+    Unconfirmed transactions waiting to be mined.
+
+    Entries are indexed by txid, by every coin outpoint they spend and by every
+    domain outpoint they spend, so double spends and conflicting domain
+    transfers or IP changes are found with one dict lookup per input. Two
+    priority structures are kept up to date as entries come and go: a sorted
+    index by ancestor score, walked from the top to fill block templates
+    without sorting the whole pool, and a lazily-invalidated heap by descendant
+    score for evicting the least valuable packages when the pool exceeds
+    `max_bytes`.
+
+    :param coin_view: Object with get_coin(txid, output_index) returning a Coin or None (e.g. CoinsCache).
+    :param domain_view: Optional object with get_by_outpoint(txid, output_index) (e.g. DomainIndex);
+                        when given, domain inputs must spend a known domain output.
+    :param script_cache: Optional ScriptCache. When given, every input's script is run before a
+                         transaction is accepted (domain inputs only when their owner is known) and
+                         the inputs that pass are recorded, so block validation sharing the cache
+                         does not verify them again.
+    """
+    def __init__(self, coin_view, domain_view=None, max_bytes=DEFAULT_MAX_BYTES,
+                 max_ancestors=DEFAULT_MAX_ANCESTORS, max_descendants=DEFAULT_MAX_DESCENDANTS,
+                 script_cache=None, script_flags=STANDARD_SCRIPT_VERIFY_FLAGS):
+        self.coin_view = coin_view
+        self.domain_view = domain_view
+        self.script_cache = script_cache
+        self.script_flags = script_flags
+        self.max_bytes = max_bytes
+        self.max_ancestors = max_ancestors
+        self.max_descendants = max_descendants
+        self.entries = {}  # Txid -> MempoolEntry
+        self.spent = {}  # (txid, output index) of a spent coin -> spending MempoolEntry
+        self.domain_spent = {}  # (txid, output index) of a spent domain output -> spending MempoolEntry
+        self.total_bytes = 0
+        self._by_score = []  # Sorted (-ancestor score, sequence, txid)
+        self._eviction_heap = []  # (descendant score, sequence, eviction version, txid)
+        self._sequence = itertools.count()
+        self._version = 0  # Bumped on every change, invalidates the cached template
+        self._template = None  # (version, max_size, BlockTemplate)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def get(self, txid):
+        entry = self.entries.get(txid)
+        return entry.tx if entry is not None else None
+
+    def get_entry(self, txid):
+        """
+        :return: The MempoolEntry of `txid` (transaction, fee, size), or None
+        """
+        return self.entries.get(txid)
+
+    # Relationships
+
+    @staticmethod
+    def _ancestors(entries):
+        """
+        All in-mempool ancestors of a set of entries (excluding the entries themselves).
+        """
+        result = set()
+        stack = list(entries)
+        while stack:
+            for parent in stack.pop().parents:
+                if parent not in result:
+                    result.add(parent)
+                    stack.append(parent)
+        return result
+
+    @staticmethod
+    def _descendants(entry):
+        result = set()
+        stack = [entry]
+        while stack:
+            for child in stack.pop().children:
+                if child not in result:
+                    result.add(child)
+                    stack.append(child)
+        return result
+
+    def get_conflicts(self, tx):
+        """
+        Mempool entries spending any coin or domain output that `tx` also spends.
+        """
+        conflicts = set()
+        for coin_input in tx.coin_inputs:
+            entry = self.spent.get((coin_input.txid, coin_input.output_index))
+            if entry is not None and entry.txid != tx.txid:
+                conflicts.add(entry)
+        for domain_input in tx.domain_inputs:
+            entry = self.domain_spent.get((domain_input.domain_txid, domain_input.output_index))
+            if entry is not None and entry.txid != tx.txid:
+                conflicts.add(entry)
+        return conflicts
+
+    # Indexes
+
+    def _index_score(self, entry):
+        entry.score_key = (-entry.ancestor_score, entry.sequence, entry.txid)
+        bisect.insort(self._by_score, entry.score_key)
+
+    def _unindex_score(self, entry):
+        position = bisect.bisect_left(self._by_score, entry.score_key)
+        del self._by_score[position]
+        entry.score_key = None
+
+    def _push_eviction(self, entry):
+        entry.eviction_version += 1
+        heapq.heappush(self._eviction_heap, (entry.descendant_score, entry.sequence, entry.eviction_version, entry.txid))
+
+    # Adding
+
+    def add(self, tx, now=None):
+        """
+        Validate a transaction's inputs against the mempool and the coin view,
+        then add it.
+
+        :return: The new MempoolEntry
+        :raises ValueError: If the transaction is a coinbase, already present, spends a
+                            missing or already spent output, has unpaired domain inputs and
+                            outputs, pays a negative fee, exceeds the ancestor/descendant
+                            limits or is evicted at once.
+        """
+        txid = tx.txid
+        if txid in self.entries:
+            raise ValueError("Transaction %s is already in the mempool" % txid.hex())
+        if tx.tx_type in COINBASE_TX_TYPES:
+            raise ValueError("Coinbase transactions cannot enter the mempool")
+        if tx.tx_type in (2, 3) and len(tx.domain_inputs) != len(tx.domain_outputs):
+            raise ValueError("Domain inputs and outputs of %s must pair up" % txid.hex())
+
+        parents = set()
+        value_in = 0
+        outpoints = set()
+        spent_outputs = []
+        for coin_input in tx.coin_inputs:
+            outpoint = (coin_input.txid, coin_input.output_index)
+            if outpoint in outpoints:
+                raise ValueError("Transaction %s spends %s:%d twice" % (txid.hex(), outpoint[0].hex(), outpoint[1]))
+            outpoints.add(outpoint)
+            spender = self.spent.get(outpoint)
+            if spender is not None:
+                raise ValueError("Coin %s:%d is already spent by mempool transaction %s"
+                                 % (outpoint[0].hex(), outpoint[1], spender.txid.hex()))
+            parent = self.entries.get(coin_input.txid)
+            if parent is not None:
+                if coin_input.output_index >= len(parent.tx.coin_outputs):
+                    raise ValueError("Coin %s:%d does not exist" % (outpoint[0].hex(), outpoint[1]))
+                output = parent.tx.coin_outputs[coin_input.output_index]
+                parents.add(parent)
+            else:
+                coin = self.coin_view.get_coin(coin_input.txid, coin_input.output_index)
+                if coin is None:
+                    raise ValueError("Coin %s:%d is missing or spent" % (outpoint[0].hex(), outpoint[1]))
+                output = coin.output
+            value_in += output.value
+            spent_outputs.append(output)
+
+        domain_outpoints = set()
+        for domain_input in tx.domain_inputs:
+            outpoint = (domain_input.domain_txid, domain_input.output_index)
+            if outpoint in domain_outpoints:
+                raise ValueError("Transaction %s spends domain output %s:%d twice"
+                                 % (txid.hex(), outpoint[0].hex(), outpoint[1]))
+            domain_outpoints.add(outpoint)
+            spender = self.domain_spent.get(outpoint)
+            if spender is not None:
+                raise ValueError("Domain output %s:%d is already spent by mempool transaction %s"
+                                 % (outpoint[0].hex(), outpoint[1], spender.txid.hex()))
+            parent = self.entries.get(domain_input.domain_txid)
+            if parent is not None:
+                if domain_input.output_index >= len(parent.tx.domain_outputs):
+                    raise ValueError("Domain output %s:%d does not exist" % (outpoint[0].hex(), outpoint[1]))
+                parents.add(parent)
+            elif self.domain_view is not None and self.domain_view.get_by_outpoint(*outpoint) is None:
+                raise ValueError("Domain output %s:%d is missing or spent" % (outpoint[0].hex(), outpoint[1]))
+
+        fee = value_in - sum(output.value for output in tx.coin_outputs)
+        if fee < 0:
+            raise ValueError("Transaction %s spends more than its inputs" % txid.hex())
+        if self.script_cache is not None:
+            self._verify_scripts(tx, spent_outputs)
+
+        ancestors = parents | self._ancestors(parents)
+        if len(ancestors) + 1 > self.max_ancestors:
+            raise ValueError("Transaction %s has too many unconfirmed ancestors" % txid.hex())
+        for ancestor in ancestors:
+            if ancestor.descendant_count + 1 > self.max_descendants:
+                raise ValueError("Transaction %s would give %s too many descendants"
+                                 % (txid.hex(), ancestor.txid.hex()))
+
+        entry = MempoolEntry(tx, len(tx.serialize()), fee, time.time() if now is None else now, next(self._sequence))
+        entry.parents = parents
+        entry.ancestor_count += len(ancestors)
+        entry.ancestor_size += sum(ancestor.size for ancestor in ancestors)
+        entry.ancestor_fee += sum(ancestor.fee for ancestor in ancestors)
+        for parent in parents:
+            parent.children.add(entry)
+        for ancestor in ancestors:
+            ancestor.descendant_count += 1
+            ancestor.descendant_size += entry.size
+            ancestor.descendant_fee += entry.fee
+            self._push_eviction(ancestor)
+
+        self.entries[txid] = entry
+        for outpoint in outpoints:
+            self.spent[outpoint] = entry
+        for outpoint in domain_outpoints:
+            self.domain_spent[outpoint] = entry
+        self._index_score(entry)
+        self._push_eviction(entry)
+        self.total_bytes += entry.size
+        self._version += 1
+
+        if self.total_bytes > self.max_bytes:
+            self.trim()
+            if txid not in self.entries:
+                raise ValueError("Mempool full: transaction %s pays too low a fee rate" % txid.hex())
+        return entry
+
+    def _domain_owner(self, txid, output_index):
+        """
+        Owner of a domain output, following IP changes back through the
+        mempool, or None if it cannot be known without a domain view.
+        """
+        parent = self.entries.get(txid)
+        if parent is None:
+            record = self.domain_view.get_by_outpoint(txid, output_index) if self.domain_view is not None else None
+            return record.owner_pub_key_hash if record is not None else None
+        if parent.tx.tx_type == 2:
+            return parent.tx.domain_outputs[output_index].new_owner_pub_key_hash
+        if parent.tx.tx_type == 3 and output_index < len(parent.tx.domain_inputs):
+            domain_input = parent.tx.domain_inputs[output_index]  # An IP change keeps the owner
+            return self._domain_owner(domain_input.domain_txid, domain_input.output_index)
+        return None
+
+    def _verify_scripts(self, tx, spent_outputs):
+        """
+        Run the script of every input of `tx` and record the inputs that pass
+        in the script cache, all at once so a failing input caches nothing.
+        """
+        txid = tx.txid
+        flags = self.script_flags
+        sighash_cache = SigHashCache(tx)
+        verified = []
+        for index, (coin_input, output) in enumerate(zip(tx.coin_inputs, spent_outputs)):
+            if (txid, index, flags) not in self.script_cache:
+                try:
+                    verify_script(coin_input.script_sig, output.script_pub_key,
+                                  SignatureChecker(sighash_cache, index, output.value), flags)
+                except ScriptError as e:
+                    raise ValueError("Input %s:%d fails its script: %s" % (txid.hex(), index, e))
+            verified.append(index)
+        for index, domain_input in enumerate(tx.domain_inputs):
+            owner = self._domain_owner(domain_input.domain_txid, domain_input.output_index)
+            if owner is None:
+                continue
+            cache_index = len(tx.coin_inputs) + index
+            if (txid, cache_index, flags) not in self.script_cache:
+                try:
+                    verify_script(domain_input.script_sig, Script.createP2PKH_ScriptPubKey(owner),
+                                  SignatureChecker(sighash_cache, index, owner_pub_key_hash=owner), flags)
+                except ScriptError as e:
+                    raise ValueError("Domain input of %s is not signed by the domain owner: %s" % (txid.hex(), e))
+            verified.append(cache_index)
+        for index in verified:
+            self.script_cache.add(txid, index, flags)
+
+    # Removing
+
+    def _unlink(self, entry):
+        del self.entries[entry.txid]
+        for coin_input in entry.tx.coin_inputs:
+            self.spent.pop((coin_input.txid, coin_input.output_index), None)
+        for domain_input in entry.tx.domain_inputs:
+            self.domain_spent.pop((domain_input.domain_txid, domain_input.output_index), None)
+        self._unindex_score(entry)
+        for parent in entry.parents:
+            parent.children.discard(entry)
+        for child in entry.children:
+            child.parents.discard(entry)
+        self.total_bytes -= entry.size
+        self._version += 1
+
+    def _remove_with_descendants(self, entry):
+        """
+        Remove an entry and everything spending from it.
+
+        :return: List of removed transactions
+        """
+        removed = {entry} | self._descendants(entry)
+        for member in removed:
+            for ancestor in self._ancestors([member]) - removed:
+                ancestor.descendant_count -= 1
+                ancestor.descendant_size -= member.size
+                ancestor.descendant_fee -= member.fee
+        for ancestor in self._ancestors(removed) - removed:
+            self._push_eviction(ancestor)
+        for member in removed:
+            self._unlink(member)
+        return [member.tx for member in removed]
+
+    def remove(self, txid):
+        """
+        Remove a transaction and its descendants.
+
+        :return: List of removed transactions (empty if the txid is unknown)
+        """
+        entry = self.entries.get(txid)
+        if entry is None:
+            return []
+        return self._remove_with_descendants(entry)
+
+    def _remove_confirmed(self, entry):
+        # Its in-mempool ancestors are normally confirmed by the same block first;
+        # any that are not still lose this entry as a descendant
+        for ancestor in self._ancestors([entry]):
+            ancestor.descendant_count -= 1
+            ancestor.descendant_size -= entry.size
+            ancestor.descendant_fee -= entry.fee
+            self._push_eviction(ancestor)
+        descendants = self._descendants(entry)
+        self._unlink(entry)
+        for descendant in descendants:
+            descendant.ancestor_count -= 1
+            descendant.ancestor_size -= entry.size
+            descendant.ancestor_fee -= entry.fee
+            self._unindex_score(descendant)
+            self._index_score(descendant)
+
+    def remove_for_block(self, block):
+        """
+        Drop the transactions a newly connected block confirms, then everything
+        conflicting with it: entries spending a coin or domain output the block
+        spent, together with their descendants.
+
+        :return: List of transactions removed because of conflicts
+        """
+        conflicted = []
+        for tx in block.transactions:
+            entry = self.entries.get(tx.txid)
+            if entry is not None:
+                self._remove_confirmed(entry)
+        for tx in block.transactions:
+            for entry in self.get_conflicts(tx):
+                if entry.txid in self.entries:
+                    conflicted.extend(self._remove_with_descendants(entry))
+        return conflicted
+
+    def trim(self):
+        """
+        Evict the packages with the lowest descendant score until the pool fits in max_bytes.
+
+        :return: List of evicted transactions
+        """
+        evicted = []
+        heap = self._eviction_heap
+        while self.total_bytes > self.max_bytes and heap:
+            _, _, version, txid = heapq.heappop(heap)
+            entry = self.entries.get(txid)
+            if entry is None or entry.eviction_version != version:
+                continue  # Stale item, the entry was removed or re-scored since
+            evicted.extend(self._remove_with_descendants(entry))
+        if len(heap) > 2 * len(self.entries) + 1024:
+            self._eviction_heap = [item for item in heap
+                                   if item[3] in self.entries and self.entries[item[3]].eviction_version == item[2]]
+            heapq.heapify(self._eviction_heap)
+        return evicted
+
+    # Block templates
+
+    def get_block_template(self, max_size=DEFAULT_BLOCK_SIZE - BLOCK_HEADER_RESERVE):
+        """
+        Select transactions for a block of at most `max_size` bytes, best ancestor
+        score first. Each selected entry brings its not yet selected ancestors
+        along, so parents always precede children. The ancestor score index is
+        already sorted, so this walks it from the top and stops once the block
+        is nearly full, instead of sorting the pool on every call. The result
+        is cached until the mempool changes.
+        """
+        if self._template is not None and self._template[:2] == (self._version, max_size):
+            return self._template[2]
+
+        selected = set()
+        transactions = []
+        size = fees = failures = 0
+        for _, _, txid in self._by_score:
+            entry = self.entries[txid]
+            if entry in selected:
+                continue
+            package = [ancestor for ancestor in self._ancestors([entry]) if ancestor not in selected]
+            package.append(entry)
+            package_size = sum(member.size for member in package)
+            if size + package_size > max_size:
+                failures += 1
+                if failures >= MAX_CONSECUTIVE_FAILURES or max_size - size < 100:
+                    break
+                continue
+            failures = 0
+            # An ancestor always has fewer ancestors than its descendants
+            package.sort(key=lambda member: member.ancestor_count)
+            for member in package:
+                selected.add(member)
+                transactions.append(member.tx)
+                fees += member.fee
+            size += package_size
+
+        template = BlockTemplate(transactions, size, fees)
+        self._template = (self._version, max_size, template)
+        return template
+
+    def to_json(self):
+        return {
+            'size': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes
+        }
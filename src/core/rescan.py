@@ -0,0 +1,96 @@
+# Wallet rescan over stored blocks, reading only the blocks whose compact filter matches
+import time
+
+
+class RescanStats:
+    """
+    Counts and timings of a rescan. `matched` blocks were read because their
+    filter matched (or they have none); those that turned out not to touch the
+    wallet are the filter's false positives.
+    """
+    def __init__(self):
+        self.blocks = 0
+        self.matched = 0
+        self.relevant = 0  # Matched blocks that changed the wallet
+        self.unfiltered = 0  # Blocks stored without a filter, always read
+        self.filter_seconds = 0.0
+        self.block_seconds = 0.0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def false_positives(self):
+        return self.matched - self.relevant
+
+    def to_json(self):
+        return {
+            'blocks': self.blocks,
+            'matched': self.matched,
+            'relevant': self.relevant,
+            'false_positives': self.false_positives,
+            'unfiltered': self.unfiltered,
+            'filter_seconds': self.filter_seconds,
+            'block_seconds': self.block_seconds,
+            'elapsed_seconds': self.elapsed
+        }
+
+
+def rescan(wallet_index, store, start_height=None, end_height=None, progress=None, progress_interval=5.0):
+    """
+    Bring a WalletIndex up to date with the blocks in a BlockStore. Each
+    block's filter is tested against the wallet's scripts and outpoints first,
+    and only the blocks that match are read, parsed and connected; the others
+    are skipped without touching the block files. The query is rebuilt after
+    each block that changes the wallet, so spends of coins found earlier in
+    the rescan are matched too.
+
+    To restore a wallet or pick up an imported key, clear() the index first
+    and rescan from the start.
+
+    :param store: Block source with get_hash_at_height(), get_filter() and get_block(), e.g. BlockStore.
+    :param start_height: Height to start at; defaults to the block after the index's tip.
+    :param end_height: Height to stop before; defaults to the end of the stored chain.
+    :param progress: Optional callable receiving the RescanStats every `progress_interval` seconds.
+    :return: RescanStats
+    """
+    if start_height is None:
+        start_height = wallet_index.height + 1
+    if start_height != wallet_index.height + 1:
+        raise ValueError("Wallet index is at height %d, so the rescan must start at %d"
+                         % (wallet_index.height, wallet_index.height + 1))
+    stats = RescanStats()
+    elements = wallet_index.filter_elements()
+    last_progress = stats.started
+    height = start_height
+    while end_height is None or height < end_height:
+        block_hash = store.get_hash_at_height(height)
+        if block_hash is None:
+            break
+        started = time.perf_counter()
+        block_filter = store.get_filter(block_hash)
+        if block_filter is None:
+            stats.unfiltered += 1
+            matched = True
+        else:
+            matched = block_filter.match_any(elements)
+        filtered = time.perf_counter()
+        stats.filter_seconds += filtered - started
+
+        if matched:
+            block = store.get_block(block_hash)
+            if wallet_index.connect_block(block, height, block_hash):
+                stats.relevant += 1
+                elements = wallet_index.filter_elements()
+            stats.matched += 1
+            stats.block_seconds += time.perf_counter() - filtered
+        else:
+            wallet_index.skip_block(block_hash, height)
+        stats.blocks += 1
+        height += 1
+
+        if progress is not None and filtered - last_progress >= progress_interval:
+            last_progress = filtered
+            stats.elapsed = filtered - stats.started
+            progress(stats)
+    stats.elapsed = time.perf_counter() - stats.started
+    return stats
@@ -1,6 +1,358 @@
+# Scripts: P2PKH construction, signature hashes and the script interpreter
 import hashlib
 import struct
-from ecdsa import VerifyingKey, SECP256k1
+from collections import OrderedDict
+
+from ..crypto import crypto
+from .transaction import WIRE_V2_VERSION, encode_varint
+
+SIGHASH_ALL = 1  # The only signature hash type: commits to every input and output
+
+# Opcodes. 0x01-0x4b push that many bytes; OP_1 to OP_16 push the numbers 1 to 16.
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c  # Push the number of bytes given by the next byte
+OP_PUSHDATA2 = 0x4d  # Push the number of bytes given by the next 2 bytes
+OP_1 = 0x51
+OP_16 = 0x60
+OP_NOP = 0x61
+OP_VERIFY = 0x69
+OP_RETURN = 0x6a
+OP_DROP = 0x75
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_SHA256 = 0xa8
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKSIGVERIFY = 0xad
+
+# Verification flags
+SCRIPT_VERIFY_NONE = 0
+SCRIPT_VERIFY_PUSHONLY = 1 << 0  # ScriptSigs may only push data
+SCRIPT_VERIFY_NULLFAIL = 1 << 1  # A signature check that fails must have been given an empty signature
+SCRIPT_VERIFY_CLEANSTACK = 1 << 2  # Exactly one item must be left on the stack
+STANDARD_SCRIPT_VERIFY_FLAGS = SCRIPT_VERIFY_PUSHONLY | SCRIPT_VERIFY_NULLFAIL | SCRIPT_VERIFY_CLEANSTACK
+
+MAX_SCRIPT_SIZE = 10000
+MAX_ELEMENT_SIZE = 520
+MAX_STACK_SIZE = 1000
+MAX_OPS_PER_SCRIPT = 201  # Non-push operations
+
+P2PKH_PREFIX = b'\x76\xa9\x14'  # OP_DUP OP_HASH160 <20 bytes>
+P2PKH_SUFFIX = b'\x88\xac'  # OP_EQUALVERIFY OP_CHECKSIG
+
+DEFAULT_SCRIPT_CACHE_ENTRIES = 100000
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash160(data):
+    return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+
+class SigHashCache:
+    """
+    Signature hash precomputation for one transaction. The hashes of all coin
+    prevouts, coin outputs, domain prevouts and domain outputs are computed once
+    here, so the hash each input signs costs the same however many inputs and
+    outputs the transaction has. ScriptSigs are not committed to, so the signer
+    can build the cache from the unsigned transaction and the verifier from the
+    signed one and get the same hashes. See "5. Signature Hash" in
+    PROTOCOL/TRANSACTIONS/Transaction.txt.
+    """
+    __slots__ = ('transaction', 'hash_prevouts', 'hash_outputs', 'hash_domain_prevouts', 'hash_domain_outputs',
+                 '_prefix', '_suffix', '_v2')
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        # Version 2 transactions commit to their outputs and spent scripts with VarInt lengths
+        self._v2 = transaction.version >= WIRE_V2_VERSION
+        self.hash_prevouts = double_sha256(b''.join(
+            coin_input.txid + struct.pack('>I', coin_input.output_index) for coin_input in transaction.coin_inputs))
+        self.hash_outputs = double_sha256(b''.join(
+            output.serialize_v2() if self._v2 else output.serialize() for output in transaction.coin_outputs))
+        self.hash_domain_prevouts = double_sha256(b''.join(
+            domain_input.domain_txid + struct.pack('>I', domain_input.output_index)
+            for domain_input in transaction.domain_inputs))
+        self.hash_domain_outputs = double_sha256(b''.join(output.serialize() for output in transaction.domain_outputs))
+        self._prefix = (struct.pack('>IB', transaction.version, transaction.tx_type) +
+                        self.hash_prevouts + self.hash_domain_prevouts)
+        self._suffix = self.hash_outputs + self.hash_domain_outputs + struct.pack('>I', transaction.lock_time)
+
+    def coin_input_hash(self, input_index, script_pub_key, value, sighash_type=SIGHASH_ALL):
+        """
+        Hash signed by the ScriptSig of coin input `input_index`, which spends an
+        output of `value` locked by `script_pub_key`.
+        """
+        coin_input = self.transaction.coin_inputs[input_index]
+        return double_sha256(self._prefix + b'\x00' + coin_input.txid + struct.pack('>I', coin_input.output_index) +
+                             (encode_varint(len(script_pub_key)) if self._v2 else struct.pack('B', len(script_pub_key))) +
+                             script_pub_key + struct.pack('>Q', value) +
+                             self._suffix + struct.pack('>I', sighash_type))
+
+    def domain_input_hash(self, input_index, owner_pub_key_hash, sighash_type=SIGHASH_ALL):
+        """
+        Hash signed by the ScriptSig of domain input `input_index`, which spends a
+        domain output owned by `owner_pub_key_hash`.
+        """
+        domain_input = self.transaction.domain_inputs[input_index]
+        return double_sha256(self._prefix + b'\x01' + domain_input.domain_txid +
+                             struct.pack('>I', domain_input.output_index) + owner_pub_key_hash +
+                             self._suffix + struct.pack('>I', sighash_type))
+
+
+class ScriptError(ValueError):
+    pass
+
+
+class SignatureChecker:
+    """
+    Signature checks for the scripts of one input. A coin input signs a hash
+    committing to the spent ScriptPubKey and value, a domain input one
+    committing to the owner's public key hash (see SigHashCache).
+
+    When `jobs` is a list, checks are not run: each is appended to it as
+    (message_hash, signature, public_key) and assumed to pass, so a block's
+    signatures can be verified together (crypto.SignatureVerifier) once all
+    its scripts have run. That is only exact under SCRIPT_VERIFY_NULLFAIL,
+    where a check given a non-empty signature either passes or fails the
+    whole script, so verify_script() refuses a deferring checker without it.
+    """
+    __slots__ = ('sighash_cache', 'input_index', 'value', 'owner_pub_key_hash', 'jobs')
+
+    def __init__(self, sighash_cache, input_index, value=0, owner_pub_key_hash=None, jobs=None):
+        self.sighash_cache = sighash_cache
+        self.input_index = input_index
+        self.value = value  # Value of the spent coin output
+        self.owner_pub_key_hash = owner_pub_key_hash  # Set for domain inputs
+        self.jobs = jobs
+
+    def message_hash(self, script_code):
+        if self.owner_pub_key_hash is not None:
+            return self.sighash_cache.domain_input_hash(self.input_index, self.owner_pub_key_hash)
+        return self.sighash_cache.coin_input_hash(self.input_index, script_code, self.value)
+
+    def check_signature(self, signature, public_key, script_code):
+        message_hash = self.message_hash(script_code)
+        if self.jobs is not None:
+            self.jobs.append((message_hash, signature, public_key))
+            return True
+        return crypto.verify_signature(message_hash, signature, public_key)
+
+
+class ScriptCache:
+    """
+    Inputs whose scripts have passed, keyed by (txid, input index, flags);
+    domain inputs are numbered after the coin inputs. The txid commits to the
+    ScriptSig and to the outpoint spent, so a hit means this very check has
+    succeeded before. The mempool records the inputs it verifies and block
+    validation consumes the entries when the transaction is mined, so its
+    signatures are not verified twice. The oldest entries are evicted first.
+    """
+    def __init__(self, max_entries=DEFAULT_SCRIPT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, txid, input_index, flags):
+        self.entries[(txid, input_index, flags)] = None
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def consume(self, txid, input_index, flags):
+        """
+        Remove an entry, e.g. once the input is in a connected block.
+
+        :return: True if the input had been verified with these flags.
+        """
+        try:
+            del self.entries[(txid, input_index, flags)]
+        except KeyError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def to_json(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def cast_to_bool(element):
+    """
+    Truth value of a stack element: false for any encoding of zero, including negative zero.
+    """
+    last = len(element) - 1
+    for i, byte in enumerate(element):
+        if byte:
+            return not (i == last and byte == 0x80)
+    return False
+
+
+def iter_ops(script):
+    """
+    Yield (opcode, pushed bytes) for each operation of a script; the pushed
+    bytes are None for operations that are not pushes.
+    """
+    end = len(script)
+    offset = 0
+    while offset < end:
+        opcode = script[offset]
+        offset += 1
+        if opcode > OP_PUSHDATA2:
+            yield opcode, None
+            continue
+        if opcode < OP_PUSHDATA1:
+            size = opcode
+        elif opcode == OP_PUSHDATA1:
+            if offset + 1 > end:
+                raise ScriptError("Truncated OP_PUSHDATA1")
+            size = script[offset]
+            offset += 1
+        else:
+            if offset + 2 > end:
+                raise ScriptError("Truncated OP_PUSHDATA2")
+            size = struct.unpack_from('>H', script, offset)[0]
+            offset += 2
+        if offset + size > end:
+            raise ScriptError("Push past the end of the script")
+        yield opcode, bytes(script[offset:offset + size])
+        offset += size
+
+
+def is_push_only(script):
+    return all(data is not None or OP_1 <= opcode <= OP_16 for opcode, data in iter_ops(script))
+
+
+def _pop(stack):
+    if not stack:
+        raise ScriptError("Stack underflow")
+    return stack.pop()
+
+
+def eval_script(script, stack, checker, flags=STANDARD_SCRIPT_VERIFY_FLAGS):
+    """
+    Run a script on `stack` (a list, top last), in place.
+
+    :raises ScriptError: If an operation fails or a limit is exceeded.
+    """
+    if len(script) > MAX_SCRIPT_SIZE:
+        raise ScriptError("Script is larger than %d bytes" % MAX_SCRIPT_SIZE)
+    op_count = 0
+    for opcode, data in iter_ops(script):
+        if data is not None:
+            if len(data) > MAX_ELEMENT_SIZE:
+                raise ScriptError("Push larger than %d bytes" % MAX_ELEMENT_SIZE)
+            stack.append(data)
+        elif OP_1 <= opcode <= OP_16:
+            stack.append(bytes([opcode - OP_1 + 1]))
+        else:
+            op_count += 1
+            if op_count > MAX_OPS_PER_SCRIPT:
+                raise ScriptError("More than %d operations" % MAX_OPS_PER_SCRIPT)
+            if opcode == OP_DUP:
+                if not stack:
+                    raise ScriptError("Stack underflow")
+                stack.append(stack[-1])
+            elif opcode == OP_HASH160:
+                stack.append(hash160(_pop(stack)))
+            elif opcode == OP_EQUAL or opcode == OP_EQUALVERIFY:
+                equal = _pop(stack) == _pop(stack)
+                if opcode == OP_EQUAL:
+                    stack.append(b'\x01' if equal else b'')
+                elif not equal:
+                    raise ScriptError("OP_EQUALVERIFY failed")
+            elif opcode == OP_CHECKSIG or opcode == OP_CHECKSIGVERIFY:
+                public_key = _pop(stack)
+                signature = _pop(stack)
+                valid = bool(signature) and checker.check_signature(signature, public_key, script)
+                if not valid and signature and flags & SCRIPT_VERIFY_NULLFAIL:
+                    raise ScriptError("Signature check failed")
+                if opcode == OP_CHECKSIG:
+                    stack.append(b'\x01' if valid else b'')
+                elif not valid:
+                    raise ScriptError("OP_CHECKSIGVERIFY failed")
+            elif opcode == OP_VERIFY:
+                if not cast_to_bool(_pop(stack)):
+                    raise ScriptError("OP_VERIFY failed")
+            elif opcode == OP_DROP:
+                _pop(stack)
+            elif opcode == OP_SHA256:
+                stack.append(hashlib.sha256(_pop(stack)).digest())
+            elif opcode == OP_RETURN:
+                raise ScriptError("OP_RETURN")
+            elif opcode != OP_NOP:
+                raise ScriptError("Unknown opcode 0x%02x" % opcode)
+        if len(stack) > MAX_STACK_SIZE:
+            raise ScriptError("Stack larger than %d items" % MAX_STACK_SIZE)
+
+
+def match_p2pkh(script_sig, script_pub_key):
+    """
+    Recognise the standard P2PKH pair: a ScriptSig of two direct pushes
+    (Script.createP2PKH_ScriptSig) spending OP_DUP OP_HASH160 <20 bytes>
+    OP_EQUALVERIFY OP_CHECKSIG.
+
+    :return: (signature, public key), or None if either script does not match the template.
+    """
+    if (len(script_pub_key) != 25 or script_pub_key[:3] != P2PKH_PREFIX or
+            script_pub_key[23:] != P2PKH_SUFFIX or not script_sig):
+        return None
+    signature_end = 1 + script_sig[0]
+    if (not 0 < script_sig[0] < OP_PUSHDATA1 or signature_end >= len(script_sig) or
+            not 0 < script_sig[signature_end] < OP_PUSHDATA1 or
+            signature_end + 1 + script_sig[signature_end] != len(script_sig)):
+        return None
+    return bytes(script_sig[1:signature_end]), bytes(script_sig[signature_end + 1:])
+
+
+def verify_script(script_sig, script_pub_key, checker, flags=STANDARD_SCRIPT_VERIFY_FLAGS):
+    """
+    Check that `script_sig` unlocks `script_pub_key`: the ScriptSig is run on
+    an empty stack, then the ScriptPubKey on the stack it leaves, and the
+    input is valid if the top item is true.
+
+    Standard P2PKH pairs skip the interpreter: the key is hashed and compared
+    and the signature checked directly, with the same result the generic
+    evaluation would give.
+
+    :param checker: SignatureChecker for the input.
+    :raises ScriptError: If the input is not valid.
+    """
+    if checker.jobs is not None and not flags & SCRIPT_VERIFY_NULLFAIL:
+        raise ValueError("Deferred signature checks need SCRIPT_VERIFY_NULLFAIL")
+    matched = match_p2pkh(script_sig, script_pub_key)
+    if matched is not None:
+        signature, public_key = matched
+        if hash160(public_key) != script_pub_key[3:23]:
+            raise ScriptError("OP_EQUALVERIFY failed")
+        if not checker.check_signature(signature, public_key, script_pub_key):
+            raise ScriptError("Signature check failed")
+        return
+
+    if flags & SCRIPT_VERIFY_PUSHONLY and not is_push_only(script_sig):
+        raise ScriptError("ScriptSig is not push-only")
+    stack = []
+    eval_script(script_sig, stack, checker, flags)
+    eval_script(script_pub_key, stack, checker, flags)
+    if not stack or not cast_to_bool(stack[-1]):
+        raise ScriptError("Script evaluated to false")
+    if flags & SCRIPT_VERIFY_CLEANSTACK and len(stack) != 1:
+        raise ScriptError("Stack not clean after evaluation")
+
 
 class Script:
     def __init__(self, script_sig, script_pub_key):
@@ -28,52 +380,50 @@ class Script:
             'script_pub_key': self.script_pub_key.hex()
         }
 
-    def get_message_hash(self, transaction):
+    def get_message_hash(self, transaction, input_index, value, sighash_cache=None):
         """
-        Compute the message hash for a P2PKH transaction. It takes the full transaction in binary format and doublesSHA256 it
+        Compute the message hash signed by coin input `input_index` of a transaction,
+        which spends an output of `value` locked by this script's ScriptPubKey.
+        Pass the same SigHashCache for every input of a transaction to hash its
+        prevouts and outputs only once.
         """
-        # Serialize the transaction
-        serialized_transaction = transaction.serialize()
-
-        # Compute double SHA-256
-        first_hash = hashlib.sha256(serialized_transaction).digest()
-        second_hash = hashlib.sha256(first_hash).digest()
-
-        return second_hash
+        if sighash_cache is None:
+            sighash_cache = SigHashCache(transaction)
+        return sighash_cache.coin_input_hash(input_index, self.script_pub_key, value)
 
     def verify_signature(self, message_hash, signature, public_key):
         """
         Verify the signature using the message hash and public key.
+        Decoded public keys are cached; use crypto.SignatureVerifier to check many signatures at once.
         """
-        verifying_key = VerifyingKey.from_string(public_key, curve=SECP256k1)
-        try:
-            verifying_key.verify(signature, message_hash)
-            return True
-        except Exception:
-            return False
+        return crypto.verify_signature(message_hash, signature, public_key)
 
-    @staticmethod
-    def from_transaction(transaction, input_index):
+    def verify(self, transaction, input_index, value, flags=STANDARD_SCRIPT_VERIFY_FLAGS, sighash_cache=None):
         """
-        Extract ScriptSig and ScriptPubKey from a transaction given the input index.
+        Run this script pair for coin input `input_index` of a transaction,
+        which spends an output of `value` locked by this script's ScriptPubKey.
+
+        :raises ScriptError: If the input is not valid.
         """
-        # Get CoinInput or DomainInput from the transaction
-        if input_index < len(transaction.coin_inputs):
-            coin_input = transaction.coin_inputs[input_index]
-            script_sig = coin_input.script_sig
-        else:
-            coin_input = None
-            script_sig = b''
+        if sighash_cache is None:
+            sighash_cache = SigHashCache(transaction)
+        verify_script(self.script_sig, self.script_pub_key, SignatureChecker(sighash_cache, input_index, value), flags)
 
-        # Get ScriptPubKey from the corresponding CoinOutput or DomainOutput
-        if input_index < len(transaction.coin_outputs):
-            coin_output = transaction.coin_outputs[input_index]
-            script_pub_key = coin_output.script_pub_key
-        else:
-            coin_output = None
-            script_pub_key = b''
+    @staticmethod
+    def from_transaction(transaction, input_index, coin_view):
+        """
+        Pair the ScriptSig of coin input `input_index` with the ScriptPubKey of
+        the output it spends, looked up in `coin_view`.
+
+        :param coin_view: Object with get_coin(txid, output_index) returning a Coin or None (e.g. CoinsCache).
+        :return: Tuple of (Script, spent output value)
+        """
+        coin_input = transaction.coin_inputs[input_index]
+        coin = coin_view.get_coin(coin_input.txid, coin_input.output_index)
+        if coin is None:
+            raise ValueError("Coin %s:%d is missing or spent" % (coin_input.txid.hex(), coin_input.output_index))
+        return Script(coin_input.script_sig, coin.output.script_pub_key), coin.output.value
 
-        return Script(script_sig, script_pub_key)
     def createP2PKH_ScriptPubKey(pubkey_hash):
         """
         Creates a binary ScriptPubKey for a P2PKH output.
@@ -96,7 +446,7 @@ class Script:
                         pubkey_hash + op_equalverify + op_checksig)
         
         return scriptpubkey
-    def createP2PKH_ScriptSig(signature: bytes, public_key: VerifyingKey) -> bytes:
+    def createP2PKH_ScriptSig(signature: bytes, public_key: 'ecdsa.VerifyingKey') -> bytes:
         """
         Creates a binary ScriptSig for a P2PKH input.
 
@@ -105,7 +455,7 @@ class Script:
         :return: Binary ScriptSig
         """
         # Ensure public_key is a VerifyingKey object
-        if not isinstance(public_key, VerifyingKey):
+        if not hasattr(public_key, 'to_string'):
             raise TypeError("public_key must be a VerifyingKey object")
 
         # Convert VerifyingKey to bytes
@@ -1,29 +1,124 @@
+import hashlib
+import ipaddress
 import struct
+from .domain import FullDomain
+
+_set = object.__setattr__
+
+
+def _check_bounds(view, end):
+    """
+    Raise if a variable-length field runs past the end of the buffer.
+    struct.unpack_from already does this for fixed-size fields.
+    """
+    if end > len(view):
+        raise ValueError("Truncated data: need %d bytes, have %d" % (end, len(view)))
+
+
+# Transactions and blocks from this version on use the v2 wire format: VarInt counts and lengths
+WIRE_V2_VERSION = 2
+
+
+def encode_varint(value):
+    """
+    VarInt: values below 0xfd in one byte, otherwise a 0xfd, 0xfe or 0xff marker
+    followed by the value in 2, 4 or 8 big-endian bytes.
+    """
+    if value < 0xfd:
+        return bytes((value,))
+    if value <= 0xffff:
+        return b'\xfd' + struct.pack('>H', value)
+    if value <= 0xffffffff:
+        return b'\xfe' + struct.pack('>I', value)
+    return b'\xff' + struct.pack('>Q', value)
+
+
+def varint_size(value):
+    return 1 if value < 0xfd else 3 if value <= 0xffff else 5 if value <= 0xffffffff else 9
+
+
+def read_varint(view, offset=0):
+    """
+    Read a VarInt at `offset`. Only the shortest encoding of a value is accepted,
+    so every transaction has exactly one serialization and one txid.
+
+    :return: Tuple of (value, number of bytes consumed)
+    """
+    first = struct.unpack_from('B', view, offset)[0]
+    if first < 0xfd:
+        return first, 1
+    if first == 0xfd:
+        value, size = struct.unpack_from('>H', view, offset + 1)[0], 3
+    elif first == 0xfe:
+        value, size = struct.unpack_from('>I', view, offset + 1)[0], 5
+    else:
+        value, size = struct.unpack_from('>Q', view, offset + 1)[0], 9
+    if varint_size(value) != size:
+        raise ValueError("Non-canonical VarInt at offset %d" % offset)
+    return value, size
+
+
+class _Immutable:
+    """
+    Base for the wire objects below. They cache their serialized bytes (and the
+    Transaction its txid), so they are frozen once built; use TransactionBuilder
+    to derive a modified transaction.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable; use TransactionBuilder to modify it" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable; use TransactionBuilder to modify it" % type(self).__name__)
+
+
+class CoinInput(_Immutable):
+    __slots__ = ('txid', 'output_index', 'script_sig', 'length', '_raw')
 
-class CoinInput:
     def __init__(self, txid, output_index, script_sig):
-        self.txid = txid  # 32 bytes (transaction ID)
-        self.output_index = output_index  # 4 bytes (output index)
-        self.script_sig = script_sig  # Variable length (script signature)
-        self.length = 32 + 4 + 1 + len(script_sig)  # Total length of serialized input
+        _set(self, 'txid', txid)  # 32 bytes (transaction ID)
+        _set(self, 'output_index', output_index)  # 4 bytes (output index)
+        _set(self, 'script_sig', script_sig)  # Variable length (script signature)
+        _set(self, 'length', 32 + 4 + 1 + len(script_sig))  # Total length of serialized input
+        _set(self, '_raw', None)
+
+    def __reduce__(self):
+        return CoinInput, (self.txid, self.output_index, self.script_sig)
 
     def serialize(self):
-        # TXID (32 bytes)
-        txid_bin = self.txid
-        # Output Index (4 bytes)
-        output_index_bin = struct.pack('>I', self.output_index)
-        # ScriptSig Length (1 byte)
-        script_sig_length_bin = struct.pack('B', len(self.script_sig))
-        # ScriptSig (variable length)
-        return txid_bin + output_index_bin + script_sig_length_bin + self.script_sig
+        if self._raw is None:
+            # TXID (32 bytes), Output Index (4 bytes), ScriptSig Length (1 byte), ScriptSig (variable length)
+            _set(self, '_raw', self.txid + struct.pack('>IB', self.output_index, len(self.script_sig)) + self.script_sig)
+        return self._raw
+
+    def serialize_v2(self):
+        # TXID (32 bytes), Output Index (4 bytes), ScriptSig Length (VarInt), ScriptSig (variable length)
+        return self.txid + struct.pack('>I', self.output_index) + encode_varint(len(self.script_sig)) + self.script_sig
 
     @staticmethod
     def parse(data):
-        txid = data[:32]
-        output_index = struct.unpack('>I', data[32:36])[0]
-        script_sig_length = struct.unpack('B', data[36:37])[0]
-        script_sig = data[37:37+script_sig_length]
-        return CoinInput(txid, output_index, script_sig)
+        return CoinInput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0, v2=False):
+        """
+        Parse a CoinInput at `offset` of a memoryview without slicing the buffer.
+        `v2` selects the VarInt ScriptSig length of version 2 transactions.
+
+        :return: Tuple of (CoinInput, number of bytes consumed)
+        """
+        txid = bytes(view[offset:offset+32])
+        if v2:
+            output_index = struct.unpack_from('>I', view, offset+32)[0]
+            script_sig_length, size = read_varint(view, offset+36)
+            start = offset + 36 + size
+            _check_bounds(view, start + script_sig_length)
+            return CoinInput(txid, output_index, bytes(view[start:start+script_sig_length])), 36 + size + script_sig_length
+        output_index, script_sig_length = struct.unpack_from('>IB', view, offset+32)
+        script_sig = bytes(view[offset+37:offset+37+script_sig_length])
+        _check_bounds(view, offset + 37 + script_sig_length)
+        return CoinInput(txid, output_index, script_sig), 37 + script_sig_length
 
     def to_json(self):
         return {
@@ -31,56 +126,102 @@ class CoinInput:
             'output_index': self.output_index,
             'script_sig': self.script_sig.hex()
         }
-class CoinOutput:
+class CoinOutput(_Immutable):
+    __slots__ = ('value', 'script_pub_key', 'length', '_raw')
+
     def __init__(self, value, script_pub_key):
-        self.value = value  # 8 bytes (value in native coin)
-        self.script_pub_key = script_pub_key  # Variable length (script public key)
-        self.length = 8 + 1 + len(script_pub_key)  # Total length of serialized output
+        _set(self, 'value', value)  # 8 bytes (value in native coin)
+        _set(self, 'script_pub_key', script_pub_key)  # Variable length (script public key)
+        _set(self, 'length', 8 + 1 + len(script_pub_key))  # Total length of serialized output
+        _set(self, '_raw', None)
+
+    def __reduce__(self):
+        return CoinOutput, (self.value, self.script_pub_key)
 
     def serialize(self):
-        # Value (8 bytes)
-        value_bin = struct.pack('>Q', self.value)
-        # ScriptPubKey Length (1 byte)
-        script_pub_key_length_bin = struct.pack('B', len(self.script_pub_key))
-        # ScriptPubKey (variable length)
-        return value_bin + script_pub_key_length_bin + self.script_pub_key
+        if self._raw is None:
+            # Value (8 bytes), ScriptPubKey Length (1 byte), ScriptPubKey (variable length)
+            _set(self, '_raw', struct.pack('>QB', self.value, len(self.script_pub_key)) + self.script_pub_key)
+        return self._raw
+
+    def serialize_v2(self):
+        # Value (8 bytes), ScriptPubKey Length (VarInt), ScriptPubKey (variable length)
+        return struct.pack('>Q', self.value) + encode_varint(len(self.script_pub_key)) + self.script_pub_key
 
     @staticmethod
     def parse(data):
-        value = struct.unpack('>Q', data[:8])[0]
-        script_pub_key_length = struct.unpack('B', data[8:9])[0]
-        script_pub_key = data[9:9+script_pub_key_length]
-        return CoinOutput(value, script_pub_key)
+        return CoinOutput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0, v2=False):
+        """
+        Parse a CoinOutput at `offset` of a memoryview without slicing the buffer.
+        `v2` selects the VarInt ScriptPubKey length of version 2 transactions.
+
+        :return: Tuple of (CoinOutput, number of bytes consumed)
+        """
+        if v2:
+            value = struct.unpack_from('>Q', view, offset)[0]
+            script_pub_key_length, size = read_varint(view, offset+8)
+            start = offset + 8 + size
+            _check_bounds(view, start + script_pub_key_length)
+            return CoinOutput(value, bytes(view[start:start+script_pub_key_length])), 8 + size + script_pub_key_length
+        value, script_pub_key_length = struct.unpack_from('>QB', view, offset)
+        script_pub_key = bytes(view[offset+9:offset+9+script_pub_key_length])
+        _check_bounds(view, offset + 9 + script_pub_key_length)
+        return CoinOutput(value, script_pub_key), 9 + script_pub_key_length
 
     def to_json(self):
         return {
             'value': self.value,
             'script_pub_key': self.script_pub_key.hex()
         }
-class DomainInput:
+class DomainInput(_Immutable):
+    __slots__ = ('domain_txid', 'output_index', 'script_sig', 'length', '_raw')
+
     def __init__(self, domain_txid, output_index, script_sig):
-        self.domain_txid = domain_txid  # 32 bytes (domain transaction ID)
-        self.output_index = output_index  # 4 bytes (output index)
-        self.script_sig = script_sig  # Variable length (script signature)
-        self.length = 32 + 4 + 1 + len(script_sig)  # Total length of serialized input
+        _set(self, 'domain_txid', domain_txid)  # 32 bytes (domain transaction ID)
+        _set(self, 'output_index', output_index)  # 4 bytes (output index)
+        _set(self, 'script_sig', script_sig)  # Variable length (script signature)
+        _set(self, 'length', 32 + 4 + 1 + len(script_sig))  # Total length of serialized input
+        _set(self, '_raw', None)
+
+    def __reduce__(self):
+        return DomainInput, (self.domain_txid, self.output_index, self.script_sig)
 
     def serialize(self):
-        # Domain Transaction ID (32 bytes)
-        domain_txid_bin = self.domain_txid
-        # Output Index (4 bytes)
-        output_index_bin = struct.pack('>I', self.output_index)
-        # ScriptSig Length (1 byte)
-        script_sig_length_bin = struct.pack('B', len(self.script_sig))
-        # ScriptSig (variable length)
-        return domain_txid_bin + output_index_bin + script_sig_length_bin + self.script_sig
+        if self._raw is None:
+            # Domain TXID (32 bytes), Output Index (4 bytes), ScriptSig Length (1 byte), ScriptSig (variable length)
+            _set(self, '_raw', self.domain_txid + struct.pack('>IB', self.output_index, len(self.script_sig)) + self.script_sig)
+        return self._raw
+
+    def serialize_v2(self):
+        # Domain TXID (32 bytes), Output Index (4 bytes), ScriptSig Length (VarInt), ScriptSig (variable length)
+        return self.domain_txid + struct.pack('>I', self.output_index) + encode_varint(len(self.script_sig)) + self.script_sig
 
     @staticmethod
     def parse(data):
-        domain_txid = data[:32]
-        output_index = struct.unpack('>I', data[32:36])[0]
-        script_sig_length = struct.unpack('B', data[36:37])[0]
-        script_sig = data[37:37+script_sig_length]
-        return DomainInput(domain_txid, output_index, script_sig)
+        return DomainInput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0, v2=False):
+        """
+        Parse a DomainInput at `offset` of a memoryview without slicing the buffer.
+        `v2` selects the VarInt ScriptSig length of version 2 transactions.
+
+        :return: Tuple of (DomainInput, number of bytes consumed)
+        """
+        domain_txid = bytes(view[offset:offset+32])
+        if v2:
+            output_index = struct.unpack_from('>I', view, offset+32)[0]
+            script_sig_length, size = read_varint(view, offset+36)
+            start = offset + 36 + size
+            _check_bounds(view, start + script_sig_length)
+            return DomainInput(domain_txid, output_index, bytes(view[start:start+script_sig_length])), 36 + size + script_sig_length
+        output_index, script_sig_length = struct.unpack_from('>IB', view, offset+32)
+        script_sig = bytes(view[offset+37:offset+37+script_sig_length])
+        _check_bounds(view, offset + 37 + script_sig_length)
+        return DomainInput(domain_txid, output_index, script_sig), 37 + script_sig_length
 
     def to_json(self):
         return {
@@ -88,10 +229,15 @@ class DomainInput:
             'output_index': self.output_index,
             'script_sig': self.script_sig.hex()
         }
-class DomainOutput:
+class DomainOutput(_Immutable):
+    __slots__ = ('new_owner_pub_key_hash', 'length')
+
     def __init__(self, new_owner_pub_key_hash):
-        self.new_owner_pub_key_hash = new_owner_pub_key_hash  # 20 bytes (new owner public key hash)
-        self.length = 20 + 1  # Total length of serialized output
+        _set(self, 'new_owner_pub_key_hash', new_owner_pub_key_hash)  # 20 bytes (new owner public key hash)
+        _set(self, 'length', 20)  # Total length of serialized output
+
+    def __reduce__(self):
+        return DomainOutput, (self.new_owner_pub_key_hash,)
 
     def serialize(self):
         # New Owner Public Key Hash (20 bytes)
@@ -99,24 +245,158 @@ class DomainOutput:
 
     @staticmethod
     def parse(data):
-        new_owner_pub_key_hash = data[:20]
-        return DomainOutput(new_owner_pub_key_hash)
+        return DomainOutput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        Parse a DomainOutput at `offset` of a memoryview without slicing the buffer.
+
+        :return: Tuple of (DomainOutput, number of bytes consumed)
+        """
+        _check_bounds(view, offset + 20)
+        return DomainOutput(bytes(view[offset:offset+20])), 20
 
     def to_json(self):
         return {
             'new_owner_pub_key_hash': self.new_owner_pub_key_hash.hex()
         }
-class Transaction:
+class IPChangeOutput(_Immutable):
+    """
+    Domain output of an IP change transaction (type 3): the new IP of the domain spent by the matching domain input.
+    """
+    __slots__ = ('ip_address', 'length', '_raw')
+
+    def __init__(self, ip_address):
+        packed = ipaddress.ip_address(ip_address).packed
+        _set(self, 'ip_address', str(ipaddress.ip_address(ip_address)))  # IPv4 or IPv6 address
+        _set(self, 'length', 1 + len(packed))  # Total length of serialized output
+        _set(self, '_raw', struct.pack('B', len(packed) == 16) + packed)
+
+    def __reduce__(self):
+        return IPChangeOutput, (self.ip_address,)
+
+    def serialize(self):
+        # IP Version Flag (1 byte, 0 for IPv4 and 1 for IPv6), IP Address (4 or 16 bytes)
+        return self._raw
+
+    @staticmethod
+    def parse(data):
+        return IPChangeOutput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        Parse an IPChangeOutput at `offset` of a memoryview without slicing the buffer.
+
+        :return: Tuple of (IPChangeOutput, number of bytes consumed)
+        """
+        ip_version_flag = struct.unpack_from('B', view, offset)[0]
+        if ip_version_flag > 1:
+            # Only 0 and 1 re-serialize to the same bytes, so any other flag would make the txid malleable
+            raise ValueError("Invalid IP version flag: %d" % ip_version_flag)
+        size = 16 if ip_version_flag else 4
+        _check_bounds(view, offset + 1 + size)
+        return IPChangeOutput(ipaddress.ip_address(bytes(view[offset+1:offset+1+size]))), 1 + size
+
+    def to_json(self):
+        return {
+            'ip_address': self.ip_address
+        }
+class DomainIssueOutput(_Immutable):
+    """
+    Domain output of a domain coinbase transaction (type 4): a newly issued full domain and its owner.
+    """
+    __slots__ = ('full_domain', 'owner_pub_key_hash', 'length', '_raw')
+
+    def __init__(self, full_domain, owner_pub_key_hash):
+        domain_bin = full_domain.serialize()
+        _set(self, 'full_domain', full_domain)  # FullDomain
+        _set(self, 'owner_pub_key_hash', owner_pub_key_hash)  # 20 bytes (owner public key hash)
+        _set(self, 'length', 20 + len(domain_bin))  # Total length of serialized output
+        _set(self, '_raw', owner_pub_key_hash + domain_bin)
+
+    def __reduce__(self):
+        return DomainIssueOutput, (self.full_domain, self.owner_pub_key_hash)
+
+    def serialize(self):
+        # Owner Public Key Hash (20 bytes), Full Domain (55 bytes with IPv4, 67 bytes with IPv6)
+        return self._raw
+
+    @staticmethod
+    def parse(data):
+        return DomainIssueOutput.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        Parse a DomainIssueOutput at `offset` of a memoryview without slicing the buffer.
+
+        :return: Tuple of (DomainIssueOutput, number of bytes consumed)
+        """
+        _check_bounds(view, offset + 20)
+        owner_pub_key_hash = bytes(view[offset:offset+20])
+        full_domain, consumed = FullDomain.parse_from(view, offset + 20)
+        return DomainIssueOutput(full_domain, owner_pub_key_hash), 20 + consumed
+
+    def to_json(self):
+        return {
+            'full_domain': self.full_domain.get_full_domain(),
+            'owner_pub_key_hash': self.owner_pub_key_hash.hex()
+        }
+
+# Domain output class for each transaction type: domain transfer (2), IP change (3) and domain coinbase (4)
+DOMAIN_OUTPUT_TYPES = {2: DomainOutput, 3: IPChangeOutput, 4: DomainIssueOutput}
+
+
+class Transaction(_Immutable):
+    __slots__ = ('tx_type', 'version', 'coin_inputs', 'coin_outputs', 'lock_time',
+                 'domain_inputs', 'domain_outputs', '_raw', '_txid', '_domain_offset')
+
     def __init__(self, tx_type, version, coin_inputs, coin_outputs, lock_time, domain_inputs=None, domain_outputs=None):
-        self.tx_type = tx_type  # 1 byte (transaction type)
-        self.version = version  # 4 bytes (version)
-        self.coin_inputs = coin_inputs  # List of CoinInput objects
-        self.coin_outputs = coin_outputs  # List of CoinOutput objects
-        self.lock_time = lock_time  # 4 bytes (lock time)
-        self.domain_inputs = domain_inputs or []  # List of DomainInput objects (if applicable)
-        self.domain_outputs = domain_outputs or []  # List of DomainOutput objects (if applicable)
+        _set(self, 'tx_type', tx_type)  # 1 byte (transaction type)
+        _set(self, 'version', version)  # 4 bytes (version)
+        _set(self, 'coin_inputs', tuple(coin_inputs))  # Tuple of CoinInput objects
+        _set(self, 'coin_outputs', tuple(coin_outputs))  # Tuple of CoinOutput objects
+        _set(self, 'lock_time', lock_time)  # 4 bytes (lock time)
+        _set(self, 'domain_inputs', tuple(domain_inputs or ()))  # Tuple of DomainInput objects (if applicable)
+        _set(self, 'domain_outputs', tuple(domain_outputs or ()))  # Tuple of DomainOutput, IPChangeOutput or DomainIssueOutput objects (if applicable)
+        _set(self, '_raw', None)  # Cached wire bytes, kept from parse or filled by the first serialize()
+        _set(self, '_txid', None)
+        _set(self, '_domain_offset', None)
+
+    def __reduce__(self):
+        return Transaction, (self.tx_type, self.version, self.coin_inputs, self.coin_outputs,
+                             self.lock_time, self.domain_inputs, self.domain_outputs)
+
+    @property
+    def txid(self):
+        """
+        Transaction ID: SHA-256 of the serialized transaction, computed once.
+        """
+        if self._txid is None:
+            _set(self, '_txid', hashlib.sha256(self.serialize()).digest())
+        return self._txid
+
+    hash = txid
+
+    def to_builder(self):
+        """
+        Return a TransactionBuilder pre-filled with this transaction's fields.
+        """
+        return TransactionBuilder.from_transaction(self)
 
     def serialize(self):
+        if self._raw is None:
+            _set(self, '_raw', self._serialize())
+        return self._raw
+
+    def _serialize(self):
+        if self.version >= WIRE_V2_VERSION:
+            return self._serialize_v2()
+        counts = [len(self.coin_inputs), len(self.coin_outputs), len(self.domain_inputs), len(self.domain_outputs)]
+        if max(counts) > 255:
+            raise ValueError("Version 1 transactions hold at most 255 inputs and outputs of each kind; use version 2")
         # Version (4 bytes)
         version_bin = struct.pack('>I', self.version)
         # Transaction Type (1 byte)
@@ -136,62 +416,151 @@ class Transaction:
         domain_inputs_bin = b''
         if self.tx_type == 2 or self.tx_type == 3:
             domain_input_count_bin = struct.pack('B', len(self.domain_inputs))
-            domain_inputs_bin = b''.join(di.serialize() for di in self.domain_inputs)
+            domain_inputs_bin = domain_input_count_bin + b''.join(di.serialize() for di in self.domain_inputs)
         
         # Domain Outputs (if applicable)
         domain_outputs_bin = b''
-        if self.tx_type == 2:
+        if self.tx_type in DOMAIN_OUTPUT_TYPES:
             domain_output_count_bin = struct.pack('B', len(self.domain_outputs))
-            domain_outputs_bin = b''.join(do.serialize() for do in self.domain_outputs)
+            domain_outputs_bin = domain_output_count_bin + b''.join(do.serialize() for do in self.domain_outputs)
         
         # Combine all parts
         return version_bin + tx_type_bin + coin_input_count_bin + coin_inputs_bin + coin_output_count_bin + coin_outputs_bin + lock_time_bin + domain_inputs_bin + domain_outputs_bin
 
+    def _serialize_v2(self):
+        # Version (4 bytes), Transaction Type (1 byte), Coin Inputs Count (VarInt), Coin Inputs (variable length),
+        # Coin Outputs Count (VarInt), Coin Outputs (variable length), Lock Time (4 bytes)
+        parts = [struct.pack('>IB', self.version, self.tx_type), encode_varint(len(self.coin_inputs))]
+        parts.extend(i.serialize_v2() for i in self.coin_inputs)
+        parts.append(encode_varint(len(self.coin_outputs)))
+        parts.extend(o.serialize_v2() for o in self.coin_outputs)
+        parts.append(struct.pack('>I', self.lock_time))
+        if self.tx_type == 2 or self.tx_type == 3:
+            # Domain Inputs Count (VarInt), Domain Inputs (variable length)
+            parts.append(encode_varint(len(self.domain_inputs)))
+            parts.extend(di.serialize_v2() for di in self.domain_inputs)
+        if self.tx_type in DOMAIN_OUTPUT_TYPES:
+            # Domain Outputs Count (VarInt), Domain Outputs (variable length)
+            parts.append(encode_varint(len(self.domain_outputs)))
+            parts.extend(do.serialize() for do in self.domain_outputs)
+        return b''.join(parts)
+
+    @property
+    def domain_offset(self):
+        """
+        Position of the domain section (the Domain Inputs Count, or the Domain
+        Outputs Count of a domain coinbase) within the serialized transaction, or
+        None for coin transactions.
+        """
+        if self.tx_type not in DOMAIN_OUTPUT_TYPES:
+            return None
+        if self._domain_offset is None:
+            if self.version >= WIRE_V2_VERSION:
+                size = (5 + varint_size(len(self.coin_inputs)) + varint_size(len(self.coin_outputs)) + 4
+                        + sum(len(i.serialize_v2()) for i in self.coin_inputs)
+                        + sum(len(o.serialize_v2()) for o in self.coin_outputs))
+            else:
+                size = 5 + 1 + 1 + 4 + sum(i.length for i in self.coin_inputs) + sum(o.length for o in self.coin_outputs)
+            _set(self, '_domain_offset', size)
+        return self._domain_offset
+
     @staticmethod
     def parse(data):
-        offset = 0
-        
-        # Version (4 bytes)
-        version = struct.unpack('>I', data[offset:offset+4])[0]
-        offset += 4
-        
-        # Transaction Type (1 byte)
-        tx_type = struct.unpack('B', data[offset:offset+1])[0]
-        offset += 1
-        
-        # Coin Inputs Count (1 byte)
-        coin_input_count = struct.unpack('B', data[offset:offset+1])[0]
-        offset += 1
-        coin_inputs = [CoinInput.parse(data[offset:])]
-        offset += coin_inputs[0].length
-        
-        # Coin Outputs Count (1 byte)
-        coin_output_count = struct.unpack('B', data[offset:offset+1])[0]
-        offset += 1
-        coin_outputs = [CoinOutput.parse(data[offset:])]
-        offset += coin_outputs[0].length
+        return Transaction.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        Parse a transaction at `offset` of a memoryview, walking a single cursor
+        over the buffer instead of slicing the remainder for every field.
+        Version 1 and version 2 encodings are both accepted.
+
+        :param view: memoryview (or any buffer) holding the serialized transaction.
+        :param offset: Position of the first byte of the transaction.
+        :return: Tuple of (Transaction, number of bytes consumed)
+        """
+        start = offset
+
+        # Version (4 bytes), Transaction Type (1 byte)
+        version, tx_type = struct.unpack_from('>IB', view, offset)
+        v2 = version >= WIRE_V2_VERSION
+        offset += 5
+
+        # Coin Inputs Count (1 byte, VarInt in version 2)
+        if v2:
+            coin_input_count, size = read_varint(view, offset)
+        else:
+            coin_input_count, size = struct.unpack_from('B', view, offset)[0], 1
+        offset += size
+        coin_inputs = []
+        for _ in range(coin_input_count):
+            coin_input, consumed = CoinInput.parse_from(view, offset, v2)
+            coin_inputs.append(coin_input)
+            offset += consumed
+
+        # Coin Outputs Count (1 byte, VarInt in version 2)
+        if v2:
+            coin_output_count, size = read_varint(view, offset)
+        else:
+            coin_output_count, size = struct.unpack_from('B', view, offset)[0], 1
+        offset += size
+        coin_outputs = []
+        for _ in range(coin_output_count):
+            coin_output, consumed = CoinOutput.parse_from(view, offset, v2)
+            coin_outputs.append(coin_output)
+            offset += consumed
 
         # Lock Time (4 bytes)
-        lock_time = struct.unpack('>I', data[offset:offset+4])[0]
+        lock_time = struct.unpack_from('>I', view, offset)[0]
         offset += 4
-        
+
+        domain_offset = offset - start
+        domain_inputs, domain_outputs, consumed = Transaction.parse_domain_section(view, offset, tx_type, version)
+        offset += consumed
+
+        tx = Transaction(tx_type, version, coin_inputs, coin_outputs, lock_time, domain_inputs, domain_outputs)
+        _set(tx, '_raw', bytes(view[start:offset]))
+        _set(tx, '_domain_offset', domain_offset)
+        return tx, offset - start
+
+    @staticmethod
+    def parse_domain_section(view, offset, tx_type, version):
+        """
+        Parse only the domain inputs and outputs of a transaction, starting at its
+        domain section (see `domain_offset`), so a domain index can read them
+        without decoding the coin inputs and outputs in front.
+
+        :return: Tuple of (domain inputs, domain outputs, number of bytes consumed)
+        """
+        start = offset
+        v2 = version >= WIRE_V2_VERSION
         domain_inputs = []
         domain_outputs = []
         if tx_type == 2 or tx_type == 3:
-            # Domain Inputs Count (1 byte)
-            domain_input_count = struct.unpack('B', data[offset:offset+1])[0]
-            offset += 1
-            domain_inputs = [DomainInput.parse(data[offset:])]
-            offset += domain_inputs[0].length
-        
-        if tx_type == 2:
-            # Domain Outputs Count (1 byte)
-            domain_output_count = struct.unpack('B', data[offset:offset+1])[0]
-            offset += 1
-            domain_outputs = [DomainOutput.parse(data[offset:])]
-            offset += domain_outputs[0].length
-        
-        return Transaction(tx_type, version, coin_inputs, coin_outputs, lock_time, domain_inputs, domain_outputs)
+            # Domain Inputs Count (1 byte, VarInt in version 2)
+            if v2:
+                domain_input_count, size = read_varint(view, offset)
+            else:
+                domain_input_count, size = struct.unpack_from('B', view, offset)[0], 1
+            offset += size
+            for _ in range(domain_input_count):
+                domain_input, consumed = DomainInput.parse_from(view, offset, v2)
+                domain_inputs.append(domain_input)
+                offset += consumed
+
+        if tx_type in DOMAIN_OUTPUT_TYPES:
+            # Domain Outputs Count (1 byte, VarInt in version 2)
+            domain_output_class = DOMAIN_OUTPUT_TYPES[tx_type]
+            if v2:
+                domain_output_count, size = read_varint(view, offset)
+            else:
+                domain_output_count, size = struct.unpack_from('B', view, offset)[0], 1
+            offset += size
+            for _ in range(domain_output_count):
+                domain_output, consumed = domain_output_class.parse_from(view, offset)
+                domain_outputs.append(domain_output)
+                offset += consumed
+        return domain_inputs, domain_outputs, offset - start
 
     def to_json(self):
         return {
@@ -203,8 +572,60 @@ class Transaction:
             'domain_inputs': [di.to_json() for di in self.domain_inputs],
             'domain_outputs': [do.to_json() for do in self.domain_outputs]
         }
-    
-    
+
+
+class TransactionBuilder:
+    """
+    Mutable counterpart of Transaction. Every build() returns a new Transaction,
+    so cached serializations and txids never describe stale contents.
+    """
+    def __init__(self, tx_type=1, version=1, lock_time=0):
+        self.tx_type = tx_type
+        self.version = version
+        self.lock_time = lock_time
+        self.coin_inputs = []
+        self.coin_outputs = []
+        self.domain_inputs = []
+        self.domain_outputs = []
+
+    @staticmethod
+    def from_transaction(tx):
+        builder = TransactionBuilder(tx.tx_type, tx.version, tx.lock_time)
+        builder.coin_inputs = list(tx.coin_inputs)
+        builder.coin_outputs = list(tx.coin_outputs)
+        builder.domain_inputs = list(tx.domain_inputs)
+        builder.domain_outputs = list(tx.domain_outputs)
+        return builder
+
+    def add_coin_input(self, txid, output_index, script_sig):
+        self.coin_inputs.append(CoinInput(txid, output_index, script_sig))
+        return self
+
+    def add_coin_output(self, value, script_pub_key):
+        self.coin_outputs.append(CoinOutput(value, script_pub_key))
+        return self
+
+    def add_domain_input(self, domain_txid, output_index, script_sig):
+        self.domain_inputs.append(DomainInput(domain_txid, output_index, script_sig))
+        return self
+
+    def add_domain_output(self, new_owner_pub_key_hash):
+        self.domain_outputs.append(DomainOutput(new_owner_pub_key_hash))
+        return self
+
+    def add_ip_change_output(self, ip_address):
+        self.domain_outputs.append(IPChangeOutput(ip_address))
+        return self
+
+    def add_domain_issue_output(self, full_domain, owner_pub_key_hash):
+        self.domain_outputs.append(DomainIssueOutput(full_domain, owner_pub_key_hash))
+        return self
+
+    def build(self):
+        return Transaction(self.tx_type, self.version, self.coin_inputs, self.coin_outputs,
+                           self.lock_time, self.domain_inputs, self.domain_outputs)
+
+
 class CoinbaseTransaction:
     def __init__(self, version, outputs, lock_time):
         self.version = version  # 4 bytes (version)
@@ -1,9 +1,11 @@
 import hashlib
-import ecdsa
-import base58
-import os
-from script import *
-from transaction import *
+
+from .script import Script, SigHashCache
+from .transaction import TransactionBuilder
+from .coin_selection import select_coins
+
+# ecdsa and base58 are imported where keys and addresses are first used, so
+# importing the wallet (e.g. for a CLI command that never signs) stays cheap
 
 class Wallet:
     def __init__(self):
@@ -16,6 +18,7 @@ class Wallet:
         Generate a keypair from a given seed string by hashing it with SHA-256
         and using the 256-bit hash as the private key.
         """
+        import ecdsa
         # Hash the seed string with SHA-256
         seed_hash = hashlib.sha256(seed_string.encode('utf-8')).digest()
         # Use the hash as the private key
@@ -33,6 +36,7 @@ class Wallet:
         """
         Generate a random keypair.
         """
+        import ecdsa
         priv_key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
         pub_key = priv_key.get_verifying_key()
         self.private_key = priv_key
@@ -44,6 +48,7 @@ class Wallet:
         """
         Convert a public key to a Base58Check encoded address.
         """
+        import base58
         pub_key_bytes = pub_key.to_string()
         sha256 = hashlib.sha256(pub_key_bytes).digest()
         ripemd160 = hashlib.new('ripemd160', sha256).digest()
@@ -56,19 +61,22 @@ class Wallet:
         """
         Convert a Base58Check encoded address to a public key hash.
         """
+        import base58
         decoded = base58.b58decode_check(address)
         pubkey_hash = decoded[1:]
         return pubkey_hash
     def sign_message(self, message: bytes) -> bytes:
         """
         Sign a message using the private key associated with this wallet.
+        The nonce is derived from the key and message (RFC 6979), so the same
+        message always gets the same signature.
         
         :param message: The message to sign, typically a byte representation of the transaction hash.
         :return: The signature of the message.
         """
         if not self.private_key:
             raise ValueError("No private key set for signing")
-        return self.private_key.sign(message, hashfunc=hashlib.sha256)
+        return self.private_key.sign_deterministic(message, hashfunc=hashlib.sha256)
     
     def createSpendingTransaction(self, prev_tx: 'Transaction', prev_output_index: int, value: int, to_address: str) -> 'Transaction':
         """
@@ -80,27 +88,72 @@ class Wallet:
         :param to_address: The address of the recipient.
         :return: A new transaction that spends from the previous transaction to the new address.
         """
-        # Create input
-        txid = hashlib.sha256(prev_tx.serialize()).digest() # Acts as the message that has to be signed in order to make a valid ScripSig
-        signature = self.sign_message(txid)  # Use the wallet's private key to sign the transaction hash
-        scriptSig = Script.createP2PKH_ScriptSig(signature,self.public_key)
-        coin_input = CoinInput(txid, prev_output_index, scriptSig)
-
-        # Create output
+        # Build the unsigned transaction, then sign it (ScriptSigs are not part of the signature hash)
+        spent_output = prev_tx.coin_outputs[prev_output_index]
         to_public_key_hash = self.address_to_pubkey_hash(to_address)
         scriptPubKey = Script.createP2PKH_ScriptPubKey(to_public_key_hash)
-        coin_output = CoinOutput(value, scriptPubKey)
-
-        # Create transaction
-        tx = Transaction(
-            tx_type=1,  # Regular transaction
-            version=1,
-            coin_inputs=[coin_input],
-            coin_outputs=[coin_output],
-            lock_time=0
-        )
-
-        return tx
+        tx = (TransactionBuilder(tx_type=1)  # Regular transaction
+              .add_coin_input(prev_tx.txid, prev_output_index, b'')
+              .add_coin_output(value, scriptPubKey)
+              .build())
+        return self.sign_transaction(tx, [spent_output])
+
+    def create_transaction(self, wallet_index, payments, fee_rate=1):
+        """
+        Create a transaction paying several addresses from the coins of this
+        wallet's key in a WalletIndex, with change back to the same key. The
+        coins spent are locked in the index until the block that spends them
+        is connected, so the next transaction does not pick them again.
+
+        :param wallet_index: WalletIndex tracking this wallet's P2PKH script.
+        :param payments: List of (address, value).
+        :param fee_rate: Fee per serialized byte.
+        :return: The signed Transaction and its SelectionResult.
+        """
+        if not payments:
+            raise ValueError("No payments")
+        script_pub_key = Script.createP2PKH_ScriptPubKey(self.address_to_pubkey_hash(self.address))
+        if not wallet_index.is_mine(script_pub_key):
+            raise ValueError("Wallet index does not track this wallet's script")
+        selection = select_coins(wallet_index.spendable_coins(script_pub_key), sum(value for _, value in payments),
+                                 fee_rate, len(payments))
+        builder = TransactionBuilder(tx_type=1)
+        for coin in selection.coins:
+            builder.add_coin_input(coin.txid, coin.output_index, b'')
+        for address, value in payments:
+            builder.add_coin_output(value, Script.createP2PKH_ScriptPubKey(self.address_to_pubkey_hash(address)))
+        if selection.change:
+            builder.add_coin_output(selection.change, script_pub_key)
+        tx = self.sign_transaction(builder.build(), [coin.output for coin in selection.coins])
+        wallet_index.lock(coin.outpoint for coin in selection.coins)
+        return tx, selection
+
+    def sign_transaction(self, transaction, spent_outputs):
+        """
+        Sign every coin and domain input of a transaction with this wallet's key.
+        The signature hashes of all inputs share one SigHashCache, so signing
+        costs the same per input however large the transaction is.
+
+        :param transaction: Transaction whose inputs are signed (existing ScriptSigs are replaced).
+        :param spent_outputs: The CoinOutput spent by each coin input, in input order.
+        :return: A new Transaction with the ScriptSigs filled in.
+        """
+        if len(spent_outputs) != len(transaction.coin_inputs):
+            raise ValueError("Expected one spent output per coin input")
+        sighash_cache = SigHashCache(transaction)
+        builder = transaction.to_builder()
+        builder.coin_inputs = []
+        for input_index, (coin_input, spent_output) in enumerate(zip(transaction.coin_inputs, spent_outputs)):
+            message_hash = sighash_cache.coin_input_hash(input_index, spent_output.script_pub_key, spent_output.value)
+            scriptSig = Script.createP2PKH_ScriptSig(self.sign_message(message_hash), self.public_key)
+            builder.add_coin_input(coin_input.txid, coin_input.output_index, scriptSig)
+        owner_pub_key_hash = self.address_to_pubkey_hash(self.address)
+        builder.domain_inputs = []
+        for input_index, domain_input in enumerate(transaction.domain_inputs):
+            message_hash = sighash_cache.domain_input_hash(input_index, owner_pub_key_hash)
+            scriptSig = Script.createP2PKH_ScriptSig(self.sign_message(message_hash), self.public_key)
+            builder.add_domain_input(domain_input.domain_txid, domain_input.output_index, scriptSig)
+        return builder.build()
 
     def to_json(self):
         """
@@ -0,0 +1,328 @@
+# Wallet index of owned coins and domains
+import struct
+from collections import OrderedDict
+
+from .domain import FullDomain
+
+COINBASE = 0
+DOMAIN_TRANSFER = 2
+IP_CHANGE = 3
+DOMAIN_COINBASE = 4
+
+P2PKH_PREFIX = b'\x76\xa9\x14'  # OP_DUP OP_HASH160 <20 bytes>
+P2PKH_SUFFIX = b'\x88\xac'  # OP_EQUALVERIFY OP_CHECKSIG
+
+DEFAULT_UNDO_BLOCKS = 288  # Blocks that can be disconnected again, about two days at 10 minutes
+
+
+def p2pkh_hash(script_pub_key):
+    if (len(script_pub_key) == 25 and script_pub_key[:3] == P2PKH_PREFIX and
+            script_pub_key[23:] == P2PKH_SUFFIX):
+        return bytes(script_pub_key[3:23])
+    return None
+
+
+class OwnedCoin:
+    """
+    An unspent coin output paying one of the wallet's scripts.
+    """
+    __slots__ = ('txid', 'output_index', 'output', 'height', 'is_coinbase')
+
+    def __init__(self, txid, output_index, output, height, is_coinbase=False):
+        self.txid = txid
+        self.output_index = output_index
+        self.output = output  # CoinOutput
+        self.height = height
+        self.is_coinbase = is_coinbase
+
+    @property
+    def outpoint(self):
+        return (self.txid, self.output_index)
+
+    @property
+    def value(self):
+        return self.output.value
+
+    @property
+    def script_pub_key(self):
+        return self.output.script_pub_key
+
+    def to_json(self):
+        return {
+            'txid': self.txid.hex(),
+            'output_index': self.output_index,
+            'value': self.value,
+            'script_pub_key': self.script_pub_key.hex(),
+            'height': self.height,
+            'is_coinbase': self.is_coinbase
+        }
+
+
+class OwnedDomain:
+    """
+    A domain output owned by one of the wallet's keys. The FullDomain is None
+    when a domain was transferred to the wallet and no domain lookup was given
+    to resolve its name.
+    """
+    __slots__ = ('txid', 'output_index', 'full_domain', 'owner_pub_key_hash', 'height')
+
+    def __init__(self, txid, output_index, full_domain, owner_pub_key_hash, height):
+        self.txid = txid
+        self.output_index = output_index
+        self.full_domain = full_domain
+        self.owner_pub_key_hash = owner_pub_key_hash
+        self.height = height
+
+    @property
+    def outpoint(self):
+        return (self.txid, self.output_index)
+
+    def to_json(self):
+        return {
+            'txid': self.txid.hex(),
+            'output_index': self.output_index,
+            'domain': self.full_domain.get_full_domain() if self.full_domain is not None else None,
+            'owner_pub_key_hash': self.owner_pub_key_hash.hex(),
+            'height': self.height
+        }
+
+
+class _BlockUndo:
+    __slots__ = ('spent_coins', 'spent_domains', 'created_coins', 'created_domains')
+
+    def __init__(self):
+        self.spent_coins = []  # OwnedCoin spent by the block
+        self.spent_domains = []  # OwnedDomain spent by the block
+        self.created_coins = []  # Outpoints of OwnedCoin created by the block
+        self.created_domains = []  # Outpoints of OwnedDomain created by the block
+
+
+class WalletIndex:
+    """
+    The coin outputs and domains owned by a set of P2PKH scripts (as built by
+    Script.createP2PKH_ScriptPubKey), kept up to date as blocks are connected
+    and disconnected. Balances are running totals, so reading them is O(1).
+
+    Only this wallet's outputs are remembered, with what each block changed
+    for the last `undo_blocks` blocks so they can be disconnected again.
+    Coins picked for a transaction that has not confirmed yet can be locked so
+    coin selection does not pick them twice.
+
+    :param scripts: P2PKH ScriptPubKeys to track.
+    :param domain_lookup: Optional callable (txid, output_index) -> record with
+                          a full_domain attribute (e.g. DomainIndex.get_by_outpoint),
+                          used to name domains transferred to the wallet.
+    """
+    def __init__(self, scripts=(), domain_lookup=None, undo_blocks=DEFAULT_UNDO_BLOCKS):
+        self.scripts = {}  # ScriptPubKey -> public key hash
+        self.owners = {}  # Public key hash -> ScriptPubKey
+        self.coins = {}  # (txid, index) -> OwnedCoin
+        self.domains = {}  # (txid, index) -> OwnedDomain
+        self.balances = {}  # ScriptPubKey -> confirmed balance
+        self.balance = 0
+        self.locked = set()  # Outpoints reserved by unconfirmed transactions
+        self.domain_lookup = domain_lookup
+        self.undo_blocks = undo_blocks
+        self._undo = OrderedDict()  # Block hash -> _BlockUndo
+        self.best_block = None
+        self.height = -1
+        for script_pub_key in scripts:
+            self.add_script(script_pub_key)
+
+    def add_script(self, script_pub_key):
+        """
+        Track a P2PKH script. Outputs it received in blocks connected earlier
+        are not found; rescan those blocks to pick them up.
+        """
+        owner = p2pkh_hash(script_pub_key)
+        if owner is None:
+            raise ValueError("Only P2PKH scripts can be tracked")
+        script_pub_key = bytes(script_pub_key)
+        self.scripts[script_pub_key] = owner
+        self.owners[owner] = script_pub_key
+        self.balances.setdefault(script_pub_key, 0)
+
+    def is_mine(self, script_pub_key):
+        return script_pub_key in self.scripts
+
+    def get_balance(self, script_pub_key=None):
+        """
+        Confirmed balance of one script, or of the whole wallet.
+        """
+        if script_pub_key is None:
+            return self.balance
+        return self.balances.get(script_pub_key, 0)
+
+    def get_spendable_balance(self):
+        return self.balance - sum(self.coins[outpoint].value for outpoint in self.locked if outpoint in self.coins)
+
+    def spendable_coins(self, script_pub_key=None):
+        """
+        Unlocked coins, of one script or of the whole wallet.
+        """
+        return [coin for outpoint, coin in self.coins.items()
+                if outpoint not in self.locked and (script_pub_key is None or coin.script_pub_key == script_pub_key)]
+
+    def filter_elements(self):
+        """
+        What to test block filters against: the wallet's scripts (which also
+        match domains issued or transferred to its keys) and the outpoints of
+        its coins and domains, to find the blocks spending them.
+        """
+        elements = list(self.scripts)
+        elements.extend(txid + struct.pack('>I', output_index) for txid, output_index in self.coins)
+        elements.extend(txid + struct.pack('>I', output_index) for txid, output_index in self.domains)
+        return elements
+
+    def get_domains(self, owner_pub_key_hash=None):
+        return [domain for domain in self.domains.values()
+                if owner_pub_key_hash is None or domain.owner_pub_key_hash == owner_pub_key_hash]
+
+    def find_domain(self, domain_name, tld):
+        for domain in self.domains.values():
+            if (domain.full_domain is not None and domain.full_domain.domain_name == domain_name.lower() and
+                    domain.full_domain.tld == tld.lower()):
+                return domain
+        return None
+
+    def lock(self, outpoints):
+        self.locked.update(outpoints)
+
+    def unlock(self, outpoints):
+        self.locked.difference_update(outpoints)
+
+    # Updates
+
+    def _add_coin(self, coin):
+        self.coins[coin.outpoint] = coin
+        self.balances[coin.script_pub_key] += coin.value
+        self.balance += coin.value
+
+    def _remove_coin(self, outpoint):
+        coin = self.coins.pop(outpoint)
+        self.balances[coin.script_pub_key] -= coin.value
+        self.balance -= coin.value
+        self.locked.discard(outpoint)
+        return coin
+
+    def connect_block(self, block, height, block_hash=None):
+        """
+        Apply a block: remove the wallet's coins and domains it spends and add
+        the outputs it pays to the wallet's scripts.
+
+        :return: Number of the wallet's coins and domains the block spent or created.
+        """
+        block_hash = block_hash or block.header_hash()
+        undo = _BlockUndo()
+        for tx in block.transactions:
+            txid = tx.txid
+            if tx.tx_type != COINBASE:
+                for coin_input in tx.coin_inputs:
+                    outpoint = (coin_input.txid, coin_input.output_index)
+                    if outpoint in self.coins:
+                        undo.spent_coins.append(self._remove_coin(outpoint))
+            for index, output in enumerate(tx.coin_outputs):
+                if output.script_pub_key in self.scripts:
+                    coin = OwnedCoin(txid, index, output, height, tx.tx_type == COINBASE)
+                    self._add_coin(coin)
+                    undo.created_coins.append(coin.outpoint)
+            if tx.domain_outputs:
+                self._connect_domains(tx, height, undo)
+        self._undo[block_hash] = undo
+        while len(self._undo) > self.undo_blocks:
+            self._undo.popitem(last=False)
+        self.best_block = block_hash
+        self.height = height
+        return (len(undo.spent_coins) + len(undo.created_coins) +
+                len(undo.spent_domains) + len(undo.created_domains))
+
+    def _connect_domains(self, tx, height, undo):
+        txid = tx.txid
+        if tx.tx_type == DOMAIN_COINBASE:
+            for index, output in enumerate(tx.domain_outputs):
+                if output.owner_pub_key_hash in self.owners:
+                    domain = OwnedDomain(txid, index, output.full_domain, output.owner_pub_key_hash, height)
+                    self.domains[domain.outpoint] = domain
+                    undo.created_domains.append(domain.outpoint)
+            return
+        # Domain input i moves its domain to domain output i
+        for index, (domain_input, output) in enumerate(zip(tx.domain_inputs, tx.domain_outputs)):
+            previous = self.domains.pop((domain_input.domain_txid, domain_input.output_index), None)
+            if previous is not None:
+                undo.spent_domains.append(previous)
+            if tx.tx_type == DOMAIN_TRANSFER:
+                owner = output.new_owner_pub_key_hash
+                full_domain = previous.full_domain if previous is not None else None
+            elif tx.tx_type == IP_CHANGE and previous is not None:
+                owner = previous.owner_pub_key_hash
+                full_domain = previous.full_domain
+                if full_domain is not None:
+                    full_domain = FullDomain(full_domain.domain_name, full_domain.tld, output.ip_address)
+            else:
+                continue
+            if owner not in self.owners:
+                continue
+            if full_domain is None and self.domain_lookup is not None:
+                record = self.domain_lookup(txid, index)
+                full_domain = record.full_domain if record is not None else None
+            domain = OwnedDomain(txid, index, full_domain, owner, height)
+            self.domains[domain.outpoint] = domain
+            undo.created_domains.append(domain.outpoint)
+
+    def skip_block(self, block_hash, height):
+        """
+        Advance past a block known not to touch the wallet, e.g. because its
+        filter did not match, without reading it.
+        """
+        self._undo[block_hash] = _BlockUndo()
+        while len(self._undo) > self.undo_blocks:
+            self._undo.popitem(last=False)
+        self.best_block = block_hash
+        self.height = height
+
+    def disconnect_block(self, block, block_hash=None):
+        """
+        Undo the most recently connected block.
+
+        :raises ValueError: If the block is not the tip or is too old to undo.
+        """
+        block_hash = block_hash or block.header_hash()
+        if block_hash != self.best_block:
+            raise ValueError("Block %s is not the wallet's tip" % block_hash.hex())
+        undo = self._undo.pop(block_hash, None)
+        if undo is None:
+            raise ValueError("No undo data for block %s; rescan the wallet" % block_hash.hex())
+        # Restore what was spent first: outputs created and spent within the block are then removed again
+        for domain in undo.spent_domains:
+            self.domains[domain.outpoint] = domain
+        for outpoint in undo.created_domains:
+            del self.domains[outpoint]
+        for coin in undo.spent_coins:
+            self._add_coin(coin)
+        for outpoint in undo.created_coins:
+            self._remove_coin(outpoint)
+        self.best_block = block.previous_hash
+        self.height -= 1
+
+    def clear(self):
+        """
+        Forget every coin, domain and connected block but keep the scripts and
+        locks, e.g. before rescanning after importing a key.
+        """
+        self.coins.clear()
+        self.domains.clear()
+        self.balances = dict.fromkeys(self.scripts, 0)
+        self.balance = 0
+        self._undo.clear()
+        self.best_block = None
+        self.height = -1
+
+    def to_json(self):
+        return {
+            'best_block': self.best_block.hex() if self.best_block is not None else None,
+            'height': self.height,
+            'balance': self.balance,
+            'coins': len(self.coins),
+            'locked': len(self.locked),
+            'domains': [domain.to_json() for domain in self.domains.values()]
+        }
@@ -1 +1,198 @@
-# Merkle tree implementation 
+# Merkle tree implementation
+import hashlib
+import struct
+
+HASH_SIZE = 32
+
+
+def double_sha256(data):
+    """
+    Hash data with SHA-256 twice.
+    """
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash_leaves(items):
+    """
+    Hash a batch of serialized items (e.g. transactions) into leaves with one
+    SHA-256 each, the same hash used for transaction IDs.
+
+    :return: The leaf hashes concatenated into one bytes buffer.
+    """
+    sha256 = hashlib.sha256
+    return b''.join([sha256(item).digest() for item in items])
+
+
+def _hash_level(level):
+    """
+    Compute the parent level of a level held in a contiguous buffer of 32-byte hashes.
+    An odd last node is paired with itself.
+    """
+    if len(level) // HASH_SIZE % 2:
+        level = bytes(level) + bytes(level[-HASH_SIZE:])
+    sha256 = hashlib.sha256
+    view = memoryview(level)
+    return bytearray(b''.join([sha256(sha256(view[i:i+2*HASH_SIZE]).digest()).digest()
+                               for i in range(0, len(view), 2 * HASH_SIZE)]))
+
+
+class MerkleTree:
+    """
+    Merkle tree whose levels are each stored in one contiguous bytearray of
+    32-byte hashes (level 0 holds the leaves). Appending or updating a leaf only
+    rehashes the path from that leaf to the root, so a block template can grow
+    one transaction at a time in O(log n).
+
+    A level with an odd number of nodes pairs its last node with itself, and a
+    single leaf is its own root, matching Block.calculateMerkleRoot.
+    """
+    def __init__(self):
+        self._levels = [bytearray()]
+
+    @staticmethod
+    def from_leaves(leaves):
+        """
+        Build a tree from an iterable of 32-byte leaf hashes, hashing one whole level per pass.
+        """
+        tree = MerkleTree()
+        tree._levels = [bytearray(b''.join(leaves))]
+        while len(tree._levels[-1]) > HASH_SIZE:
+            tree._levels.append(_hash_level(tree._levels[-1]))
+        return tree
+
+    @staticmethod
+    def from_transactions(transactions):
+        """
+        Build a tree whose leaves are the IDs of the given transactions.
+        """
+        return MerkleTree.from_leaves(tx.txid for tx in transactions)
+
+    def __len__(self):
+        return len(self._levels[0]) // HASH_SIZE
+
+    def _count(self, depth):
+        return len(self._levels[depth]) // HASH_SIZE
+
+    def _node(self, depth, index):
+        level = self._levels[depth]
+        return bytes(level[index*HASH_SIZE:(index+1)*HASH_SIZE])
+
+    def leaf(self, index):
+        return self._node(0, index)
+
+    def root(self):
+        """
+        Return the Merkle root (32 zero bytes for an empty tree).
+        """
+        if not self._levels[0]:
+            return b'\x00' * HASH_SIZE
+        return self._node(len(self._levels) - 1, 0)
+
+    def append(self, leaf):
+        """
+        Append a 32-byte leaf hash and rehash its path to the root.
+
+        :return: The index of the new leaf.
+        """
+        if len(leaf) != HASH_SIZE:
+            raise ValueError("Leaf hash must be 32 bytes long")
+        self._levels[0] += leaf
+        index = len(self) - 1
+        self._update_path(index)
+        return index
+
+    def update(self, index, leaf):
+        """
+        Replace the leaf at `index` and rehash its path to the root.
+        """
+        if len(leaf) != HASH_SIZE:
+            raise ValueError("Leaf hash must be 32 bytes long")
+        if not 0 <= index < len(self):
+            raise IndexError("Leaf index out of range")
+        self._levels[0][index*HASH_SIZE:(index+1)*HASH_SIZE] = leaf
+        self._update_path(index)
+
+    def _update_path(self, index):
+        depth = 0
+        while self._count(depth) > 1:
+            count = self._count(depth)
+            parent = index // 2
+            left = self._node(depth, 2 * parent)
+            right = self._node(depth, 2 * parent + 1) if 2 * parent + 1 < count else left
+            parent_hash = double_sha256(left + right)
+
+            if depth + 1 == len(self._levels):
+                self._levels.append(bytearray())
+            upper = self._levels[depth + 1]
+            if parent == len(upper) // HASH_SIZE:
+                upper += parent_hash
+            else:
+                upper[parent*HASH_SIZE:(parent+1)*HASH_SIZE] = parent_hash
+            index = parent
+            depth += 1
+
+    def get_proof(self, index):
+        """
+        Build an inclusion proof for the leaf at `index`.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("Leaf index out of range")
+        siblings = []
+        position = index
+        for depth in range(len(self._levels) - 1):
+            sibling = position ^ 1
+            if sibling >= self._count(depth):
+                sibling = position
+            siblings.append(self._node(depth, sibling))
+            position //= 2
+        return MerkleProof(index, self.leaf(index), siblings)
+
+
+class MerkleProof:
+    """
+    Inclusion proof of one leaf: its index, the leaf hash and the sibling hashes
+    from the leaf level up to (but excluding) the root.
+    """
+    def __init__(self, index, leaf, siblings):
+        self.index = index  # 4 bytes (leaf position in the block)
+        self.leaf = leaf  # 32 bytes (leaf hash, the transaction ID)
+        self.siblings = siblings  # List of 32-byte sibling hashes
+
+    def compute_root(self):
+        node = self.leaf
+        position = self.index
+        for sibling in self.siblings:
+            if position & 1:
+                node = double_sha256(sibling + node)
+            else:
+                node = double_sha256(node + sibling)
+            position >>= 1
+        return node
+
+    def verify(self, root):
+        """
+        Check that the proof connects the leaf to the given Merkle root.
+        """
+        return self.compute_root() == root
+
+    def serialize(self):
+        # Index (4 bytes), Leaf (32 bytes), Sibling Count (1 byte), Siblings (32 bytes each)
+        return (struct.pack('>I', self.index) + self.leaf +
+                struct.pack('B', len(self.siblings)) + b''.join(self.siblings))
+
+    @staticmethod
+    def parse(data):
+        index = struct.unpack('>I', data[0:4])[0]
+        leaf = bytes(data[4:36])
+        sibling_count = struct.unpack('B', data[36:37])[0]
+        if len(data) < 37 + sibling_count * HASH_SIZE:
+            raise ValueError("Truncated Merkle proof")
+        siblings = [bytes(data[37+i*HASH_SIZE:37+(i+1)*HASH_SIZE]) for i in range(sibling_count)]
+        return MerkleProof(index, leaf, siblings)
+
+    def to_json(self):
+        return {
+            'index': self.index,
+            'leaf': self.leaf.hex(),
+            'siblings': [s.hex() for s in self.siblings]
+        }
@@ -1 +1,267 @@
-# DNS resolution logic 
+# DNS resolution logic
+import asyncio
+import socket
+import struct
+from collections import OrderedDict
+
+from ..core.domain import domain_name_hash
+
+# Record types and classes
+TYPE_A = 1
+TYPE_AAAA = 28
+CLASS_IN = 1
+
+# Response codes
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+
+HEADER = struct.Struct('>HHHHHH')  # ID, Flags, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT
+MAX_UDP_SIZE = 512
+
+
+class DNSQuery:
+    """
+    The parts of a DNS query the resolver needs: its ID and flags, the first
+    question, and the raw question section to echo back in the response.
+    """
+    __slots__ = ('id', 'flags', 'labels', 'qtype', 'qclass', 'question')
+
+    def __init__(self, query_id, flags, labels, qtype, qclass, question):
+        self.id = query_id
+        self.flags = flags
+        self.labels = labels  # List of lower-cased labels
+        self.qtype = qtype
+        self.qclass = qclass
+        self.question = question  # Raw question section (QNAME, QTYPE, QCLASS)
+
+    @property
+    def opcode(self):
+        return (self.flags >> 11) & 0xf
+
+    @staticmethod
+    def parse(data):
+        if len(data) < HEADER.size:
+            raise ValueError("Truncated DNS header")
+        query_id, flags, qdcount, _, _, _ = HEADER.unpack_from(data, 0)
+        if qdcount != 1:
+            raise ValueError("Expected exactly one question")
+        offset = HEADER.size
+        labels = []
+        while True:
+            if offset >= len(data):
+                raise ValueError("Truncated QNAME")
+            length = data[offset]
+            offset += 1
+            if length == 0:
+                break
+            if length & 0xc0:
+                raise ValueError("Compressed QNAME in question")
+            labels.append(bytes(data[offset:offset+length]).decode('ascii', 'replace').lower())
+            offset += length
+        if offset + 4 > len(data):
+            raise ValueError("Truncated question")
+        qtype, qclass = struct.unpack_from('>HH', data, offset)
+        offset += 4
+        return DNSQuery(query_id, flags, labels, qtype, qclass, bytes(data[HEADER.size:offset]))
+
+
+def build_response(query, rcode, answers=b'', answer_count=0, truncated=False):
+    """
+    Build an authoritative response echoing the query's question.
+    """
+    flags = 0x8000 | 0x0400 | (query.flags & 0x7900) | rcode  # QR, AA, echo opcode and RD
+    if truncated:
+        flags |= 0x0200
+        answers, answer_count = b'', 0
+    return HEADER.pack(query.id, flags, 1, answer_count, 0, 0) + query.question + answers
+
+
+def build_error(data, rcode):
+    """
+    Build an error response to a query that could not be parsed, or None if even its header is unusable.
+    """
+    if len(data) < HEADER.size:
+        return None
+    query_id, flags = struct.unpack_from('>HH', data, 0)
+    return HEADER.pack(query_id, 0x8000 | (flags & 0x7900) | rcode, 0, 0, 0, 0)
+
+
+def domain_index_lookup(domain_index):
+    """
+    Adapt a DomainIndex to the resolver's lookup signature.
+    """
+    def lookup(domain_name, tld):
+        record = domain_index.get(domain_name, tld)
+        if record is None:
+            return None, False
+        return record.full_domain.ip_address, True
+    return lookup
+
+
+class DNSResolver:
+    """
+    Answers A and AAAA queries for on-chain domains. `lookup(domain_name, tld)`
+    returns (ip_address or None, exists). Answers are cached per domain name
+    hash and dropped by invalidate(). A resolver built with from_domain_index()
+    registers invalidate() as a DomainIndex listener, so it runs whenever a
+    block issues, transfers or changes the IP of that domain and cached answers
+    never outlive the chain state they were built from. A resolver built from
+    any other lookup must call invalidate() itself.
+    """
+    def __init__(self, lookup, ttl=60, cache_size=100000):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # Name hash -> {qtype: (rcode, answer bytes, answer count)}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_domain_index(domain_index, **kwargs):
+        """
+        A resolver answering from `domain_index` whose cache follows the index's changes.
+        """
+        resolver = DNSResolver(domain_index_lookup(domain_index), **kwargs)
+        domain_index.add_listener(resolver.invalidate)
+        return resolver
+
+    def invalidate(self, name_hash):
+        self.cache.pop(name_hash, None)
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def _answer(self, domain_name, tld, qtype):
+        try:
+            ip_address, exists = self.lookup(domain_name, tld)
+        except ValueError:
+            ip_address, exists = None, False
+        if not exists:
+            return RCODE_NXDOMAIN, b'', 0
+        if ip_address is None:
+            return RCODE_NOERROR, b'', 0
+        family = socket.AF_INET6 if ':' in ip_address else socket.AF_INET
+        if (qtype == TYPE_A) != (family == socket.AF_INET):
+            return RCODE_NOERROR, b'', 0
+        rdata = socket.inet_pton(family, ip_address)
+        # Name (pointer to the question's QNAME at offset 12), Type, Class, TTL, RDLENGTH, RDATA
+        answer = struct.pack('>HHHIH', 0xc00c, qtype, CLASS_IN, self.ttl, len(rdata)) + rdata
+        return RCODE_NOERROR, answer, 1
+
+    def resolve(self, query):
+        """
+        Answer a parsed query.
+
+        :return: Tuple of (rcode, answer bytes, answer count)
+        """
+        if query.opcode != 0 or query.qclass != CLASS_IN:
+            return RCODE_NOTIMP, b'', 0
+        if len(query.labels) != 2:
+            return RCODE_NXDOMAIN, b'', 0
+        domain_name, tld = query.labels
+        if query.qtype not in (TYPE_A, TYPE_AAAA):
+            _, exists = self.lookup(domain_name, tld)
+            return (RCODE_NOERROR if exists else RCODE_NXDOMAIN), b'', 0
+
+        name_hash = domain_name_hash(domain_name, tld)
+        answers = self.cache.get(name_hash)
+        if answers is not None and query.qtype in answers:
+            self.hits += 1
+            self.cache.move_to_end(name_hash)
+            return answers[query.qtype]
+        self.misses += 1
+        result = self._answer(domain_name, tld, query.qtype)
+        if answers is None:
+            answers = self.cache[name_hash] = {}
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        answers[query.qtype] = result
+        return result
+
+    def handle(self, data, max_size=None):
+        """
+        Turn a raw query into a raw response (None to drop the packet).
+        """
+        try:
+            query = DNSQuery.parse(data)
+        except ValueError:
+            return build_error(data, RCODE_FORMERR)
+        if query.flags & 0x8000:
+            return None  # A response, not a query
+        try:
+            rcode, answers, answer_count = self.resolve(query)
+        except Exception:
+            return build_response(query, RCODE_SERVFAIL)
+        response = build_response(query, rcode, answers, answer_count)
+        if max_size is not None and len(response) > max_size:
+            response = build_response(query, rcode, truncated=True)
+        return response
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = self.resolver.handle(data, MAX_UDP_SIZE)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+
+class DNSServer:
+    """
+    asyncio DNS server answering over UDP, with TCP (2-byte length framing) for
+    clients retrying truncated answers.
+    """
+    def __init__(self, resolver, host='127.0.0.1', port=5353):
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.udp_transport = None
+        self.tcp_server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self.resolver), local_addr=(self.host, self.port))
+        self.port = self.udp_transport.get_extra_info('sockname')[1]
+        self.tcp_server = await asyncio.start_server(self._handle_tcp, self.host, self.port)
+
+    async def _handle_tcp(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack('>H', await reader.readexactly(2))[0]
+                response = self.resolver.handle(await reader.readexactly(length))
+                if response is None:
+                    break
+                writer.write(struct.pack('>H', len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        await self.start()
+        await self.tcp_server.serve_forever()
+
+    def close(self):
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+
+
+def build_query(query_id, name, qtype=TYPE_A):
+    """
+    Build a raw query for `name` (e.g. "example.com"), as used by the load generator.
+    """
+    qname = b''.join(struct.pack('B', len(label)) + label.encode('ascii') for label in name.split('.')) + b'\x00'
+    return HEADER.pack(query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('>HH', qtype, CLASS_IN)
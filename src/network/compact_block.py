@@ -0,0 +1,197 @@
+# Compact block relay
+import hashlib
+import struct
+
+from ..core.block import Block, BLOCK_HEADER_SIZE
+from ..core.transaction import Transaction
+
+SHORT_ID_SIZE = 6
+DOMAIN_COINBASE = 4
+
+
+def short_id_key(header, nonce):
+    """
+    Per-block key for short transaction IDs, so colliding IDs cannot be
+    precomputed and differ from one block (and sender nonce) to the next.
+    """
+    return hashlib.sha256(header + struct.pack('>Q', nonce)).digest()[:16]
+
+
+def short_id(key, txid):
+    return hashlib.blake2b(txid, key=key, digest_size=SHORT_ID_SIZE).digest()
+
+
+class CompactBlock:
+    """
+    A block announced by its header, a 6-byte keyed hash of each transaction ID
+    and the transactions the receiver cannot have yet (the coinbase and the
+    domain coinbase), which are sent in full.
+
+    Binary format:
+    Block Header (80 bytes)
+    Nonce (8 bytes) // Salts the short ID key
+    Short ID Count (2 bytes)
+    Short IDs (6 bytes each) // In block order, skipping prefilled transactions
+    Prefilled Count (2 bytes)
+    Prefilled Transactions:
+    Index (2 bytes) // Position in the block
+    Transaction (variable)
+    """
+    def __init__(self, header, nonce, short_ids, prefilled):
+        self.header = header  # Serialized 80-byte header
+        self.nonce = nonce
+        self.short_ids = short_ids  # List of 6-byte short IDs
+        self.prefilled = prefilled  # List of (index, Transaction)
+        self.key = short_id_key(header, nonce)
+
+    @property
+    def block_hash(self):
+        return hashlib.sha256(self.header).digest()
+
+    @property
+    def transaction_count(self):
+        return len(self.short_ids) + len(self.prefilled)
+
+    def short_id(self, txid):
+        return short_id(self.key, txid)
+
+    @staticmethod
+    def from_block(block, nonce):
+        header = block.serialize_header()
+        key = short_id_key(header, nonce)
+        prefilled = []
+        short_ids = []
+        for index, tx in enumerate(block.transactions):
+            if index == 0 or tx.tx_type == DOMAIN_COINBASE:
+                prefilled.append((index, tx))
+            else:
+                short_ids.append(short_id(key, tx.txid))
+        return CompactBlock(header, nonce, short_ids, prefilled)
+
+    def serialize(self):
+        return (self.header + struct.pack('>QH', self.nonce, len(self.short_ids)) + b''.join(self.short_ids) +
+                struct.pack('>H', len(self.prefilled)) +
+                b''.join(struct.pack('>H', index) + tx.serialize() for index, tx in self.prefilled))
+
+    @staticmethod
+    def parse(data):
+        view = memoryview(data)
+        if len(view) < BLOCK_HEADER_SIZE + 10:
+            raise ValueError("Truncated compact block")
+        header = bytes(view[:BLOCK_HEADER_SIZE])
+        nonce, count = struct.unpack_from('>QH', view, BLOCK_HEADER_SIZE)
+        offset = BLOCK_HEADER_SIZE + 10
+        end = offset + count * SHORT_ID_SIZE
+        if end + 2 > len(view):
+            raise ValueError("Truncated compact block")
+        short_ids = [bytes(view[i:i+SHORT_ID_SIZE]) for i in range(offset, end, SHORT_ID_SIZE)]
+        prefilled_count = struct.unpack_from('>H', view, end)[0]
+        offset = end + 2
+        prefilled = []
+        for _ in range(prefilled_count):
+            index = struct.unpack_from('>H', view, offset)[0]
+            tx, consumed = Transaction.parse_from(view, offset + 2)
+            prefilled.append((index, tx))
+            offset += 2 + consumed
+        if offset != len(view):
+            raise ValueError("Trailing bytes after compact block")
+        if any(index >= count + prefilled_count for index, _ in prefilled):
+            raise ValueError("Prefilled transaction index out of range")
+        return CompactBlock(header, nonce, short_ids, prefilled)
+
+
+class PartialBlock:
+    """
+    A compact block being reconstructed: prefilled transactions are placed
+    first, then every pool transaction whose short ID matches a slot. Slots
+    matched by more than one pool transaction, or not matched at all, are
+    left missing and have to be requested with getblocktxn.
+
+    :param pool: Mapping of txid -> Transaction (the mempool or relay pool).
+    """
+    def __init__(self, compact, pool):
+        self.compact = compact
+        self.transactions = [None] * compact.transaction_count
+        for index, tx in compact.prefilled:
+            self.transactions[index] = tx
+        slots = {}  # Short ID -> index in the block
+        positions = (index for index, tx in enumerate(self.transactions) if tx is None)
+        ambiguous = set()
+        for index, sid in zip(positions, compact.short_ids):
+            if sid in slots:
+                ambiguous.add(sid)  # Two block transactions share a short ID
+            slots[sid] = index
+        for txid, tx in pool.items():
+            sid = compact.short_id(txid)
+            index = slots.get(sid)
+            if index is None:
+                continue
+            if self.transactions[index] is not None:
+                ambiguous.add(sid)
+            self.transactions[index] = tx
+        for sid in ambiguous:
+            self.transactions[slots[sid]] = None
+
+    @property
+    def missing(self):
+        return [index for index, tx in enumerate(self.transactions) if tx is None]
+
+    def fill(self, transactions):
+        """
+        Place the transactions of a blocktxn reply, in the order of `missing`.
+        """
+        missing = self.missing
+        if len(transactions) != len(missing):
+            raise ValueError("Expected %d transactions, got %d" % (len(missing), len(transactions)))
+        for index, tx in zip(missing, transactions):
+            self.transactions[index] = tx
+
+    def to_block(self):
+        """
+        Assemble the block. The caller must still check its Merkle root, which
+        catches a pool transaction that matched a short ID by accident.
+        """
+        if self.missing:
+            raise ValueError("Block still has missing transactions")
+        block = Block.parse_header(self.compact.header)
+        block.transactions = list(self.transactions)
+        return block
+
+
+def encode_getblocktxn(block_hash, indexes):
+    return block_hash + struct.pack('>H', len(indexes)) + b''.join(struct.pack('>H', index) for index in indexes)
+
+
+def decode_getblocktxn(payload):
+    """
+    :return: Tuple of (block hash, list of transaction indexes)
+    """
+    if len(payload) < 34:
+        raise ValueError("Truncated getblocktxn message")
+    count = struct.unpack_from('>H', payload, 32)[0]
+    if len(payload) != 34 + 2 * count:
+        raise ValueError("Bad getblocktxn message")
+    return payload[:32], list(struct.unpack_from('>%dH' % count, payload, 34))
+
+
+def encode_blocktxn(block_hash, transactions):
+    return block_hash + struct.pack('>H', len(transactions)) + b''.join(tx.serialize() for tx in transactions)
+
+
+def decode_blocktxn(payload):
+    """
+    :return: Tuple of (block hash, list of Transactions)
+    """
+    view = memoryview(payload)
+    if len(view) < 34:
+        raise ValueError("Truncated blocktxn message")
+    count = struct.unpack_from('>H', view, 32)[0]
+    offset = 34
+    transactions = []
+    for _ in range(count):
+        tx, consumed = Transaction.parse_from(view, offset)
+        transactions.append(tx)
+        offset += consumed
+    if offset != len(view):
+        raise ValueError("Trailing bytes after blocktxn message")
+    return bytes(view[:32]), transactions
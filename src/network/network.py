@@ -1 +1,96 @@
-# Network utilities 
+# Network utilities
+import asyncio
+import random
+import time
+
+
+class ConnectionManager:
+    """
+    Keeps a node connected to `target_outbound` outbound peers chosen at random
+    from a list of known (host, port) addresses. Dropped connections are
+    replaced on the next pass; an address that failed is not retried for
+    `retry_delay` seconds.
+    """
+    def __init__(self, node, addresses, target_outbound=8, interval=0.5, retry_delay=5.0):
+        self.node = node
+        self.addresses = list(addresses)
+        self.target_outbound = target_outbound
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.failed = {}  # Address -> time of the last failed attempt
+        self._task = None
+
+    def add_address(self, host, port):
+        if (host, port) not in self.addresses:
+            self.addresses.append((host, port))
+
+    def _connected(self):
+        connected = {(self.node.host, self.node.port)}
+        for peer in self.node.peers:
+            if peer.outbound:
+                connected.add(peer.address[:2])
+        return connected
+
+    def _candidates(self):
+        now = time.monotonic()
+        connected = self._connected()
+        return [address for address in self.addresses
+                if address not in connected and now - self.failed.get(address, -self.retry_delay) >= self.retry_delay]
+
+    async def fill(self):
+        """
+        Open connections until the outbound target is reached or no candidate is left.
+        """
+        missing = self.target_outbound - self.node.outbound_count
+        if missing <= 0:
+            return
+        candidates = self._candidates()
+        random.shuffle(candidates)
+        for address in candidates[:missing]:
+            try:
+                await self.node.connect(*address)
+            except OSError:
+                self.failed[address] = time.monotonic()
+
+    async def run(self):
+        while True:
+            await self.fill()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+async def start_local_network(node_factory, count, target_outbound=4, host='127.0.0.1', timeout=10.0):
+    """
+    Start `count` nodes listening on ephemeral localhost ports, each with a
+    ConnectionManager over the addresses of all the others, and wait until
+    every node has completed the handshake with its outbound peers.
+
+    :param node_factory: Called with no arguments to create each Node.
+    :return: Tuple of (nodes, connection managers)
+    """
+    nodes = [node_factory() for _ in range(count)]
+    for node in nodes:
+        node.host = host
+        await node.start()
+    addresses = [(node.host, node.port) for node in nodes]
+    managers = [ConnectionManager(node, addresses, min(target_outbound, count - 1)) for node in nodes]
+    for manager in managers:
+        await manager.fill()
+        manager.start()
+    handshakes = [peer.ready.wait() for node in nodes for peer in list(node.peers)]
+    await asyncio.wait_for(asyncio.gather(*handshakes), timeout)
+    return nodes, managers
+
+
+async def stop_local_network(nodes, managers):
+    for manager in managers:
+        manager.stop()
+    for node in nodes:
+        await node.close()
@@ -1 +1,445 @@
-# Node implementation 
+# Node implementation
+import asyncio
+import random
+import time
+from collections import Counter, OrderedDict
+
+from ..core.block import Block, NETWORK_MAGIC, BLOCK_HEADER_SIZE
+from ..core.blockchain import HeaderIndex, HAVE_DATA
+from ..core.transaction import Transaction
+from ..utils import metrics
+from .p2p_protocol import (MSG_VERSION, MSG_VERACK, MSG_PING, MSG_PONG, MSG_INV, MSG_GETDATA, MSG_NOTFOUND,
+                           MSG_GETHEADERS, MSG_HEADERS, MSG_BLOCK, MSG_TX, MSG_CMPCTBLOCK, MSG_GETBLOCKTXN,
+                           MSG_BLOCKTXN, MESSAGE_NAMES, INV_TX, INV_BLOCK, MAX_INV_ITEMS, MAX_HEADERS,
+                           MAX_LOCATOR_HASHES, Peer, encode_version, decode_version, encode_inventory,
+                           decode_inventory, encode_getheaders, decode_getheaders, encode_headers, decode_headers)
+from .compact_block import (CompactBlock, PartialBlock, encode_getblocktxn, decode_getblocktxn,
+                            encode_blocktxn, decode_blocktxn)
+
+
+class Node:
+    """
+    A relay node: keeps a HeaderIndex with the raw headers alongside it, the
+    blocks and loose transactions it has received, and talks to its peers with
+    the messages of p2p_protocol. Syncing is headers-first: after the handshake
+    each side asks for headers from its best tip's locator, then requests the
+    missing blocks in batched getdata messages. New blocks and transactions are
+    relayed with batched inv announcements.
+
+    With `compact_blocks`, a new block is pushed straight to the peers that do
+    not know it as a cmpctblock message; the receiver rebuilds it from its own
+    loose transactions and asks for the ones it lacks with getblocktxn.
+    """
+    def __init__(self, genesis, host='127.0.0.1', port=0, magic=NETWORK_MAGIC, check_pow=True,
+                 send_queue_size=256, inv_interval=0.05, mempool=None, compact_blocks=False, recent_blocks=16):
+        self.host = host
+        self.port = port
+        self.magic = magic
+        self.check_pow = check_pow
+        self.send_queue_size = send_queue_size
+        self.inv_interval = inv_interval
+        self.nonce = random.getrandbits(64)  # Detects connections to ourselves
+        self.headers = HeaderIndex()
+        self.header_data = bytearray()  # Raw 80-byte headers, in HeaderIndex position order
+        self.blocks = {}  # Block hash -> serialized block
+        self.transactions = {}  # Txid -> Transaction
+        self.mempool = mempool  # Optional Mempool deciding which loose transactions are accepted
+        self.compact_blocks = compact_blocks
+        self.recent_blocks = recent_blocks
+        self._recent = OrderedDict()  # Block hash -> Block, the last blocks accepted, to serve getblocktxn
+        self.partial_blocks = {}  # Block hash -> PartialBlock waiting for a blocktxn reply
+        self.compact_stats = Counter()  # Reconstructions: 'complete', 'round_trips', 'missing', 'failed', 'seconds'
+        self.requested = set()  # Hashes requested from some peer
+        self.peers = set()
+        self.listeners = []  # Called with (block hash, Block) for every new block
+        self.messages_received = Counter()  # Message name -> count
+        self.server = None
+        self._add_header(genesis.serialize_header())
+        self.blocks[genesis.header_hash()] = genesis.serialize()
+        self.headers.set_have_data(genesis.header_hash())
+
+    def __repr__(self):
+        return "Node(%s:%d, height=%d, peers=%d)" % (self.host, self.port, self.best_height, len(self.peers))
+
+    @property
+    def best_height(self):
+        return self.headers.best_tip()[1]
+
+    @property
+    def outbound_count(self):
+        return sum(1 for peer in self.peers if peer.outbound)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Connections
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _accept(self, reader, writer):
+        self._add_peer(reader, writer, outbound=False)
+
+    async def connect(self, host, port):
+        """
+        Open an outbound connection and start the version handshake.
+
+        :return: The Peer
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        return self._add_peer(reader, writer, outbound=True)
+
+    def _add_peer(self, reader, writer, outbound):
+        peer = Peer(self, reader, writer, outbound, self.send_queue_size, inv_interval=self.inv_interval)
+        self.peers.add(peer)
+        peer.start()
+        asyncio.ensure_future(peer.send(MSG_VERSION, encode_version(self.nonce, self.best_height, self.port)))
+        return peer
+
+    def on_peer_closed(self, peer):
+        self.peers.discard(peer)
+        # Let another peer serve whatever this one still owed us
+        self.requested -= peer.in_flight
+        for item_hash in peer.in_flight:
+            self.partial_blocks.pop(item_hash, None)
+        peer.in_flight.clear()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for peer in list(self.peers):
+            peer.close()
+
+    # Chain state
+
+    def _add_header(self, header):
+        count = len(self.headers)
+        position = self.headers.add_header(header, self.check_pow)
+        if position == count:
+            self.header_data += header
+        return position
+
+    def get_header(self, position):
+        return bytes(self.header_data[position*BLOCK_HEADER_SIZE:(position+1)*BLOCK_HEADER_SIZE])
+
+    def _relay(self, item_type, item_hash, source=None):
+        for peer in self.peers:
+            if peer is not source:
+                peer.announce(item_type, item_hash)
+
+    def submit_block(self, block, source=None):
+        """
+        Accept a block (mined locally or received from `source`) and relay it.
+
+        :return: True if the block was new and accepted.
+        """
+        block_hash = block.header_hash()
+        if block_hash in self.blocks:
+            return False
+        if Block.calculateMerkleRoot(block.transactions) != block.merkle_root:
+            raise ValueError("Block %s has a bad Merkle root" % block_hash.hex())
+        self._add_header(block.serialize_header())
+        self.blocks[block_hash] = block.serialize()
+        self.headers.set_have_data(block_hash)
+        self._recent[block_hash] = block
+        if len(self._recent) > self.recent_blocks:
+            self._recent.popitem(last=False)
+        for tx in block.transactions:
+            self.transactions.pop(tx.txid, None)
+        if self.mempool is not None:
+            for tx in self.mempool.remove_for_block(block):
+                self.transactions.pop(tx.txid, None)
+        if self.compact_blocks:
+            self._push_compact(block, block_hash, source)
+        else:
+            self._relay(INV_BLOCK, block_hash, source)
+        for listener in self.listeners:
+            listener(block_hash, block)
+        if metrics.enabled:
+            metrics.inc('p2p_blocks_accepted_total')
+            metrics.set_gauge('p2p_best_height', self.best_height)
+            metrics.set_gauge('p2p_peers', len(self.peers))
+        return True
+
+    def submit_transaction(self, tx, source=None):
+        """
+        Accept a loose transaction and relay it.
+
+        :return: True if the transaction was new.
+        """
+        if tx.txid in self.transactions:
+            return False  # The common case for relayed transactions, checked without raising
+        try:
+            self.accept_transaction(tx, source)
+        except ValueError:
+            return False
+        return True
+
+    def accept_transaction(self, tx, source=None):
+        """
+        Like submit_transaction(), but say why a transaction is refused.
+
+        :raises ValueError: If the transaction is already known or the mempool rejects it.
+        """
+        if tx.txid in self.transactions:
+            raise ValueError("Transaction %s is already known" % tx.txid.hex())
+        if self.mempool is not None:
+            self.mempool.add(tx)
+        self.transactions[tx.txid] = tx
+        self._relay(INV_TX, tx.txid, source)
+        metrics.inc('p2p_transactions_accepted_total')
+
+    def _push_compact(self, block, block_hash, source=None):
+        """
+        Send the block as a cmpctblock message to every peer not known to have
+        it. The message is built once; peers that miss it can still fetch the
+        block through headers sync.
+        """
+        payload = None
+        for peer in self.peers:
+            if peer is source or not peer.ready.is_set() or block_hash in peer.known_inventory:
+                continue
+            if payload is None:
+                payload = CompactBlock.from_block(block, random.getrandbits(64)).serialize()
+            peer.mark_known(block_hash)
+            asyncio.ensure_future(peer.send(MSG_CMPCTBLOCK, payload))
+
+    def _get_block(self, block_hash):
+        block = self._recent.get(block_hash)
+        if block is None and block_hash in self.blocks:
+            block = Block.parse(self.blocks[block_hash])
+        return block
+
+    def _locator(self):
+        return self.headers.get_locator()[:MAX_LOCATOR_HASHES]
+
+    def _headers_after(self, locator, stop_hash):
+        """
+        Raw headers on the best chain after the first locator hash we know, up to
+        `stop_hash` or MAX_HEADERS headers. Only headers of blocks we have are
+        sent, so the peer can request every block in the reply from us.
+        """
+        best = self.headers.best
+        best_height = int(self.headers.headers[best]['height'])
+        start_height = 0
+        for block_hash in locator:
+            position = self.headers.get_position(block_hash)
+            if position < 0:
+                continue
+            height = int(self.headers.headers[position]['height'])
+            if self.headers.get_ancestor(best, height) == position:
+                start_height = height + 1
+                break
+        end_height = min(best_height, start_height + MAX_HEADERS - 1)
+        if end_height < start_height:
+            return []
+        # Walk back from the last header instead of looking up every height
+        position = self.headers.get_ancestor(best, end_height)
+        positions = []
+        for _ in range(end_height - start_height + 1):
+            positions.append(position)
+            position = int(self.headers.headers[position]['parent'])
+        positions.reverse()
+        stop = self.headers.get_position(stop_hash)
+        if stop in positions:
+            positions = positions[:positions.index(stop) + 1]
+        status = self.headers.headers['status']
+        for i, position in enumerate(positions):
+            if not status[position] & HAVE_DATA:
+                positions = positions[:i]
+                break
+        return [self.get_header(position) for position in positions]
+
+    # Message handlers
+
+    async def handle_message(self, peer, msg_type, payload):
+        handler = self._handlers.get(msg_type)
+        if handler is None:
+            raise ValueError("Unknown message type %d" % msg_type)
+        name = MESSAGE_NAMES[msg_type]
+        self.messages_received[name] += 1
+        with metrics.span('p2p_handle', message=name):
+            await handler(self, peer, payload)
+
+    async def _on_version(self, peer, payload):
+        if peer.version is not None:
+            raise ValueError("Duplicate version message")
+        version = decode_version(payload)
+        if version[3] == self.nonce:
+            raise ValueError("Connected to ourselves")
+        peer.version = version
+        await peer.send(MSG_VERACK)
+        await self._maybe_ready(peer)
+
+    async def _on_verack(self, peer, payload):
+        peer.verack_received = True
+        await self._maybe_ready(peer)
+
+    async def _maybe_ready(self, peer):
+        if peer.version is None or not peer.verack_received or peer.ready.is_set():
+            return
+        peer.ready.set()
+        await peer.send(MSG_GETHEADERS, encode_getheaders(self._locator()))
+
+    async def _on_ping(self, peer, payload):
+        await peer.send(MSG_PONG, payload)
+
+    async def _on_pong(self, peer, payload):
+        pass
+
+    async def _on_inv(self, peer, payload):
+        wanted = []
+        for item_type, item_hash in decode_inventory(payload):
+            peer.mark_known(item_hash)
+            if item_hash in self.requested:
+                continue
+            if (item_type == INV_BLOCK and item_hash not in self.blocks or
+                    item_type == INV_TX and item_hash not in self.transactions):
+                wanted.append((item_type, item_hash))
+        await self._request(peer, wanted)
+
+    async def _request(self, peer, items):
+        if not items:
+            return
+        for _, item_hash in items:
+            self.requested.add(item_hash)
+            peer.in_flight.add(item_hash)
+        for i in range(0, len(items), MAX_INV_ITEMS):
+            await peer.send(MSG_GETDATA, encode_inventory(items[i:i+MAX_INV_ITEMS]))
+
+    async def _on_getdata(self, peer, payload):
+        not_found = []
+        for item_type, item_hash in decode_inventory(payload):
+            if item_type == INV_BLOCK and item_hash in self.blocks:
+                await peer.send(MSG_BLOCK, self.blocks[item_hash])
+            elif item_type == INV_TX and item_hash in self.transactions:
+                await peer.send(MSG_TX, self.transactions[item_hash].serialize())
+            else:
+                not_found.append((item_type, item_hash))
+                continue
+            peer.mark_known(item_hash)
+        if not_found:
+            await peer.send(MSG_NOTFOUND, encode_inventory(not_found))
+
+    async def _on_notfound(self, peer, payload):
+        for _, item_hash in decode_inventory(payload):
+            self.requested.discard(item_hash)
+            self.partial_blocks.pop(item_hash, None)
+            peer.in_flight.discard(item_hash)
+
+    async def _on_getheaders(self, peer, payload):
+        locator, stop_hash = decode_getheaders(payload)
+        await peer.send(MSG_HEADERS, encode_headers(self._headers_after(locator, stop_hash)))
+
+    async def _on_headers(self, peer, payload):
+        headers = decode_headers(payload)
+        wanted = []
+        block_hash = None
+        for header in headers:
+            block_hash = self.headers.get_hash(self._add_header(header))
+            peer.mark_known(block_hash)
+            if block_hash not in self.blocks and block_hash not in self.requested:
+                wanted.append((INV_BLOCK, block_hash))
+        await self._request(peer, wanted)
+        if len(headers) == MAX_HEADERS:
+            # The peer has more; continue from the last header it sent
+            await peer.send(MSG_GETHEADERS, encode_getheaders(self.headers.get_locator(block_hash)[:MAX_LOCATOR_HASHES]))
+
+    async def _on_block(self, peer, payload):
+        block = Block.parse(payload)
+        block_hash = block.header_hash()
+        peer.mark_known(block_hash)
+        peer.in_flight.discard(block_hash)
+        self.requested.discard(block_hash)
+        if self.headers.get_position(block.previous_hash) < 0:
+            # Parent unknown: fetch the headers in between, the block is requested again after them
+            await peer.send(MSG_GETHEADERS, encode_getheaders(self._locator()))
+            return
+        self.submit_block(block, peer)
+
+    async def _on_cmpctblock(self, peer, payload):
+        compact = CompactBlock.parse(payload)
+        block_hash = compact.block_hash
+        peer.mark_known(block_hash)
+        if block_hash in self.blocks or block_hash in self.partial_blocks:
+            return
+        previous_hash = compact.header[4:36]
+        if self.headers.get_position(previous_hash) < 0:
+            await peer.send(MSG_GETHEADERS, encode_getheaders(self._locator()))
+            return
+        self._add_header(compact.header)
+        start = time.perf_counter()
+        partial = PartialBlock(compact, self.transactions)
+        missing = partial.missing
+        elapsed = time.perf_counter() - start
+        self.compact_stats['seconds'] += elapsed
+        metrics.observe('compact_reconstruct_seconds', elapsed)
+        metrics.inc('compact_missing_transactions_total', len(missing))
+        if not missing:
+            await self._finish_compact(peer, block_hash, partial)
+            return
+        self.compact_stats['round_trips'] += 1
+        self.compact_stats['missing'] += len(missing)
+        self.partial_blocks[block_hash] = partial
+        self.requested.add(block_hash)
+        peer.in_flight.add(block_hash)
+        await peer.send(MSG_GETBLOCKTXN, encode_getblocktxn(block_hash, missing))
+
+    async def _finish_compact(self, peer, block_hash, partial):
+        start = time.perf_counter()
+        block = partial.to_block()
+        if Block.calculateMerkleRoot(block.transactions) != block.merkle_root:
+            # A short ID matched the wrong transaction: fall back to the full block
+            self.compact_stats['failed'] += 1
+            self.requested.discard(block_hash)
+            await self._request(peer, [(INV_BLOCK, block_hash)])
+            return
+        self.compact_stats['complete'] += 1
+        self.compact_stats['seconds'] += time.perf_counter() - start
+        self.submit_block(block, peer)
+
+    async def _on_getblocktxn(self, peer, payload):
+        block_hash, indexes = decode_getblocktxn(payload)
+        block = self._get_block(block_hash)
+        if block is None or any(index >= len(block.transactions) for index in indexes):
+            await peer.send(MSG_NOTFOUND, encode_inventory([(INV_BLOCK, block_hash)]))
+            return
+        await peer.send(MSG_BLOCKTXN, encode_blocktxn(block_hash, [block.transactions[i] for i in indexes]))
+
+    async def _on_blocktxn(self, peer, payload):
+        block_hash, transactions = decode_blocktxn(payload)
+        partial = self.partial_blocks.pop(block_hash, None)
+        peer.in_flight.discard(block_hash)
+        self.requested.discard(block_hash)
+        if partial is None:
+            return
+        start = time.perf_counter()
+        partial.fill(transactions)
+        self.compact_stats['seconds'] += time.perf_counter() - start
+        await self._finish_compact(peer, block_hash, partial)
+
+    async def _on_tx(self, peer, payload):
+        tx = Transaction.parse(payload)
+        peer.mark_known(tx.txid)
+        peer.in_flight.discard(tx.txid)
+        self.requested.discard(tx.txid)
+        self.submit_transaction(tx, peer)
+
+    _handlers = {
+        MSG_VERSION: _on_version,
+        MSG_VERACK: _on_verack,
+        MSG_PING: _on_ping,
+        MSG_PONG: _on_pong,
+        MSG_INV: _on_inv,
+        MSG_GETDATA: _on_getdata,
+        MSG_NOTFOUND: _on_notfound,
+        MSG_GETHEADERS: _on_getheaders,
+        MSG_HEADERS: _on_headers,
+        MSG_BLOCK: _on_block,
+        MSG_TX: _on_tx,
+        MSG_CMPCTBLOCK: _on_cmpctblock,
+        MSG_GETBLOCKTXN: _on_getblocktxn,
+        MSG_BLOCKTXN: _on_blocktxn,
+    }
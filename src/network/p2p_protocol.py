@@ -1 +1,264 @@
-# Peer-to-peer protocol 
+# Peer-to-peer protocol
+import asyncio
+import struct
+import time
+
+from ..core.block import NETWORK_MAGIC, BLOCK_HEADER_SIZE
+from ..utils import metrics
+
+PROTOCOL_VERSION = 1
+
+# Message types
+MSG_VERSION = 0
+MSG_VERACK = 1
+MSG_PING = 2
+MSG_PONG = 3
+MSG_INV = 4
+MSG_GETDATA = 5
+MSG_NOTFOUND = 6
+MSG_GETHEADERS = 7
+MSG_HEADERS = 8
+MSG_BLOCK = 9
+MSG_TX = 10
+MSG_CMPCTBLOCK = 11
+MSG_GETBLOCKTXN = 12
+MSG_BLOCKTXN = 13
+
+MESSAGE_NAMES = {
+    MSG_VERSION: 'version', MSG_VERACK: 'verack', MSG_PING: 'ping', MSG_PONG: 'pong',
+    MSG_INV: 'inv', MSG_GETDATA: 'getdata', MSG_NOTFOUND: 'notfound',
+    MSG_GETHEADERS: 'getheaders', MSG_HEADERS: 'headers', MSG_BLOCK: 'block', MSG_TX: 'tx',
+    MSG_CMPCTBLOCK: 'cmpctblock', MSG_GETBLOCKTXN: 'getblocktxn', MSG_BLOCKTXN: 'blocktxn'
+}
+
+# Inventory item types
+INV_TX = 1
+INV_BLOCK = 2
+
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+MAX_INV_ITEMS = 50000  # Per inv, getdata or notfound message
+MAX_HEADERS = 2000  # Per headers message
+MAX_LOCATOR_HASHES = 101
+
+# Magic Number (4 bytes), Size (4 bytes, excluding magic and size), Message Type (1 byte)
+MESSAGE_HEADER = struct.Struct('>IIB')
+# Protocol version, services, timestamp, nonce, best height, listen port
+VERSION_FORMAT = struct.Struct('>IQQQiH')
+INV_ITEM_SIZE = 33  # Type (1 byte), Hash (32 bytes)
+
+
+# Framing
+
+def encode_message(msg_type, payload=b'', magic=NETWORK_MAGIC):
+    """
+    Frame a message with the Magic Number + Size prefix used for blocks on disk
+    (PROTOCOL/BLOCKS/Blocks.txt), followed by a one-byte message type.
+    """
+    return MESSAGE_HEADER.pack(magic, len(payload) + 1, msg_type) + payload
+
+
+async def read_message(reader, magic=NETWORK_MAGIC):
+    """
+    Read one framed message from a stream.
+
+    :return: Tuple of (message type, payload bytes)
+    """
+    header = await reader.readexactly(MESSAGE_HEADER.size)
+    frame_magic, size, msg_type = MESSAGE_HEADER.unpack(header)
+    if frame_magic != magic:
+        raise ValueError("Bad magic number 0x%08x" % frame_magic)
+    if size < 1 or size > MAX_MESSAGE_SIZE:
+        raise ValueError("Bad message size %d" % size)
+    return msg_type, await reader.readexactly(size - 1)
+
+
+# Payloads
+
+def encode_version(nonce, best_height, listen_port, services=0):
+    return VERSION_FORMAT.pack(PROTOCOL_VERSION, services, int(time.time()), nonce, best_height, listen_port)
+
+
+def decode_version(payload):
+    """
+    :return: Tuple of (protocol version, services, timestamp, nonce, best height, listen port)
+    """
+    if len(payload) != VERSION_FORMAT.size:
+        raise ValueError("Bad version message size %d" % len(payload))
+    return VERSION_FORMAT.unpack(payload)
+
+
+def encode_inventory(items):
+    """
+    Encode (type, hash) items for an inv, getdata or notfound message.
+    """
+    if len(items) > MAX_INV_ITEMS:
+        raise ValueError("Too many inventory items: %d" % len(items))
+    return struct.pack('>I', len(items)) + b''.join(bytes((item_type,)) + item_hash for item_type, item_hash in items)
+
+
+def decode_inventory(payload):
+    if len(payload) < 4:
+        raise ValueError("Truncated inventory message")
+    count = struct.unpack_from('>I', payload, 0)[0]
+    if count > MAX_INV_ITEMS or len(payload) != 4 + count * INV_ITEM_SIZE:
+        raise ValueError("Bad inventory message")
+    return [(payload[offset], payload[offset+1:offset+INV_ITEM_SIZE])
+            for offset in range(4, len(payload), INV_ITEM_SIZE)]
+
+
+def encode_getheaders(locator, stop_hash=b'\x00' * 32):
+    if len(locator) > MAX_LOCATOR_HASHES:
+        raise ValueError("Too many locator hashes: %d" % len(locator))
+    return struct.pack('B', len(locator)) + b''.join(locator) + stop_hash
+
+
+def decode_getheaders(payload):
+    """
+    :return: Tuple of (locator hashes, stop hash)
+    """
+    if not payload:
+        raise ValueError("Truncated getheaders message")
+    count = payload[0]
+    if count > MAX_LOCATOR_HASHES or len(payload) != 1 + 32 * count + 32:
+        raise ValueError("Bad getheaders message")
+    locator = [payload[offset:offset+32] for offset in range(1, 1 + 32 * count, 32)]
+    return locator, payload[-32:]
+
+
+def encode_headers(headers):
+    if len(headers) > MAX_HEADERS:
+        raise ValueError("Too many headers: %d" % len(headers))
+    return struct.pack('>H', len(headers)) + b''.join(headers)
+
+
+def decode_headers(payload):
+    if len(payload) < 2:
+        raise ValueError("Truncated headers message")
+    count = struct.unpack_from('>H', payload, 0)[0]
+    if count > MAX_HEADERS or len(payload) != 2 + count * BLOCK_HEADER_SIZE:
+        raise ValueError("Bad headers message")
+    return [payload[offset:offset+BLOCK_HEADER_SIZE] for offset in range(2, len(payload), BLOCK_HEADER_SIZE)]
+
+
+class Peer:
+    """
+    One connection to a remote node. Outgoing messages go through a bounded
+    send queue drained by a single writer task, which coalesces queued frames
+    into one write and waits for the transport to drain. When the queue is
+    full send() blocks, so a peer that reads slowly also slows down how fast
+    its own requests are read and served; a peer stalled for longer than
+    `send_timeout` is disconnected. Block and transaction announcements are
+    not queued per message but collected and flushed as batched inv messages
+    every `inv_interval` seconds.
+    """
+    def __init__(self, node, reader, writer, outbound, send_queue_size=256, send_timeout=30.0, inv_interval=0.05):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.outbound = outbound
+        self.address = writer.get_extra_info('peername')
+        self.send_queue = asyncio.Queue(send_queue_size)
+        self.send_timeout = send_timeout
+        self.inv_interval = inv_interval
+        self.pending_inv = []
+        self.known_inventory = set()  # Hashes the peer has or has been told about
+        self.in_flight = set()  # Hashes requested from this peer
+        self.version = None  # Decoded version message of the peer
+        self.verack_received = False
+        self.ready = asyncio.Event()  # Set once the version handshake is complete
+        self.closed = asyncio.Event()
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._tasks = []
+
+    def __repr__(self):
+        return "Peer(%s:%d, %s)" % (self.address[0], self.address[1], 'outbound' if self.outbound else 'inbound')
+
+    @property
+    def best_height(self):
+        return self.version[4] if self.version is not None else -1
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._read_loop()),
+                       asyncio.ensure_future(self._write_loop()),
+                       asyncio.ensure_future(self._inv_loop())]
+
+    async def send(self, msg_type, payload=b''):
+        """
+        Queue a message, waiting while the send queue is full.
+        """
+        if self.closed.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.send_queue.put(encode_message(msg_type, payload, self.node.magic)),
+                                   self.send_timeout)
+        except asyncio.TimeoutError:
+            self.close()
+
+    def announce(self, item_type, item_hash):
+        """
+        Schedule an inventory item for the next batched inv, unless the peer already knows it.
+        """
+        if item_hash in self.known_inventory or len(self.pending_inv) >= MAX_INV_ITEMS:
+            return
+        self.mark_known(item_hash)
+        self.pending_inv.append((item_type, item_hash))
+
+    def mark_known(self, item_hash):
+        if len(self.known_inventory) >= 4 * MAX_INV_ITEMS:
+            self.known_inventory.clear()
+        self.known_inventory.add(item_hash)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                msg_type, payload = await read_message(self.reader, self.node.magic)
+                self.messages_received += 1
+                self.bytes_received += MESSAGE_HEADER.size + len(payload)
+                if metrics.enabled:
+                    name = MESSAGE_NAMES.get(msg_type, 'unknown')
+                    metrics.inc('p2p_messages_received_total', message=name)
+                    metrics.inc('p2p_bytes_received_total', MESSAGE_HEADER.size + len(payload), message=name)
+                if msg_type not in (MSG_VERSION, MSG_VERACK) and not self.ready.is_set():
+                    raise ValueError("%s before the version handshake" % MESSAGE_NAMES.get(msg_type, msg_type))
+                await self.node.handle_message(self, msg_type, payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, struct.error):
+            pass  # A truncated or malformed payload disconnects the peer
+        finally:
+            self.close()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frames = [await self.send_queue.get()]
+                while not self.send_queue.empty() and len(frames) < 64:
+                    frames.append(self.send_queue.get_nowait())
+                data = b''.join(frames)
+                self.writer.write(data)
+                self.messages_sent += len(frames)
+                self.bytes_sent += len(data)
+                if metrics.enabled:
+                    metrics.inc('p2p_messages_sent_total', len(frames))
+                    metrics.inc('p2p_bytes_sent_total', len(data))
+                await self.writer.drain()
+        except ConnectionError:
+            self.close()
+
+    async def _inv_loop(self):
+        while True:
+            await asyncio.sleep(self.inv_interval)
+            if self.pending_inv and self.ready.is_set():
+                items, self.pending_inv = self.pending_inv, []
+                await self.send(MSG_INV, encode_inventory(items))
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.writer.close()
+        self.node.on_peer_closed(self)
@@ -1 +1,683 @@
-# Database interactions 
+# Database interactions
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+
+import rocksdb
+
+from ..core.transaction import Transaction
+from ..core.block import Block, NETWORK_MAGIC, FRAME_HEADER_SIZE
+from ..core.domain import FullDomain, normalize_domain, domain_name_hash
+from ..core.block_filter import BlockFilter
+from ..crypto.merkle_tree import MerkleTree, hash_leaves
+from ..utils import metrics
+from .records import Coin, DomainRecord, BlockUndo
+
+COIN_PREFIX = b'c'  # c + TXID (32 bytes) + Output Index (4 bytes) -> Coin
+BEST_BLOCK_KEY = b'B'  # Hash of the block the stored coin set corresponds to
+DOMAIN_PREFIX = b'd'  # d + Name Hash (32 bytes) -> DomainRecord
+DOMAIN_OUTPOINT_PREFIX = b'o'  # o + TXID (32 bytes) + Output Index (4 bytes) -> Name Hash (32 bytes)
+BLOCK_HASH_PREFIX = b'h'  # h + Block Hash (32 bytes) -> BlockLocation
+BLOCK_HEIGHT_PREFIX = b'n'  # n + Height (4 bytes) -> Block Hash (32 bytes)
+BLOCK_FILE_END_KEY = b'F'  # File Number (4 bytes) + Offset (8 bytes) just past the last indexed block
+BLOCK_FILTER_PREFIX = b'f'  # f + Block Hash (32 bytes) -> BlockFilter
+TX_PREFIX = b't'  # t + TXID (32 bytes) -> Block Hash (32 bytes) + Offset (4 bytes) + Length (4 bytes)
+BEST_HEIGHT_KEY = b'H'  # Height (4 bytes) of the highest stored block
+UNDO_PREFIX = b'u'  # u + Block Hash (32 bytes) -> BlockUndo
+
+
+def coin_key(txid, output_index):
+    return COIN_PREFIX + txid + struct.pack('>I', output_index)
+
+
+class UTXODatabase:
+    """
+    RocksDB-backed set of unspent outputs keyed by (txid, output_index).
+    All changes go through write_batch, which commits them atomically together
+    with the best block hash, so the stored set always matches a whole block.
+    """
+    def __init__(self, path):
+        options = rocksdb.Options(create_if_missing=True)
+        # Lookups of outpoints that are not stored (new coinbase outputs) stop at the filter
+        options.table_factory = rocksdb.BlockBasedTableFactory(
+            filter_policy=rocksdb.BloomFilterPolicy(10))
+        self.db = rocksdb.DB(path, options)
+
+    def get_coin(self, txid, output_index):
+        data = self.db.get(coin_key(txid, output_index))
+        return Coin.parse(data) if data is not None else None
+
+    def get_best_block(self):
+        return self.db.get(BEST_BLOCK_KEY)
+
+    def write_batch(self, changes, best_block=None, sync=False):
+        """
+        Apply coin changes atomically.
+
+        :param changes: Iterable of ((txid, output_index), Coin or None); None deletes the coin.
+        :param best_block: Block hash to record along with the changes.
+        """
+        batch = rocksdb.WriteBatch()
+        for (txid, output_index), coin in changes:
+            if coin is None:
+                batch.delete(coin_key(txid, output_index))
+            else:
+                batch.put(coin_key(txid, output_index), coin.serialize())
+        if best_block is not None:
+            batch.put(BEST_BLOCK_KEY, best_block)
+        self.db.write(batch, sync=sync)
+
+
+# Coins cache entry flags
+DIRTY = 1  # Differs from the database and must be written on flush
+FRESH = 2  # Not in the database, so spending it can simply drop the entry
+
+# Rough per-entry cost of the cache (dict slot, key tuple, entry list, Coin and CoinOutput)
+CACHE_ENTRY_OVERHEAD = 400
+
+
+class CoinsCache:
+    """
+    Bounded in-memory layer over UTXODatabase. Entries are [coin or None, flags]
+    lists; None marks a spent coin that still has to be deleted from disk.
+    Outputs created and spent between two flushes are FRESH and never reach
+    the database. The cache is flushed as one write batch when its estimated
+    size exceeds max_bytes or flush_interval seconds have passed.
+    """
+    def __init__(self, database, max_bytes=256 * 1024 * 1024, flush_interval=300):
+        self.database = database
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.entries = {}
+        self.size_bytes = 0
+        self.best_block = database.get_best_block()
+        self.last_flush = time.monotonic()
+
+    def _entry_size(self, coin):
+        return CACHE_ENTRY_OVERHEAD + (len(coin.output.script_pub_key) if coin is not None else 0)
+
+    def _fetch(self, outpoint):
+        entry = self.entries.get(outpoint)
+        if metrics.enabled:
+            metrics.inc('coins_cache_lookups_total')
+            if entry is None:
+                metrics.inc('coins_cache_misses_total')
+        if entry is None:
+            coin = self.database.get_coin(*outpoint)
+            if coin is None:
+                return None
+            entry = [coin, 0]
+            self.entries[outpoint] = entry
+            self.size_bytes += self._entry_size(coin)
+        return entry
+
+    def get_coin(self, txid, output_index):
+        entry = self._fetch((txid, output_index))
+        return entry[0] if entry is not None else None
+
+    def have_coin(self, txid, output_index):
+        return self.get_coin(txid, output_index) is not None
+
+    def add_coin(self, txid, output_index, coin):
+        outpoint = (txid, output_index)
+        entry = self.entries.get(outpoint)
+        if entry is None:
+            # Only a coinbase can repeat a txid (two identical coinbases), so only its
+            # outputs may already be on disk; any other new output is FRESH
+            if coin.is_coinbase and self.database.get_coin(txid, output_index) is not None:
+                raise ValueError("Output %s:%d already exists" % (txid.hex(), output_index))
+            self.entries[outpoint] = [coin, DIRTY | FRESH]
+        else:
+            if entry[0] is not None:
+                raise ValueError("Output %s:%d already exists" % (txid.hex(), output_index))
+            self.size_bytes -= self._entry_size(entry[0])
+            # Re-adding a coin whose spend is not flushed yet: the database still has the old one
+            entry[0] = coin
+            entry[1] |= DIRTY
+        self.size_bytes += self._entry_size(coin)
+
+    def spend_coin(self, txid, output_index):
+        """
+        Mark an output as spent.
+
+        :return: The spent Coin.
+        """
+        outpoint = (txid, output_index)
+        entry = self._fetch(outpoint)
+        if entry is None or entry[0] is None:
+            raise ValueError("Output %s:%d is missing or already spent" % (txid.hex(), output_index))
+        coin = entry[0]
+        if entry[1] & FRESH:
+            del self.entries[outpoint]
+            self.size_bytes -= self._entry_size(coin)
+        else:
+            entry[0] = None
+            entry[1] |= DIRTY
+            self.size_bytes -= self._entry_size(coin) - self._entry_size(None)
+        return coin
+
+    def connect_block(self, block, height):
+        """
+        Spend every coin input of the block and add every coin output.
+
+        :return: List of (txid, output_index, Coin) for the spent coins.
+        """
+        spent = []
+        for tx in block.transactions:
+            if tx.tx_type != 0:
+                for coin_input in tx.coin_inputs:
+                    coin = self.spend_coin(coin_input.txid, coin_input.output_index)
+                    spent.append((coin_input.txid, coin_input.output_index, coin))
+            txid = tx.txid
+            for index, output in enumerate(tx.coin_outputs):
+                self.add_coin(txid, index, Coin(output, height, tx.tx_type == 0))
+        self.best_block = block.header_hash()
+        if metrics.enabled:
+            metrics.set_gauge('coins_cache_bytes', self.size_bytes)
+            metrics.set_gauge('coins_cache_entries', len(self.entries))
+        self.maybe_flush()
+        return spent
+
+    def disconnect_block(self, block, spent_coins):
+        """
+        Undo connect_block for the tip block: remove the outputs it created and
+        restore the coins it spent. Transactions are undone last to first, so an
+        output created and spent within the block is restored and then removed.
+
+        :param spent_coins: Coins spent by the block's coin inputs, in input order (see BlockUndo).
+        """
+        if sum(len(tx.coin_inputs) for tx in block.transactions if tx.tx_type != 0) != len(spent_coins):
+            raise ValueError("Undo data of block %s does not match its inputs" % block.header_hash().hex())
+        position = len(spent_coins)
+        for tx in reversed(block.transactions):
+            txid = tx.txid
+            for index in range(len(tx.coin_outputs)):
+                self.spend_coin(txid, index)
+            if tx.tx_type != 0:
+                position -= len(tx.coin_inputs)
+                for coin_input, coin in zip(tx.coin_inputs, spent_coins[position:]):
+                    self.add_coin(coin_input.txid, coin_input.output_index, coin)
+        self.best_block = block.previous_hash
+        if metrics.enabled:
+            metrics.set_gauge('coins_cache_bytes', self.size_bytes)
+            metrics.set_gauge('coins_cache_entries', len(self.entries))
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if (self.size_bytes > self.max_bytes or
+                time.monotonic() - self.last_flush > self.flush_interval):
+            self.flush()
+
+    def flush(self, sync=False):
+        """
+        Write all dirty entries and the best block hash in one atomic batch, then empty the cache.
+        """
+        changes = [(outpoint, entry[0]) for outpoint, entry in self.entries.items() if entry[1] & DIRTY]
+        with metrics.span('coins_flush'):
+            self.database.write_batch(changes, self.best_block, sync=sync)
+        metrics.inc('coins_flushed_total', len(changes))
+        self.entries.clear()
+        self.size_bytes = 0
+        self.last_flush = time.monotonic()
+
+
+def domain_outpoint_key(txid, output_index):
+    return DOMAIN_OUTPOINT_PREFIX + txid + struct.pack('>I', output_index)
+
+
+class DomainIndex:
+    """
+    Persistent UTXD set: normalised name + TLD -> DomainRecord, plus a reverse map
+    from domain outpoints to names so transfer and IP change inputs resolve in one
+    lookup. Keys are fixed-size name hashes and the table uses bloom filters, so
+    the uniqueness check for a domain coinbase is a single point lookup that
+    rarely touches disk when the name is new. Recently used records are kept in
+    a bounded LRU cache. Each block is applied as one atomic write batch.
+    """
+    def __init__(self, path, cache_size=100000, read_only=False):
+        options = rocksdb.Options(create_if_missing=not read_only)
+        options.table_factory = rocksdb.BlockBasedTableFactory(
+            filter_policy=rocksdb.BloomFilterPolicy(10))
+        self.db = rocksdb.DB(path, options, read_only=read_only)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # Name hash -> DomainRecord, or None for a known-missing name
+        self.listeners = []  # Called with the name hash of every domain a block changes
+
+    def add_listener(self, listener):
+        """
+        Register a callable notified with the name hash of each domain changed by a
+        connected block, e.g. to invalidate DNS answer caches.
+        """
+        self.listeners.append(listener)
+
+    def _cache_put(self, name_hash, record):
+        self.cache[name_hash] = record
+        self.cache.move_to_end(name_hash)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get_by_hash(self, name_hash):
+        if name_hash in self.cache:
+            self.cache.move_to_end(name_hash)
+            return self.cache[name_hash]
+        data = self.db.get(DOMAIN_PREFIX + name_hash)
+        record = DomainRecord.parse(data) if data is not None else None
+        self._cache_put(name_hash, record)
+        return record
+
+    def get(self, domain_name, tld):
+        return self.get_by_hash(domain_name_hash(domain_name, tld))
+
+    def exists(self, domain_name, tld):
+        return self.get(domain_name, tld) is not None
+
+    def get_by_outpoint(self, txid, output_index):
+        name_hash = self.db.get(domain_outpoint_key(txid, output_index))
+        return self.get_by_hash(name_hash) if name_hash is not None else None
+
+    def get_best_block(self):
+        return self.db.get(BEST_BLOCK_KEY)
+
+    @metrics.timed('domain_connect_block')
+    def connect_block(self, block, height):
+        """
+        Apply the domain transactions of a block: domain coinbases (type 4) issue
+        new domains, transfers (type 2) change the owner and IP changes (type 3)
+        change the IP. Each moves the domain to the spending transaction's output.
+        Nothing is written if any transaction is invalid.
+
+        :return: List of (name hash, previous DomainRecord or None), in application order.
+        """
+        pending = {}  # Name hash -> DomainRecord updated by this block
+        moved = {}  # (txid, output_index) -> name hash, or None for spent outpoints
+        changes = []
+
+        def lookup(name_hash):
+            if name_hash in pending:
+                return pending[name_hash]
+            return self.get_by_hash(name_hash)
+
+        def lookup_outpoint(txid, output_index):
+            outpoint = (txid, output_index)
+            if outpoint in moved:
+                name_hash = moved[outpoint]
+                return lookup(name_hash) if name_hash is not None else None
+            return self.get_by_outpoint(txid, output_index)
+
+        for tx in block.transactions:
+            if tx.tx_type == 4:
+                for index, output in enumerate(tx.domain_outputs):
+                    domain = output.full_domain
+                    name_hash = domain_name_hash(domain.domain_name, domain.tld)
+                    if lookup(name_hash) is not None:
+                        raise ValueError("Domain %s already exists" % normalize_domain(domain.domain_name, domain.tld))
+                    record = DomainRecord(domain, output.owner_pub_key_hash, tx.txid, index, height)
+                    changes.append((name_hash, None))
+                    pending[name_hash] = record
+                    moved[(tx.txid, index)] = name_hash
+            elif tx.tx_type == 2 or tx.tx_type == 3:
+                if len(tx.domain_inputs) != len(tx.domain_outputs):
+                    raise ValueError("Domain inputs and outputs must pair up")
+                for index, (domain_input, output) in enumerate(zip(tx.domain_inputs, tx.domain_outputs)):
+                    previous = lookup_outpoint(domain_input.domain_txid, domain_input.output_index)
+                    if previous is None:
+                        raise ValueError("Domain output %s:%d is missing or already spent" %
+                                         (domain_input.domain_txid.hex(), domain_input.output_index))
+                    full_domain = previous.full_domain
+                    owner_pub_key_hash = previous.owner_pub_key_hash
+                    if tx.tx_type == 2:
+                        owner_pub_key_hash = output.new_owner_pub_key_hash
+                    else:
+                        full_domain = FullDomain(full_domain.domain_name, full_domain.tld, output.ip_address)
+                    name_hash = previous.name_hash
+                    changes.append((name_hash, previous))
+                    pending[name_hash] = DomainRecord(full_domain, owner_pub_key_hash, tx.txid, index, height)
+                    moved[(domain_input.domain_txid, domain_input.output_index)] = None
+                    moved[(tx.txid, index)] = name_hash
+
+        batch = rocksdb.WriteBatch()
+        for (txid, output_index), name_hash in moved.items():
+            if name_hash is None:
+                batch.delete(domain_outpoint_key(txid, output_index))
+            else:
+                batch.put(domain_outpoint_key(txid, output_index), name_hash)
+        for name_hash, record in pending.items():
+            batch.put(DOMAIN_PREFIX + name_hash, record.serialize())
+        batch.put(BEST_BLOCK_KEY, block.header_hash())
+        self.db.write(batch)
+
+        for name_hash, record in pending.items():
+            self._cache_put(name_hash, record)
+            for listener in self.listeners:
+                listener(name_hash)
+        return changes
+
+    @metrics.timed('domain_disconnect_block')
+    def disconnect_block(self, block, previous_records):
+        """
+        Undo connect_block for the tip block: domains it issued are removed and
+        domains it transferred or changed the IP of get their previous record
+        back, all in one write batch.
+
+        :param previous_records: DomainRecords spent by the block's domain inputs, in input order (see BlockUndo).
+        """
+        entries = []  # (name hash, outpoint created by the block, previous DomainRecord or None), in application order
+        previous = iter(previous_records)
+        try:
+            for tx in block.transactions:
+                if tx.tx_type == 4:
+                    for index, output in enumerate(tx.domain_outputs):
+                        domain = output.full_domain
+                        entries.append((domain_name_hash(domain.domain_name, domain.tld), (tx.txid, index), None))
+                elif tx.tx_type == 2 or tx.tx_type == 3:
+                    for index in range(len(tx.domain_inputs)):
+                        record = next(previous)
+                        entries.append((record.name_hash, (tx.txid, index), record))
+        except StopIteration:
+            raise ValueError("Undo data of block %s is missing domain records" % block.header_hash().hex())
+        if next(previous, None) is not None:
+            raise ValueError("Undo data of block %s does not match its domain inputs" % block.header_hash().hex())
+
+        pending = {}  # Name hash -> restored DomainRecord, or None to delete
+        moved = {}  # (txid, output_index) -> name hash, or None to delete
+        for name_hash, outpoint, record in reversed(entries):
+            moved[outpoint] = None
+            pending[name_hash] = record
+            if record is not None:
+                moved[(record.txid, record.output_index)] = name_hash
+
+        batch = rocksdb.WriteBatch()
+        for (txid, output_index), name_hash in moved.items():
+            if name_hash is None:
+                batch.delete(domain_outpoint_key(txid, output_index))
+            else:
+                batch.put(domain_outpoint_key(txid, output_index), name_hash)
+        for name_hash, record in pending.items():
+            if record is None:
+                batch.delete(DOMAIN_PREFIX + name_hash)
+            else:
+                batch.put(DOMAIN_PREFIX + name_hash, record.serialize())
+        batch.put(BEST_BLOCK_KEY, block.previous_hash)
+        self.db.write(batch)
+
+        for name_hash, record in pending.items():
+            self._cache_put(name_hash, record)
+            for listener in self.listeners:
+                listener(name_hash)
+
+
+class BlockLocation:
+    """
+    Position of a stored block: segment file number, offset of its frame and
+    size of the block (excluding the 8-byte frame header).
+    """
+    __slots__ = ('file_number', 'offset', 'length', 'height')
+    FORMAT = struct.Struct('>IQII')
+
+    def __init__(self, file_number, offset, length, height):
+        self.file_number = file_number  # 4 bytes (segment file number)
+        self.offset = offset  # 8 bytes (offset of the frame in the segment)
+        self.length = length  # 4 bytes (block size)
+        self.height = height  # 4 bytes (block height)
+
+    def serialize(self):
+        return self.FORMAT.pack(self.file_number, self.offset, self.length, self.height)
+
+    @staticmethod
+    def parse(data):
+        return BlockLocation(*BlockLocation.FORMAT.unpack(data))
+
+
+class BlockStore:
+    """
+    Blocks appended to segment files (blk00000.dat, ...) framed with the magic
+    number and block size from PROTOCOL/BLOCKS/Blocks.txt, plus a RocksDB index
+    from block hash and height to their location and the block's compact
+    filter (see block_filter.py), so wallet rescans can skip blocks without
+    reading them, and from txid to the transaction's position in its block.
+    The index also holds the undo record (BlockUndo) of every connected block,
+    which reorg.py reads to disconnect it again.
+    Reads map the segment with
+    mmap and hand the block parser a memoryview, so stored blocks are never
+    copied into Python bytes.
+
+    A store opened with read_only=True (e.g. by the command-line tools while a
+    node is running) opens the index read-only and never touches the segment
+    files beyond mapping them.
+    """
+    def __init__(self, directory, max_file_size=128 * 1024 * 1024, magic=NETWORK_MAGIC, read_only=False):
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.magic = magic
+        self.read_only = read_only
+        self.index = rocksdb.DB(os.path.join(directory, 'index'), rocksdb.Options(create_if_missing=not read_only),
+                                read_only=read_only)
+        self._maps = {}  # File number -> mmap of the segment
+        best_height = self.index.get(BEST_HEIGHT_KEY)
+        self.best_height = struct.unpack('>I', best_height)[0] if best_height is not None else -1
+
+        end = self.index.get(BLOCK_FILE_END_KEY)
+        self.file_number, self.file_end = struct.unpack('>IQ', end) if end is not None else (0, 0)
+        self._file = None
+        if read_only:
+            return
+        # Drop anything written after the last indexed block (e.g. an interrupted append)
+        path = self._path(self.file_number)
+        if os.path.exists(path) and os.path.getsize(path) > self.file_end:
+            os.truncate(path, self.file_end)
+        self._file = open(path, 'ab')
+
+    def _path(self, file_number):
+        return os.path.join(self.directory, 'blk%05d.dat' % file_number)
+
+    @metrics.timed('block_store_append')
+    def append(self, block, height):
+        """
+        Append a block and index it, its compact filter and its transactions
+        under its hash and height.
+
+        :return: The BlockLocation of the stored block.
+        """
+        if self.read_only:
+            raise ValueError("Block store is open read-only")
+        frame = block.frame(self.magic, offset_table=True)
+        if self.file_end and self.file_end + len(frame) > self.max_file_size:
+            self._file.close()
+            self.file_number += 1
+            self.file_end = 0
+            self._file = open(self._path(self.file_number), 'ab')
+        location = BlockLocation(self.file_number, self.file_end, len(frame) - FRAME_HEADER_SIZE, height)
+        self._file.write(frame)
+        self._file.flush()
+        self.file_end += len(frame)
+
+        batch = rocksdb.WriteBatch()
+        block_hash = block.header_hash()
+        batch.put(BLOCK_HASH_PREFIX + block_hash, location.serialize())
+        batch.put(BLOCK_HEIGHT_PREFIX + struct.pack('>I', height), block_hash)
+        batch.put(BLOCK_FILE_END_KEY, struct.pack('>IQ', self.file_number, self.file_end))
+        batch.put(BLOCK_FILTER_PREFIX + block_hash, BlockFilter.build(block, block_hash).serialize())
+        spans = Block.transaction_spans(memoryview(frame)[FRAME_HEADER_SIZE:], 0, location.length, block.transactions)
+        for tx, (tx_offset, tx_length) in zip(block.transactions, spans):
+            batch.put(TX_PREFIX + tx.txid, block_hash + struct.pack('>II', tx_offset, tx_length))
+        if height > self.best_height:
+            batch.put(BEST_HEIGHT_KEY, struct.pack('>I', height))
+        self.index.write(batch)
+        self.best_height = max(self.best_height, height)
+        metrics.inc('block_store_bytes_written_total', len(frame))
+        return location
+
+    def sync(self):
+        """
+        Flush appended blocks to stable storage.
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def get_location(self, block_hash):
+        data = self.index.get(BLOCK_HASH_PREFIX + block_hash)
+        return BlockLocation.parse(data) if data is not None else None
+
+    def get_hash_at_height(self, height):
+        return self.index.get(BLOCK_HEIGHT_PREFIX + struct.pack('>I', height))
+
+    def get_filter(self, block_hash):
+        data = self.index.get(BLOCK_FILTER_PREFIX + block_hash)
+        return BlockFilter.parse(block_hash, data) if data is not None else None
+
+    def put_undo(self, block_hash, undo):
+        """
+        Store the BlockUndo of a connected block next to the block itself.
+        """
+        if self.read_only:
+            raise ValueError("Block store is open read-only")
+        data = undo.serialize()
+        self.index.put(UNDO_PREFIX + block_hash, data)
+        metrics.inc('block_store_undo_bytes_written_total', len(data))
+
+    def get_undo(self, block_hash):
+        data = self.index.get(UNDO_PREFIX + block_hash)
+        return BlockUndo.parse(data) if data is not None else None
+
+    def delete_undo(self, block_hash):
+        if self.read_only:
+            raise ValueError("Block store is open read-only")
+        self.index.delete(UNDO_PREFIX + block_hash)
+
+    def disconnect(self, block, height):
+        """
+        Unindex a block disconnected from the chain at `height`: its transactions
+        and its height entry are dropped, the best height falls back to the
+        block below and its undo record is deleted, all in one write batch. The
+        block itself stays stored and indexed by hash, so it can be reconnected.
+        Transaction entries that point at another block (a duplicate txid) are
+        kept.
+        """
+        if self.read_only:
+            raise ValueError("Block store is open read-only")
+        block_hash = block.header_hash()
+        batch = rocksdb.WriteBatch()
+        for tx in block.transactions:
+            key = TX_PREFIX + tx.txid
+            data = self.index.get(key)
+            if data is not None and data[:32] == block_hash:
+                batch.delete(key)
+        height_key = BLOCK_HEIGHT_PREFIX + struct.pack('>I', height)
+        if self.index.get(height_key) == block_hash:
+            batch.delete(height_key)
+        best_height = self.best_height
+        if height <= best_height:
+            best_height = height - 1
+            if best_height >= 0:
+                batch.put(BEST_HEIGHT_KEY, struct.pack('>I', best_height))
+            else:
+                batch.delete(BEST_HEIGHT_KEY)
+        batch.delete(UNDO_PREFIX + block_hash)
+        self.index.write(batch)
+        self.best_height = best_height
+
+    def get_transaction(self, txid):
+        """
+        Read one stored transaction without parsing the rest of its block.
+
+        :return: Tuple of (Transaction, block hash, BlockLocation), or None if it is not stored.
+        """
+        data = self.index.get(TX_PREFIX + txid)
+        if data is None:
+            return None
+        block_hash = data[:32]
+        tx_offset, tx_length = struct.unpack_from('>II', data, 32)
+        location = self.get_location(block_hash)
+        with self.read_raw(location) as view:
+            tx, consumed = Transaction.parse_from(view, tx_offset)
+        if consumed != tx_length:
+            raise ValueError("Transaction index entry of %s does not match its block" % txid.hex())
+        return tx, block_hash, location
+
+    def get_merkle_proof(self, txid):
+        """
+        Prove that a stored transaction is committed to by its block's Merkle root.
+        The leaves are hashed straight from the stored encodings; no transaction is
+        parsed (the stored block is version 2) and the block is never built.
+
+        :return: Tuple of (MerkleProof, block hash, BlockLocation), or None if it is not stored.
+        """
+        data = self.index.get(TX_PREFIX + txid)
+        if data is None:
+            return None
+        block_hash = data[:32]
+        tx_offset = struct.unpack_from('>I', data, 32)[0]
+        location = self.get_location(block_hash)
+        with self.read_raw(location) as view:
+            spans = Block.transaction_spans(view, 0, location.length)
+            index = next((i for i, (offset, _) in enumerate(spans) if offset == tx_offset), None)
+            if index is None:
+                raise ValueError("Transaction index entry of %s does not match its block" % txid.hex())
+            leaves = hash_leaves(view[offset:offset+length] for offset, length in spans)
+        proof = MerkleTree.from_leaves([leaves]).get_proof(index)
+        return proof, block_hash, location
+
+    def _map(self, location):
+        end = location.offset + FRAME_HEADER_SIZE + location.length
+        mapped = self._maps.get(location.file_number)
+        if mapped is None or len(mapped) < end:
+            # The segment grew since it was mapped; views of the old mapping stay valid until released
+            with open(self._path(location.file_number), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[location.file_number] = mapped
+        return mapped
+
+    def read_raw(self, location):
+        """
+        Return a zero-copy memoryview of the serialized block (frame header excluded).
+        """
+        metrics.inc('block_store_reads_total')
+        mapped = self._map(location)
+        magic, size = struct.unpack_from('>II', mapped, location.offset)
+        if magic != self.magic or size != location.length:
+            raise ValueError("Corrupt block frame in %s at offset %d" % (self._path(location.file_number), location.offset))
+        start = location.offset + FRAME_HEADER_SIZE
+        return memoryview(mapped)[start:start + location.length]
+
+    def get_raw_block(self, block_hash):
+        location = self.get_location(block_hash)
+        return self.read_raw(location) if location is not None else None
+
+    def get_block(self, block_hash):
+        location = self.get_location(block_hash)
+        if location is None:
+            return None
+        with self.read_raw(location) as view:
+            return Block.parse_from(view, 0, location.length)[0]
+
+    def get_block_at_height(self, height):
+        block_hash = self.get_hash_at_height(height)
+        return self.get_block(block_hash) if block_hash is not None else None
+
+    def iter_blocks(self, start_height=0, end_height=None):
+        """
+        Yield (height, Block) for consecutive stored heights, e.g. for a rescan.
+        """
+        height = start_height
+        while end_height is None or height < end_height:
+            block = self.get_block_at_height(height)
+            if block is None:
+                return
+            yield height, block
+            height += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        for mapped in self._maps.values():
+            try:
+                mapped.close()
+            except BufferError:
+                pass  # Still referenced by a memoryview handed out to a caller
+        self._maps.clear()
@@ -0,0 +1,155 @@
+# Chain state records: coins, domain records and block undo records, and their serialization
+import struct
+
+from ..core.transaction import CoinOutput, encode_varint, read_varint
+from ..core.domain import FullDomain, domain_name_hash
+
+COIN_FLAG_COINBASE = 0x01
+COIN_FLAG_V2 = 0x02  # The output is stored in the version 2 encoding (ScriptPubKey longer than 255 bytes)
+
+
+class Coin:
+    """
+    An unspent CoinOutput together with the height of the block that created it
+    and whether it came from a coinbase transaction.
+    """
+    __slots__ = ('output', 'height', 'is_coinbase')
+
+    def __init__(self, output, height, is_coinbase=False):
+        self.output = output  # CoinOutput
+        self.height = height  # 4 bytes (block height)
+        self.is_coinbase = is_coinbase  # 1 byte (coinbase flag)
+
+    def serialize(self):
+        # Height (4 bytes), Flags (1 byte: bit 0 coinbase, bit 1 VarInt ScriptPubKey length), CoinOutput (variable length)
+        if len(self.output.script_pub_key) > 255:
+            # Only version 2 transactions can create such outputs
+            return struct.pack('>IB', self.height, self.is_coinbase | COIN_FLAG_V2) + self.output.serialize_v2()
+        return struct.pack('>IB', self.height, self.is_coinbase) + self.output.serialize()
+
+    @staticmethod
+    def parse(data):
+        return Coin.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        :return: Tuple of (Coin, number of bytes consumed)
+        """
+        height, flags = struct.unpack_from('>IB', view, offset)
+        output, consumed = CoinOutput.parse_from(view, offset + 5, bool(flags & COIN_FLAG_V2))
+        return Coin(output, height, bool(flags & COIN_FLAG_COINBASE)), 5 + consumed
+
+    def to_json(self):
+        return {
+            'height': self.height,
+            'is_coinbase': self.is_coinbase,
+            'output': self.output.to_json()
+        }
+
+
+class DomainRecord:
+    """
+    Current state of an issued domain: where it lives (the outpoint of its latest
+    domain output), its owner's public key hash and its IP address.
+    """
+    __slots__ = ('full_domain', 'owner_pub_key_hash', 'txid', 'output_index', 'height')
+
+    def __init__(self, full_domain, owner_pub_key_hash, txid, output_index, height):
+        self.full_domain = full_domain  # FullDomain (name, TLD and current IP)
+        self.owner_pub_key_hash = owner_pub_key_hash  # 20 bytes (owner public key hash)
+        self.txid = txid  # 32 bytes (transaction holding the current domain output)
+        self.output_index = output_index  # 4 bytes (index of that domain output)
+        self.height = height  # 4 bytes (height of the block that last updated the domain)
+
+    @property
+    def name_hash(self):
+        return domain_name_hash(self.full_domain.domain_name, self.full_domain.tld)
+
+    def serialize(self):
+        # Owner PKH (20 bytes), TXID (32 bytes), Output Index (4 bytes), Height (4 bytes),
+        # Full Domain (55 or 67 bytes)
+        return (self.owner_pub_key_hash + self.txid +
+                struct.pack('>II', self.output_index, self.height) + self.full_domain.serialize())
+
+    @staticmethod
+    def parse(data):
+        return DomainRecord.parse_from(memoryview(data))[0]
+
+    @staticmethod
+    def parse_from(view, offset=0):
+        """
+        :return: Tuple of (DomainRecord, number of bytes consumed)
+        """
+        owner_pub_key_hash = bytes(view[offset:offset+20])
+        txid = bytes(view[offset+20:offset+52])
+        output_index, height = struct.unpack_from('>II', view, offset+52)
+        full_domain, consumed = FullDomain.parse_from(view, offset + 60)
+        return DomainRecord(full_domain, owner_pub_key_hash, txid, output_index, height), 60 + consumed
+
+    def to_json(self):
+        return {
+            'full_domain': self.full_domain.get_full_domain(),
+            'owner_pub_key_hash': self.owner_pub_key_hash.hex(),
+            'txid': self.txid.hex(),
+            'output_index': self.output_index,
+            'height': self.height
+        }
+
+
+class BlockUndo:
+    """
+    What connecting a block destroyed, so it can be disconnected without
+    replaying the chain: the coins its coin inputs spent and the previous
+    records of the domains its transfers and IP changes moved. Outpoints and
+    name hashes are not stored; they are read back from the block itself, whose
+    inputs line up with the two lists.
+    """
+    __slots__ = ('spent_coins', 'previous_domains')
+
+    def __init__(self, spent_coins=(), previous_domains=()):
+        self.spent_coins = list(spent_coins)  # Coins, in the order of the block's coin inputs
+        self.previous_domains = list(previous_domains)  # DomainRecords, in the order of the block's domain inputs
+
+    @staticmethod
+    def from_changes(spent, domain_changes=()):
+        """
+        Build the undo record from what CoinsCache.connect_block and DomainIndex.connect_block returned.
+        """
+        return BlockUndo([coin for _, _, coin in spent],
+                         [record for _, record in domain_changes if record is not None])
+
+    def serialize(self):
+        # Spent Coin Count (VarInt), Coins (variable length),
+        # Previous Domain Count (VarInt), DomainRecords (variable length)
+        return b''.join([encode_varint(len(self.spent_coins))] + [coin.serialize() for coin in self.spent_coins] +
+                        [encode_varint(len(self.previous_domains))] +
+                        [record.serialize() for record in self.previous_domains])
+
+    @staticmethod
+    def parse(data):
+        view = memoryview(data)
+        offset = 0
+        spent_coins = []
+        count, consumed = read_varint(view, offset)
+        offset += consumed
+        for _ in range(count):
+            coin, consumed = Coin.parse_from(view, offset)
+            spent_coins.append(coin)
+            offset += consumed
+        previous_domains = []
+        count, consumed = read_varint(view, offset)
+        offset += consumed
+        for _ in range(count):
+            record, consumed = DomainRecord.parse_from(view, offset)
+            previous_domains.append(record)
+            offset += consumed
+        if offset != len(view):
+            raise ValueError("Trailing bytes after undo record")
+        return BlockUndo(spent_coins, previous_domains)
+
+    def to_json(self):
+        return {
+            'spent_coins': [coin.to_json() for coin in self.spent_coins],
+            'previous_domains': [record.to_json() for record in self.previous_domains]
+        }
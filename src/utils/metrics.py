@@ -0,0 +1,309 @@
+# Instrumentation: counters, histograms and timing spans, structured logs and a Prometheus text endpoint
+import bisect
+import functools
+import sys
+import time
+
+# structlog, logging and asyncio are imported on first use: metrics is imported by
+# most modules, and none of them is needed until logging is enabled or the
+# endpoint started
+
+# Latency buckets in seconds, from 50 microseconds to 10 seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = False  # Instrumented code checks this before doing any work; see enable()
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in key)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.values = {}  # Label key -> value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    """
+    Counts of observations per bucket (cumulative on output), plus their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # Label key -> [bucket counts..., overflow count, sum]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def get_count(self, **labels):
+        entry = self.values.get(_label_key(labels))
+        return sum(entry[:-1]) if entry is not None else 0
+
+    def get_sum(self, **labels):
+        entry = self.values.get(_label_key(labels))
+        return entry[-1] if entry is not None else 0.0
+
+    def samples(self):
+        for key, entry in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-1]):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', _format_value(float(bound))),), cumulative
+            yield self.name + '_sum', key, entry[-1]
+            yield self.name + '_count', key, cumulative
+
+
+class Registry:
+    """
+    Metrics by name. counter(), gauge() and histogram() return the existing
+    metric of that name or create it, so call sites need no setup.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, *args)
+        elif type(metric) is not cls:
+            raise ValueError("Metric %s is already registered as a %s" % (name, metric.kind))
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def clear(self):
+        self.metrics.clear()
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            if metric.help:
+                lines.append('# HELP %s %s' % (name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample_name, key, value in metric.samples():
+                lines.append('%s%s %s' % (sample_name, _format_labels(key), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Span:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **labels):
+    """
+    Context manager timing its body into the histogram `<name>_seconds`.
+    While instrumentation is disabled it returns a shared no-op object.
+    """
+    if not enabled:
+        return _NOOP_SPAN
+    return _Span(REGISTRY.histogram(name + '_seconds'), labels)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function into the histogram `<name>_seconds`.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                REGISTRY.histogram(name + '_seconds').observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def inc(name, amount=1, **labels):
+    """
+    Add to the counter `name` (by convention ending in _total).
+    """
+    if enabled:
+        REGISTRY.counter(name).inc(amount, **labels)
+
+
+def observe(name, value, **labels):
+    if enabled:
+        REGISTRY.histogram(name).observe(value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    if enabled:
+        REGISTRY.gauge(name).set(value, **labels)
+
+
+def get_logger(name):
+    """
+    Structured logger for a component. Events are only emitted at the level
+    configured by enable(); log calls on hot paths should still be guarded by
+    `if metrics.enabled` so their arguments are not computed for nothing.
+    Modules take their logger at import time, so structlog itself is only
+    loaded when the first event is logged.
+    """
+    return _LazyLogger(name)
+
+
+class _LazyLogger:
+    __slots__ = ('name', '_logger')
+
+    def __init__(self, name):
+        self.name = name
+        self._logger = None
+
+    def __getattr__(self, attribute):
+        if self._logger is None:
+            import structlog
+            self._logger = structlog.get_logger(component=self.name)
+        return getattr(self._logger, attribute)
+
+
+def enable(log_level=None, json_logs=True, stream=None):
+    """
+    Turn instrumentation on and configure structlog to write one event per
+    line to `stream` (stderr by default), as JSON or in the console format.
+    Events below `log_level` (logging.INFO by default) are dropped.
+    """
+    global enabled
+    import logging
+    import structlog
+    if log_level is None:
+        log_level = logging.INFO
+    renderer = structlog.processors.JSONRenderer() if json_logs else structlog.dev.ConsoleRenderer(colors=False)
+    structlog.configure(
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt='iso'),
+            renderer
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(log_level),
+        logger_factory=structlog.PrintLoggerFactory(stream or sys.stderr),
+        cache_logger_on_first_use=False
+    )
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+async def _serve(registry, reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass  # Skip the request headers
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] in (b'/metrics', b'/'):
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', registry.render().encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'Not found\n'
+        writer.write(('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (status, content_type, len(body))).encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host='127.0.0.1', port=9464, registry=REGISTRY):
+    """
+    Serve the registry at http://host:port/metrics for Prometheus to scrape.
+
+    :return: The asyncio server; close() it to stop.
+    """
+    import asyncio
+    return await asyncio.start_server(functools.partial(_serve, registry), host, port)
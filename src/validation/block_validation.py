@@ -0,0 +1,433 @@
+# Block validation pipeline for initial block download
+import time
+from collections import deque
+
+from ..core.block import Block
+from ..core.domain import domain_name_hash, normalize_domain
+from ..storage.records import BlockUndo
+from ..core.script import (SigHashCache, SignatureChecker, ScriptError, Script, verify_script,
+                           STANDARD_SCRIPT_VERIFY_FLAGS, SCRIPT_VERIFY_NULLFAIL)
+from ..crypto.crypto import SignatureVerifier
+from ..consensus.pow import meets_target
+from ..utils import metrics
+
+MAX_BLOCK_SIZE = 1000000
+MAX_MONEY = 21000000 * 10**8
+INITIAL_SUBSIDY = 50 * 10**8
+HALVING_INTERVAL = 210000
+
+COINBASE = 0
+DOMAIN_COINBASE = 4
+
+STAGES = ('parse', 'check', 'prevouts', 'scripts', 'apply')
+
+log = metrics.get_logger('validation')
+
+
+def block_subsidy(height):
+    """
+    Coin reward of the block at `height`, halving every 210,000 blocks as in Bitcoin.
+    """
+    halvings = height // HALVING_INTERVAL
+    return INITIAL_SUBSIDY >> halvings if halvings < 64 else 0
+
+
+def parse_script_sig(script_sig):
+    """
+    Split a P2PKH ScriptSig (Script.createP2PKH_ScriptSig) into (signature, public key).
+    """
+    if not script_sig:
+        raise ValueError("Empty ScriptSig")
+    signature_length = script_sig[0]
+    end = 1 + signature_length
+    if end >= len(script_sig) or end + 1 + script_sig[end] != len(script_sig):
+        raise ValueError("Malformed ScriptSig")
+    return bytes(script_sig[1:end]), bytes(script_sig[end+1:])
+
+
+def check_block(block, size, check_pow=True):
+    """
+    Context-free checks: everything that can be verified from the block alone.
+
+    :raises ValueError: If the block is invalid.
+    """
+    if size > MAX_BLOCK_SIZE:
+        raise ValueError("Block is %d bytes, more than %d" % (size, MAX_BLOCK_SIZE))
+    if check_pow and not meets_target(block):
+        raise ValueError("Block does not meet its proof-of-work target")
+    transactions = block.transactions
+    if not transactions or transactions[0].tx_type != COINBASE:
+        raise ValueError("The first transaction must be the coinbase")
+    if Block.calculateMerkleRoot(transactions) != block.merkle_root:
+        raise ValueError("Merkle root mismatch")
+
+    txids = set()
+    for index, tx in enumerate(transactions):
+        if tx.txid in txids:
+            raise ValueError("Duplicate transaction %s" % tx.txid.hex())
+        txids.add(tx.txid)
+        if tx.tx_type == COINBASE and index != 0:
+            raise ValueError("More than one coinbase transaction")
+        if tx.tx_type == DOMAIN_COINBASE and index != 1:
+            raise ValueError("The domain coinbase must directly follow the coinbase")
+        if tx.tx_type in (COINBASE, DOMAIN_COINBASE):
+            if tx.coin_inputs or tx.domain_inputs:
+                raise ValueError("Coinbase transactions cannot have inputs")
+            if tx.tx_type == DOMAIN_COINBASE and len(tx.domain_outputs) != 1:
+                raise ValueError("A domain coinbase issues exactly one domain")
+            if tx.tx_type == DOMAIN_COINBASE and tx.coin_outputs:
+                # Only the coinbase is covered by the subsidy check
+                raise ValueError("A domain coinbase cannot have coin outputs")
+        elif not tx.coin_inputs and not tx.domain_inputs:
+            raise ValueError("Transaction %s has no inputs" % tx.txid.hex())
+        if tx.tx_type in (2, 3) and len(tx.domain_inputs) != len(tx.domain_outputs):
+            raise ValueError("Domain inputs and outputs of %s must pair up" % tx.txid.hex())
+        if len({(i.txid, i.output_index) for i in tx.coin_inputs}) != len(tx.coin_inputs):
+            raise ValueError("Transaction %s spends a coin twice" % tx.txid.hex())
+        total = 0
+        for output in tx.coin_outputs:
+            total += output.value
+            if output.value > MAX_MONEY or total > MAX_MONEY:
+                raise ValueError("Transaction %s output value out of range" % tx.txid.hex())
+
+
+class PipelineStats:
+    """
+    Cumulative wall time spent in each stage, and throughput. Because signature
+    checks run in worker processes while the main process parses, checks and
+    applies other blocks, the 'scripts' figure is only the time spent waiting
+    for results that were not ready yet.
+    """
+    def __init__(self):
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.blocks = 0
+        self.transactions = 0
+        self.signatures = 0
+        self.cached_scripts = 0  # Inputs skipped because the script cache held them
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def blocks_per_second(self):
+        return self.blocks / self.elapsed if self.elapsed else 0.0
+
+    def to_json(self):
+        return {
+            'blocks': self.blocks,
+            'transactions': self.transactions,
+            'signatures': self.signatures,
+            'cached_scripts': self.cached_scripts,
+            'elapsed_seconds': self.elapsed,
+            'blocks_per_second': self.blocks_per_second,
+            'stage_seconds': dict(self.stage_seconds)
+        }
+
+
+class _PendingBlock:
+    __slots__ = ('block', 'height', 'size', 'signatures', 'stage_seconds', 'futures', 'created', 'spent',
+                 'domains_created', 'domains_spent', 'domains_issued')
+
+    def __init__(self, block, height, size):
+        self.block = block
+        self.height = height
+        self.size = size
+        self.signatures = 0
+        self.stage_seconds = {}  # Stage -> seconds spent on this block
+        self.futures = []
+        self.created = []  # Coin outpoints created, still only in the overlay
+        self.spent = []  # Coin outpoints spent, still only in the overlay
+        self.domains_created = []
+        self.domains_spent = []
+        self.domains_issued = []  # Name hashes issued by domain coinbases
+
+
+class ValidationPipeline:
+    """
+    Validates and connects consecutive blocks during initial block download in
+    five stages:
+
+    1. parse: raw bytes -> Block.
+    2. check: context-free checks (check_block).
+    3. prevouts: resolve the coin and domain outputs every input spends, check
+       amounts, run each input's script against the spent output (see
+       script.verify_script) and hand the signatures it checks to the
+       SignatureVerifier's process pool.
+    4. scripts: collect the signature results.
+    5. apply: connect the block to the coins cache and the domain index, in order.
+
+    Up to `window` blocks are in flight between stages 3 and 5, so the worker
+    pool verifies the signatures of blocks N..N+window while the main process
+    parses, checks and resolves the next ones. Outputs created and spent by
+    in-flight blocks live in an overlay on top of the coins cache and domain
+    index until their block is applied, so resolving block N+1 does not wait
+    for block N to be connected.
+
+    :param coins: Coin view with get_coin(txid, index) and connect_block(block, height), e.g. CoinsCache.
+    :param domains: Optional domain view with get_by_outpoint(txid, index) and
+                    connect_block(block, height), e.g. DomainIndex.
+    :param verifier: SignatureVerifier to use; one is created (and closed) by the pipeline if None.
+    :param script_cache: Optional ScriptCache shared with the Mempool; inputs it holds were verified
+                         on mempool entry with the same flags and are not run again.
+    :param script_flags: Script verification flags. Without SCRIPT_VERIFY_NULLFAIL signatures cannot be
+                         deferred to the pool and are checked as each script runs.
+    :param undo_store: Optional store with put_undo(block_hash, BlockUndo), e.g. BlockStore. Each applied
+                       block's undo record is written to it, so reorg.ChainRollback can disconnect it.
+    :param progress: Optional callable receiving the PipelineStats every `progress_interval` seconds.
+    """
+    def __init__(self, coins, domains=None, verifier=None, window=8, check_pow=True,
+                 progress=None, progress_interval=5.0, script_cache=None, script_flags=STANDARD_SCRIPT_VERIFY_FLAGS,
+                 undo_store=None):
+        self.coins = coins
+        self.domains = domains
+        self.undo_store = undo_store
+        self.verifier = verifier
+        self.script_cache = script_cache
+        self.script_flags = script_flags
+        self.owns_verifier = verifier is None
+        self.window = window
+        self.check_pow = check_pow
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stats = PipelineStats()
+        self._pending = deque()
+        self._created = {}  # (txid, index) -> CoinOutput created by an in-flight block
+        self._spent = set()  # (txid, index) spent by an in-flight block
+        self._domains_created = {}  # (txid, index) -> owner public key hash
+        self._domains_spent = set()
+        self._domains_issued = set()  # Name hashes issued by an in-flight block
+        self._last_progress = time.perf_counter()
+
+    # Stage 3
+
+    def _resolve_coin(self, outpoint):
+        if outpoint in self._spent:
+            raise ValueError("Output %s:%d is already spent" % (outpoint[0].hex(), outpoint[1]))
+        output = self._created.get(outpoint)
+        if output is None:
+            coin = self.coins.get_coin(*outpoint)
+            if coin is None:
+                raise ValueError("Output %s:%d is missing or already spent" % (outpoint[0].hex(), outpoint[1]))
+            output = coin.output
+        return output
+
+    def _resolve_domain_owner(self, outpoint):
+        if outpoint in self._domains_spent:
+            raise ValueError("Domain output %s:%d is already spent" % (outpoint[0].hex(), outpoint[1]))
+        owner = self._domains_created.get(outpoint)
+        if owner is None:
+            record = self.domains.get_by_outpoint(*outpoint)
+            if record is None:
+                raise ValueError("Domain output %s:%d is missing or already spent" % (outpoint[0].hex(), outpoint[1]))
+            owner = record.owner_pub_key_hash
+        return owner
+
+    def _check_issuance(self, domain):
+        name_hash = domain_name_hash(domain.domain_name, domain.tld)
+        if name_hash in self._domains_issued or self.domains.get_by_hash(name_hash) is not None:
+            raise ValueError("Domain %s already exists" % normalize_domain(domain.domain_name, domain.tld))
+        return name_hash
+
+    def _cached(self, txid, input_index):
+        if self.script_cache is None or not self.script_cache.consume(txid, input_index, self.script_flags):
+            return False
+        self.stats.cached_scripts += 1
+        return True
+
+    def _resolve(self, pending):
+        """
+        Resolve every input of the block against the overlay and the views,
+        record the block's own effects in the overlay and return its signature
+        jobs. If the block is invalid its effects are taken out of the overlay
+        again.
+        """
+        try:
+            return self._resolve_block(pending)
+        except ValueError:
+            self._release(pending)
+            raise
+
+    def _resolve_block(self, pending):
+        block = pending.block
+        jobs = []
+        deferred = jobs if self.script_flags & SCRIPT_VERIFY_NULLFAIL else None
+        fees = 0
+        for tx in block.transactions:
+            txid = tx.txid
+            sighash_cache = SigHashCache(tx) if tx.coin_inputs or tx.domain_inputs else None
+            if tx.tx_type not in (COINBASE, DOMAIN_COINBASE):
+                value_in = 0
+                for input_index, coin_input in enumerate(tx.coin_inputs):
+                    outpoint = (coin_input.txid, coin_input.output_index)
+                    output = self._resolve_coin(outpoint)
+                    value_in += output.value
+                    if not self._cached(txid, input_index):
+                        checker = SignatureChecker(sighash_cache, input_index, output.value, jobs=deferred)
+                        try:
+                            verify_script(coin_input.script_sig, output.script_pub_key, checker, self.script_flags)
+                        except ScriptError as e:
+                            raise ValueError("Input %s:%d fails its script: %s" % (txid.hex(), input_index, e))
+                    self._spent.add(outpoint)
+                    pending.spent.append(outpoint)
+                value_out = sum(output.value for output in tx.coin_outputs)
+                if value_in < value_out:
+                    raise ValueError("Transaction %s spends more than its inputs" % txid.hex())
+                fees += value_in - value_out
+
+            if self.domains is not None:
+                for index, domain_input in enumerate(tx.domain_inputs):
+                    outpoint = (domain_input.domain_txid, domain_input.output_index)
+                    owner = self._resolve_domain_owner(outpoint)
+                    if not self._cached(txid, len(tx.coin_inputs) + index):
+                        checker = SignatureChecker(sighash_cache, index, owner_pub_key_hash=owner, jobs=deferred)
+                        try:
+                            verify_script(domain_input.script_sig, Script.createP2PKH_ScriptPubKey(owner), checker,
+                                          self.script_flags)
+                        except ScriptError as e:
+                            raise ValueError("Domain input of %s is not signed by the domain owner: %s"
+                                             % (txid.hex(), e))
+                    self._domains_spent.add(outpoint)
+                    pending.domains_spent.append(outpoint)
+                    if tx.tx_type == 3 and index < len(tx.domain_outputs):
+                        self._domains_created[(txid, index)] = owner  # An IP change keeps the owner
+                        pending.domains_created.append((txid, index))
+                for index, output in enumerate(tx.domain_outputs):
+                    if tx.tx_type == 2:
+                        self._domains_created[(txid, index)] = output.new_owner_pub_key_hash
+                    elif tx.tx_type == DOMAIN_COINBASE:
+                        name_hash = self._check_issuance(output.full_domain)
+                        self._domains_issued.add(name_hash)
+                        pending.domains_issued.append(name_hash)
+                        self._domains_created[(txid, index)] = output.owner_pub_key_hash
+                    else:
+                        continue
+                    pending.domains_created.append((txid, index))
+
+            for index, output in enumerate(tx.coin_outputs):
+                self._created[(txid, index)] = output
+                pending.created.append((txid, index))
+
+        coinbase_value = sum(output.value for output in block.transactions[0].coin_outputs)
+        if coinbase_value > block_subsidy(pending.height) + fees:
+            raise ValueError("Coinbase pays %d, more than the subsidy and fees" % coinbase_value)
+        return jobs
+
+    def _release(self, pending):
+        """
+        Take a block's effects out of the overlay, once it is connected to the
+        views or found invalid.
+        """
+        for outpoint in pending.created:
+            self._created.pop(outpoint, None)
+        self._spent.difference_update(pending.spent)
+        for outpoint in pending.domains_created:
+            self._domains_created.pop(outpoint, None)
+        self._domains_spent.difference_update(pending.domains_spent)
+        self._domains_issued.difference_update(pending.domains_issued)
+
+    # Stages 4 and 5
+
+    def _finish(self, pending):
+        started = time.perf_counter()
+        for future in pending.futures:
+            if not all(future.result()):
+                for other in self._pending:
+                    for other_future in other.futures:
+                        other_future.cancel()
+                raise ValueError("Invalid signature in block at height %d" % pending.height)
+        applied = time.perf_counter()
+        self.stats.stage_seconds['scripts'] += applied - started
+        pending.stage_seconds['scripts'] = applied - started
+
+        # The domain index writes a whole block or nothing, so it goes first: if it
+        # rejects the block, no coin has changed yet
+        domain_changes = self.domains.connect_block(pending.block, pending.height) if self.domains is not None else ()
+        spent = self.coins.connect_block(pending.block, pending.height)
+        if self.undo_store is not None:
+            self.undo_store.put_undo(pending.block.header_hash(), BlockUndo.from_changes(spent, domain_changes))
+        self._release(pending)  # The views now hold the block's effects
+        now = time.perf_counter()
+        self.stats.stage_seconds['apply'] += now - applied
+        pending.stage_seconds['apply'] = now - applied
+        if metrics.enabled:
+            self._record(pending)
+
+        self.stats.blocks += 1
+        self.stats.transactions += len(pending.block.transactions)
+        self.stats.elapsed = now - self.stats.started
+        if self.progress is not None and now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            self.progress(self.stats)
+
+    def _record(self, pending):
+        """
+        Per-block metrics and a structured log event for a connected block.
+        """
+        for stage, seconds in pending.stage_seconds.items():
+            metrics.observe('block_stage_seconds', seconds, stage=stage)
+        metrics.inc('blocks_connected_total')
+        metrics.inc('transactions_connected_total', len(pending.block.transactions))
+        metrics.set_gauge('validation_height', pending.height)
+        log.info('block_connected', height=pending.height, hash=pending.block.header_hash().hex(),
+                 size=pending.size, txs=len(pending.block.transactions), signatures=pending.signatures,
+                 stage_ms={stage: round(seconds * 1000, 3) for stage, seconds in pending.stage_seconds.items()})
+
+    # Driver
+
+    def submit(self, raw_block, height):
+        """
+        Feed the next block (serialized, without frame header) into the pipeline.
+        Blocks must be submitted in chain order. Returns once the block is in
+        flight; the oldest in-flight block is connected when the window is full.
+        """
+        if self.verifier is None:
+            self.verifier = SignatureVerifier()
+        stage_seconds = self.stats.stage_seconds
+        started = time.perf_counter()
+        block = Block.parse(raw_block)
+        parsed = time.perf_counter()
+        stage_seconds['parse'] += parsed - started
+
+        check_block(block, len(raw_block), self.check_pow)
+        checked = time.perf_counter()
+        stage_seconds['check'] += checked - parsed
+
+        pending = _PendingBlock(block, height, len(raw_block))
+        jobs = self._resolve(pending)
+        if jobs:
+            pending.futures = self.verifier.submit(jobs)
+        pending.signatures = len(jobs)
+        self.stats.signatures += len(jobs)
+        self._pending.append(pending)
+        resolved = time.perf_counter()
+        stage_seconds['prevouts'] += resolved - checked
+        pending.stage_seconds.update(parse=parsed - started, check=checked - parsed, prevouts=resolved - checked)
+
+        while self._pending and (len(self._pending) > self.window or
+                                 all(future.done() for future in self._pending[0].futures)):
+            self._finish(self._pending.popleft())
+
+    def flush(self):
+        """
+        Connect every block still in flight.
+        """
+        while self._pending:
+            self._finish(self._pending.popleft())
+
+    def run(self, raw_blocks, start_height=0):
+        """
+        Validate and connect a sequence of serialized blocks starting at `start_height`.
+
+        :return: PipelineStats
+        """
+        try:
+            for height, raw_block in enumerate(raw_blocks, start_height):
+                self.submit(raw_block, height)
+            self.flush()
+        finally:
+            self.close()
+        return self.stats
+
+    def close(self):
+        if self.owns_verifier and self.verifier is not None:
+            self.verifier.close()
+            self.verifier = None
@@ -0,0 +1,145 @@
+# Chain rollback: disconnect tip blocks from the coin set and domain index using their stored undo records
+import time
+
+from ..utils import metrics
+
+DEFAULT_MAX_DEPTH = 288  # Deepest rollback_to() will go looking for the fork point
+
+log = metrics.get_logger('reorg')
+
+
+class RollbackStats:
+    """
+    Depth and cost of one rollback.
+    """
+    def __init__(self):
+        self.depth = 0  # Blocks disconnected
+        self.transactions = 0
+        self.coins_restored = 0
+        self.domains_restored = 0
+        self.elapsed = 0.0
+        self.tip = None  # Hash of the block the coin set ends at
+
+    def to_json(self):
+        return {
+            'depth': self.depth,
+            'transactions': self.transactions,
+            'coins_restored': self.coins_restored,
+            'domains_restored': self.domains_restored,
+            'elapsed_seconds': self.elapsed,
+            'tip': self.tip.hex() if self.tip is not None else None
+        }
+
+
+class ChainRollback:
+    """
+    Disconnects blocks from the tip of the connected chain, newest first, by
+    applying the undo records the ValidationPipeline stored for them: each
+    block's outputs are removed, the coins it spent are put back and the domains
+    it issued, transferred or re-pointed get their previous records back. No
+    block below the fork point is read, so a reorg costs the depth of the fork,
+    not the length of the chain.
+
+    After a rollback the coin set and the domain index end at the fork point;
+    connect the competing branch with a ValidationPipeline from there.
+
+    Listeners added with add_listener() are called with (block hash, Block) for
+    every disconnected block, e.g. APIServer.block_disconnected to drop cached
+    results that no longer hold.
+
+    :param store: Block source with get_block(), get_raw_block(), get_location(), get_undo()
+                  and disconnect(block, height), e.g. BlockStore.
+    :param coins: Coin view with best_block and disconnect_block(block, spent_coins), e.g. CoinsCache.
+    :param domains: Optional domain view with disconnect_block(block, previous_records), e.g. DomainIndex.
+    """
+    def __init__(self, store, coins, domains=None):
+        self.store = store
+        self.coins = coins
+        self.domains = domains
+        self.listeners = []  # Called with (block hash, Block) for every disconnected block
+
+    @property
+    def tip(self):
+        return self.coins.best_block
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _disconnect_tip(self, stats):
+        block_hash = self.coins.best_block
+        if block_hash is None:
+            raise ValueError("No connected block to disconnect")
+        if self.domains is not None and self.domains.get_best_block() not in (None, block_hash):
+            raise ValueError("Domain index is at %s, not at the coin tip %s" %
+                             (self.domains.get_best_block().hex(), block_hash.hex()))
+        location = self.store.get_location(block_hash)
+        block = self.store.get_block(block_hash) if location is not None else None
+        if block is None:
+            raise ValueError("Block %s is not stored" % block_hash.hex())
+        undo = self.store.get_undo(block_hash)
+        if undo is None:
+            raise ValueError("No undo record for block %s" % block_hash.hex())
+
+        # The reverse of ValidationPipeline's apply stage: coins first, then domains
+        self.coins.disconnect_block(block, undo.spent_coins)
+        if self.domains is not None:
+            self.domains.disconnect_block(block, undo.previous_domains)
+        self.store.disconnect(block, location.height)
+        for listener in self.listeners:
+            listener(block_hash, block)
+
+        stats.depth += 1
+        stats.transactions += len(block.transactions)
+        stats.coins_restored += len(undo.spent_coins)
+        stats.domains_restored += len(undo.previous_domains)
+        if metrics.enabled:
+            metrics.inc('blocks_disconnected_total')
+            log.debug('block_disconnected', hash=block_hash.hex(), txs=len(block.transactions),
+                      coins=len(undo.spent_coins), domains=len(undo.previous_domains))
+
+    def _finish(self, stats, started):
+        stats.elapsed = time.perf_counter() - started
+        stats.tip = self.coins.best_block
+        if metrics.enabled:
+            metrics.inc('reorgs_total')
+            metrics.set_gauge('reorg_last_depth', stats.depth)
+            metrics.observe('reorg_seconds', stats.elapsed)
+            log.info('chain_rolled_back', depth=stats.depth, tip=stats.tip.hex() if stats.tip is not None else None,
+                     coins=stats.coins_restored, domains=stats.domains_restored,
+                     ms=round(stats.elapsed * 1000, 3))
+        return stats
+
+    def rollback(self, blocks):
+        """
+        Disconnect the `blocks` newest connected blocks.
+
+        :return: RollbackStats
+        """
+        stats = RollbackStats()
+        started = time.perf_counter()
+        for _ in range(blocks):
+            self._disconnect_tip(stats)
+        return self._finish(stats, started)
+
+    def rollback_to(self, fork_hash, max_depth=DEFAULT_MAX_DEPTH):
+        """
+        Disconnect blocks until `fork_hash`, the last block shared with the
+        competing branch (e.g. from HeaderIndex.find_fork), is the tip. The depth
+        is found by walking the stored headers back from the tip before anything
+        is disconnected, so a fork point off the connected chain changes nothing.
+
+        :return: RollbackStats
+        :raises ValueError: If `fork_hash` is not within `max_depth` blocks of the tip.
+        """
+        depth = 0
+        block_hash = self.coins.best_block
+        while block_hash != fork_hash:
+            if depth == max_depth or block_hash is None:
+                raise ValueError("Block %s is not within %d blocks of the tip" % (fork_hash.hex(), max_depth))
+            raw = self.store.get_raw_block(block_hash)
+            if raw is None:
+                raise ValueError("Block %s is not stored" % block_hash.hex())
+            with raw:
+                block_hash = bytes(raw[4:36])  # Previous Block Hash
+            depth += 1
+        return self.rollback(depth)
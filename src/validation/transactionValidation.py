@@ -1,11 +1 @@
-import sys
-import os
-# Add the src directory to sys.path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'core')))
-
-from wallet import * 
-from block import *
-from script import *
-from transaction import *
-
-# Example usage
+# Transaction validation rules
@@ -0,0 +1,48 @@
+# Tests for the context-free block checks
+import pytest
+
+from libertydns.core.block import Block
+from libertydns.core.domain import FullDomain
+from libertydns.core.transaction import TransactionBuilder
+from libertydns.validation.block_validation import check_block, block_subsidy, MAX_MONEY
+
+OWNER = b'\x11' * 20
+SCRIPT = b'\x76\xa9\x14' + OWNER + b'\x88\xac'
+
+
+def make_block(transactions):
+    return Block(1, b'\x00' * 32, Block.calculateMerkleRoot(transactions), 1700000000, 0x207fffff, 0, transactions)
+
+
+def coinbase(height=1):
+    return TransactionBuilder(tx_type=0, lock_time=height).add_coin_output(block_subsidy(height), SCRIPT).build()
+
+
+def domain_coinbase(height=1):
+    return TransactionBuilder(tx_type=4, lock_time=height).add_domain_issue_output(
+        FullDomain("example", "dns", "10.0.0.1"), OWNER)
+
+
+def check(block):
+    check_block(block, len(block.serialize()), check_pow=False)
+
+
+def test_domain_coinbase_is_accepted():
+    check(make_block([coinbase(), domain_coinbase().build()]))
+
+
+def test_domain_coinbase_with_coin_outputs_is_rejected():
+    minting = domain_coinbase().add_coin_output(MAX_MONEY - 1, SCRIPT).build()
+    with pytest.raises(ValueError, match="coin outputs"):
+        check(make_block([coinbase(), minting]))
+
+
+def test_unpaired_domain_transfer_is_rejected():
+    transfer = (TransactionBuilder(tx_type=2)
+                .add_coin_input(b'\x22' * 32, 0, b'')
+                .add_domain_input(b'\x33' * 32, 0, b'')
+                .add_domain_input(b'\x33' * 32, 1, b'')
+                .add_domain_output(OWNER)
+                .build())
+    with pytest.raises(ValueError, match="pair up"):
+        check(make_block([coinbase(), transfer]))
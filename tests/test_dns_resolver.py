@@ -0,0 +1,39 @@
+# Tests for DNS answers served from the domain index
+import pytest
+
+from libertydns.core.block import Block
+from libertydns.core.domain import FullDomain
+from libertydns.core.transaction import TransactionBuilder
+from libertydns.dns.dns_resolver import DNSQuery, DNSResolver, build_query, TYPE_A
+
+rocksdb = pytest.importorskip('rocksdb')
+from libertydns.storage.database import DomainIndex
+
+OWNER = b'\x11' * 20
+
+
+def make_block(previous_hash, transactions):
+    return Block(1, previous_hash, Block.calculateMerkleRoot(transactions), 1700000000, 0x207fffff, 0, transactions)
+
+
+def answer_ip(resolver):
+    _, answer, count = resolver.resolve(DNSQuery.parse(build_query(1, "example.dns", TYPE_A)))
+    assert count == 1
+    return '.'.join(str(b) for b in answer[-4:])
+
+
+def test_ip_change_is_visible_on_the_next_query(tmp_path):
+    domains = DomainIndex(str(tmp_path / 'domains'))
+    resolver = DNSResolver.from_domain_index(domains)
+    issue = (TransactionBuilder(tx_type=4, lock_time=0)
+             .add_domain_issue_output(FullDomain("example", "dns", "10.0.0.1"), OWNER).build())
+    first = make_block(b'\x00' * 32, [issue])
+    domains.connect_block(first, 0)
+    assert answer_ip(resolver) == "10.0.0.1"
+    assert answer_ip(resolver) == "10.0.0.1" and resolver.hits == 1
+
+    ip_change = (TransactionBuilder(tx_type=3)
+                 .add_domain_input(issue.txid, 0, b'')
+                 .add_ip_change_output("10.0.0.2").build())
+    domains.connect_block(make_block(first.header_hash(), [ip_change]), 1)
+    assert answer_ip(resolver) == "10.0.0.2"
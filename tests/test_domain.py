@@ -0,0 +1,27 @@
+# Tests for the bit-packed domain encoding
+import pytest
+
+from libertydns.core.domain import FullDomain
+
+DOMAINS = [FullDomain("example", "dns", "10.0.0.1"), FullDomain("example", "dns", "2001:db8::1")]
+
+
+def with_padding(encoding, bits):
+    return encoding[:-1] + bytes([encoding[-1] | bits])
+
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_round_trip(domain):
+    encoding = domain.serialize()
+    assert FullDomain.parse(encoding).serialize() == encoding
+    assert FullDomain.decode_many(FullDomain.encode_many([domain]))[0].serialize() == encoding
+
+
+@pytest.mark.parametrize('domain', DOMAINS)
+@pytest.mark.parametrize('bits', [0x01, 0x04])
+def test_nonzero_padding_is_rejected(domain, bits):
+    encoding = with_padding(domain.serialize(), bits)
+    with pytest.raises(ValueError, match="padding"):
+        FullDomain.parse(encoding)
+    with pytest.raises(ValueError, match="padding"):
+        FullDomain.decode_many(DOMAINS[0].serialize() + encoding)
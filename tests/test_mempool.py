@@ -0,0 +1,20 @@
+# Tests for mempool admission
+import pytest
+
+from libertydns.core.mempool import Mempool
+from libertydns.core.transaction import TransactionBuilder
+
+
+class EmptyCoinView:
+    def get_coin(self, txid, output_index):
+        return None
+
+
+def test_unpaired_ip_change_is_rejected():
+    ip_change = (TransactionBuilder(tx_type=3)
+                 .add_domain_input(b'\x33' * 32, 0, b'')
+                 .add_ip_change_output("10.0.0.2")
+                 .add_ip_change_output("10.0.0.3")
+                 .build())
+    with pytest.raises(ValueError, match="pair up"):
+        Mempool(EmptyCoinView()).add(ip_change)